@@ -0,0 +1,31 @@
+import sys
+import timeit
+
+import numpy as np
+
+import lsqfitgp2 as lgp
+
+# Compare the evaluation time of the derivatives of the kernel used in fit.py
+# when they are computed with the closed forms (the default) and when the
+# terms are opaque kernels derived with autograd. Usage:
+#
+#     python benchkernels.py [n]
+#
+# where n is the number of points (default 2000).
+
+n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+def opaque(kernel):
+    return lgp.Kernel(kernel, derivable=True)
+
+time = np.linspace(0, 100, n)
+closed = 10000 ** 2 * lgp.ExpQuad(scale=30) + 100 ** 2 * lgp.ExpQuad()
+autodiff = 10000 ** 2 * opaque(lgp.ExpQuad(scale=30)) + 100 ** 2 * opaque(lgp.ExpQuad())
+
+for deriv in [1, 2]:
+    k1 = closed.diff(deriv, deriv)
+    k2 = autodiff.diff(deriv, deriv)
+    assert np.allclose(k1(time[:, None], time[None, :]), k2(time[:, None], time[None, :]))
+    for label, k in [('closed', k1), ('autograd', k2)]:
+        t = min(timeit.repeat(lambda: k(time[:, None], time[None, :]), number=1, repeat=5))
+        print('fit.py {:8s} deriv={} {:.3f} s'.format(label, deriv, t))
@@ -6,6 +6,7 @@ import pickle
 import namedate
 import tqdm
 import sys
+import os
 import lsqfitgp2 as lgp
 
 # Read command line.
@@ -22,18 +23,17 @@ gdata = data.groupby('denominazione_regione')
 # This dictionary will be saved on file at the end.
 pickle_dict = dict()
 
+# Directory for the posteriors saved by lsqfitgp2.
+postdir = 'fitpost'
+os.makedirs(postdir, exist_ok=True)
+
 # Model function.
 def fcn(args, p):
-    times = args['times']
     gps = args['gps']
-    pred = args.get('pred', '')
     
     out = gvar.BufferDict()
     for label in gps:
-        phi = p['phi_' + label]
-        if pred:
-            phi = gps[label].predfromfit({'data': phi}, pred)
-        out[label] = phi
+        out[label] = p['phi_' + label]
     
     return out
 
@@ -82,8 +82,6 @@ for region in regions if regions else tqdm.tqdm(data['denominazione_regione'].un
     for label in fitdata:
         gp = lgp.GP(10000 ** 2 * lgp.ExpQuad(scale=30) + 100 ** 2 * lgp.ExpQuad())
         gp.addx(times, 'data')
-        gp.addx(times_pred, 'pred'),
-        gp.addx(times_plot, 'plot')
         gps[label] = gp
     prior = gvar.BufferDict({
         'phi_' + label: gps[label].prior('data')
@@ -94,11 +92,18 @@ for region in regions if regions else tqdm.tqdm(data['denominazione_regione'].un
     args = dict(times=times, gps=gps)
     fit = lsqfit.nonlinear_fit(data=(args, fitdata), prior=prior, fcn=fcn)
     
-    # Compute prediction.
-    predargs = dict(times=times_pred, pred='pred', gps=gps)
-    pred = fcn(predargs, fit.palt)
-    predargs = dict(times=times_plot, pred='plot', gps=gps)
-    plot = fcn(predargs, fit.palt)
+    # Compute prediction. The posteriors are evaluated on the prediction and
+    # plot times without adding them to the GPs, and are correlated with the
+    # fit parameters. They are also saved in a compact form, they can be
+    # evaluated on any points with lgp.Posterior.load(file, kernel).pred(times)
+    # without loading the pickle.
+    pred = gvar.BufferDict()
+    plot = gvar.BufferDict()
+    for label in gps:
+        post = gps[label].predfromfit({'data': fit.palt['phi_' + label]}, predictor=True)
+        pred[label] = post.pred(times_pred)
+        plot[label] = post.pred(times_plot)
+        post.save(f'{postdir}/{region}_{label}.npz')
 
     # Save results.
     pickle_dict[region] = dict(
@@ -75,7 +75,10 @@ class Deriv:
             return self._counter == val._counter
         else:
             return NotImplemented
-    
+
+    def __hash__(self):
+        return hash(frozenset(self._counter.items()))
+
     @property
     def implicit(self):
         """
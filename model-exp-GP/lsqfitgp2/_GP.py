@@ -3,8 +3,12 @@ from __future__ import division
 import itertools
 import sys
 import builtins
+import collections
+import hashlib
 
 import gvar
+from gvar import _svec_smat
+from scipy import spatial
 from autograd import numpy as np
 from autograd.scipy import linalg
 from autograd.builtins import isinstance
@@ -14,6 +18,8 @@ from . import _Kernel
 from . import _linalg
 from . import _array
 from . import _Deriv
+from . import _Posterior
+from . import _laplace
 
 __all__ = [
     'GP'
@@ -44,9 +50,9 @@ def _triu_indices_and_back(n):
 def _block_matrix(blocks):
     """
     Like np.block, but is autograd-friendly and avoids a copy when there is
-    only one block.
+    only one block. The blocks are the last two axes of the arrays.
     """
-    return _concatenate_noop([_concatenate_noop(row, axis=1) for row in blocks], axis=0)
+    return _concatenate_noop([_concatenate_noop(row, axis=-1) for row in blocks], axis=-2)
     # TODO make a bug report to autograd because np.block does not work
 
 def _isarraylike_nostructured(x):
@@ -86,6 +92,135 @@ def _compatible_dtypes(d1, d2):
             return False
     return True
 
+def _kronaxes(x, dims):
+    """
+    Check if the structured array `x` is a lattice over the fields in `dims`,
+    i.e., each field varies only along one axis. Return a list with, for each
+    axis of `x`, the list of fields varying along that axis, or None if `x`
+    is not a lattice. Fields that do not vary at all are assigned to the first
+    axis.
+    """
+    if x.dtype.names is None or not x.shape:
+        return None
+    axes = [[] for _ in x.shape]
+    for dim in dims:
+        if dim not in x.dtype.names:
+            return None
+        a = _linalg.noautograd(x[dim])
+        if a.shape != x.shape:
+            return None
+        varying = [
+            i for i in range(len(x.shape))
+            if np.any(a != np.take(a, [0], axis=i))
+        ]
+        if len(varying) > 1:
+            return None
+        axes[varying[0] if varying else 0].append(dim)
+    return axes
+
+def _diagnoise(ycov):
+    """
+    Return `s` if ycov == s * identity, else None. Autograd is preserved.
+    """
+    ycov_val = _linalg.noautograd(ycov)
+    if np.isscalar(ycov_val) or not ycov_val.shape:
+        return 0 if ycov_val == 0 else None
+    d = np.diag(ycov_val)
+    if np.all(d == d[0]) and np.count_nonzero(ycov_val - np.diag(d)) == 0:
+        return ycov[0, 0]
+    else:
+        return None
+
+def _gvarjac(g):
+    """
+    Given a 1D array of `gvar`s, return their means, their derivatives w.r.t.
+    the primary `gvar`s they depend on as a dense matrix, the indices of those
+    primary `gvar`s and the covariance matrix object of `gvar`. Elements
+    that are not `gvar`s have zero derivatives.
+    """
+    mean = numpy.array(gvar.mean(g), dtype=float)
+    indices = []
+    values = []
+    counts = []
+    cov = None
+    for x in g:
+        if isinstance(x, gvar.GVar):
+            _, svec, cov = x.internaldata
+            indices.append(svec.indices())
+            values.append(svec.values())
+            counts.append(len(indices[-1]))
+        else:
+            counts.append(0)
+    if cov is None:
+        return mean, numpy.zeros((len(g), 0)), numpy.zeros(0, int), None
+    primary, inverse = numpy.unique(numpy.concatenate(indices), return_inverse=True)
+    jac = numpy.zeros((len(g), len(primary)))
+    rows = numpy.repeat(numpy.arange(len(g)), counts)
+    jac[rows, inverse] = numpy.concatenate(values)
+    return mean, jac, primary, cov
+
+def _gvarfromjac(mean, jac, primary, cov):
+    """
+    Inverse of _gvarjac: build the array of `gvar`s with the given means and
+    derivatives w.r.t. the primary `gvar`s with indices `primary`.
+    """
+    out = numpy.empty(len(mean), object)
+    for i in range(len(mean)):
+        nonzero = jac[i] != 0
+        svec = _svec_smat.svec(numpy.count_nonzero(nonzero))
+        svec.assign(jac[i][nonzero], primary[nonzero])
+        out[i] = gvar.GVar(mean[i], svec, cov)
+    return out
+
+def _isboxed(x):
+    return builtins.isinstance(x, np.numpy_boxes.ArrayBox)
+
+def _fingerprint(ycov):
+    """
+    Hashable summary of a data covariance matrix, for caching.
+    """
+    if np.isscalar(ycov) or not np.shape(ycov):
+        return float(ycov)
+    ycov = numpy.ascontiguousarray(ycov)
+    digest = hashlib.sha1(ycov.view(numpy.uint8)).hexdigest()
+    return ycov.shape, str(ycov.dtype), digest
+
+def _samecov(ycov1, ycov2):
+    if np.isscalar(ycov1) or not np.shape(ycov1):
+        return np.isscalar(ycov2) or not np.shape(ycov2)
+    return np.array_equal(ycov1, ycov2)
+
+def _coords(x, dim=None):
+    """
+    Convert the 1D array `x` (field `dim` of `x` if specified) to a 2D float
+    array of coordinates whose euclidean distance is the one used by
+    isotropic kernels.
+    """
+    if dim is not None:
+        x = x[dim]
+    if x.dtype.names is None:
+        x = _linalg.noautograd(x)
+        if not np.issubdtype(x.dtype, np.number):
+            raise TypeError('can not compute distances with dtype {}'.format(x.dtype))
+        return numpy.reshape(numpy.asarray(x, float), (len(x), -1))
+    else:
+        return numpy.concatenate([_coords(x[name]) for name in x.dtype.names], axis=1)
+
+def _diagcov(ycov):
+    """
+    Return the diagonal of ycov if it is diagonal (0 if it is zero), else
+    None. Autograd is preserved.
+    """
+    ycov_val = _linalg.noautograd(ycov)
+    if np.isscalar(ycov_val) or not ycov_val.shape:
+        return 0 if ycov_val == 0 else None
+    if len(ycov_val.shape) == 1:
+        return ycov
+    if np.count_nonzero(ycov_val - np.diag(np.diag(ycov_val))) == 0:
+        return np.diag(ycov)
+    else:
+        return None
+
 class _Element:
     """
     Abstract class for an object holding information associated to a key in a
@@ -146,10 +281,12 @@ class GP:
         Convenience wrappers for `pred`.
     marginal_likelihood :
         Compute the "marginal likelihood", also known as "bayes factor".
+    cache_info, cache_clear :
+        Inspect and empty the cache of matrix decompositions.
     
     """
     
-    def __init__(self, covfun, solver='eigcut+', checkpos=True, checksym=True, checkfinite=True, **kw):
+    def __init__(self, covfun, solver='eigcut+', checkpos=True, checksym=True, checkfinite=True, checklevel='full', cachesize=8, incremental=False, distcache=None, **kw):
         """
         
         Parameters
@@ -159,7 +296,7 @@ class GP:
         solver : str
             A solver used to invert the covariance matrix. See list below for
             the available solvers. Default is `eigcut+` which is slow but
-            robust.
+            robust. `auto` is faster when the matrix is well conditioned.
         checkpos : bool
             If True (default), raise a `ValueError` if the covariance matrix
             turns out non positive within numerical error. The check will be
@@ -170,9 +307,43 @@ class GP:
         checkfinite : bool
             If True (default), check that the covariance matrix does not
             contain infs or nans.
+        checklevel : str
+            How thoroughly the checks enabled by `checkpos` and `checksym` are
+            done. 'full' (default): all the entries are compared with the
+            transposed ones and the eigenvalues are computed, which is O(n^3).
+            'probabilistic': only half of the covariance matrix is computed,
+            the symmetry is checked on a random sample of entries, and the
+            positivity with a Lanczos estimate of the smallest eigenvalue
+            started from a random vector, which is O(n^2). 'off': symmetry and
+            positivity are not checked.
+        cachesize : int
+            The maximum number of decompositions of covariance matrices kept
+            in memory to be reused by `pred` and `marginal_likelihood`
+            (default 8). The least recently used is discarded first. Set to 0
+            to disable caching. See `cache_info` and `cache_clear`.
+        incremental : bool
+            If True, when a decomposition is needed for a list of keys whose
+            leading keys have a cached decomposition, e.g. after adding a new
+            day of data with `addx`, extend the cached decomposition with a
+            block update (Schur complement) instead of decomposing the whole
+            matrix again. The block update is regularized with its own
+            eigenvalue cut, so the result is slightly different from the one
+            of the solver and depends on which decompositions are cached.
+            Default False. Ignored if `cachesize` is 0.
+        distcache : DistanceCache
+            If specified, the squared distances computed by isotropic kernels
+            are taken from and saved to this cache, which can be shared with
+            other GP objects on the same points.
         
         Solvers
         -------
+        auto :
+            Try a Cholesky decomposition regularized like `gersh`, and switch
+            to `eigcut+` if it fails or if the estimated condition number is
+            larger than `maxcond`. The number of decompositions done in each
+            way is reported by `solver_info`. When it switches, the result is
+            the same of `eigcut+`, otherwise it differs by the regularization
+            of the Cholesky decomposition.
         eigcut+ :
             Promote small eigenvalues to a minimum value (default). What
             `lsqfit` does by default.
@@ -189,13 +360,94 @@ class GP:
         maxeigv :
             Cholesky decomposition regularizing the matrix with the maximum
             eigenvalue. Slow for small sizes.
+        cg :
+            Conjugate gradient, which uses only products of the covariance
+            matrix with vectors, O(n^2) for each iteration. The
+            log-determinant is a stochastic estimate, so the marginal
+            likelihood and its gradient are approximate, with an error which
+            depends on the `seed` option and does not go to zero as the
+            iterations converge. Does not need to store a decomposition in
+            addition to the matrix, or the matrix itself with matfree=True.
+        kron :
+            For a kernel which is a product of kernels each acting on one
+            field (specified with `dim`) and x which is a lattice (each field
+            varies along only one axis of the array), diagonalize separately
+            the covariance matrix of each axis. The complexity is
+            O(sum n_i^3) instead of O((prod n_i)^3). Works only for one key
+            without derivatives at a time, and the covariance matrix of the
+            data must be a multiple of the identity.
+        statespace :
+            For a kernel which is a sum of Matérn kernels with half-integer
+            nu (possibly multiplied by constants) on 1D points, represent the
+            process as a stochastic differential equation and use a Kalman
+            filter. The complexity is O(n). Works only for points without
+            derivatives and the covariance matrix of the data must be
+            diagonal.
+        sparse :
+            For a kernel with finite support, like `PPKernel`, compute only
+            the nonzero entries of the covariance matrix, finding the close
+            pairs of points with a kd-tree, and use a sparse LU
+            decomposition. Works only for points without derivatives and the
+            covariance matrix of the data must be diagonal.
+        toeplitz :
+            For a stationary kernel (isotropic kernels, their sums and
+            products, or kernels built with stationary=True) on equispaced
+            1D points (concatenating the keys in order), the covariance
+            matrix is Toeplitz: use the Levinson-Durbin recursion, O(n^2).
+            The covariance matrix of the data must be a multiple of the
+            identity. If these conditions do not hold, falls back to
+            `eigcut+`.
+        fitc :
+            Approximate the covariance matrix with inducing points (see the
+            `inducing` argument): the matrix is replaced by its Nyström
+            approximation Kxu Kuu^-1 Kux, where u are the inducing points,
+            plus a diagonal correction to get the exact variances (fully
+            independent training conditional). The complexity is O(n m^2)
+            where `m` is the number of inducing points. The covariance matrix
+            of the data must be diagonal. The cross covariance and the
+            covariance of the predicted points are computed exactly, so use
+            `pred` with raw=True or diagonal=True on long series.
+        nystrom :
+            Like `fitc`, but without the diagonal correction.
         
         Keyword arguments
         -----------------
         eps : positive float
-            For solvers `eigcut+`, `eigcut-`, `gersh` and `maxeigv`. Specifies
+            For solvers `auto`, `eigcut+`, `eigcut-`, `gersh`, `maxeigv`, `cg`
+            and `kron`. Specifies
             the threshold for considering small the eigenvalues, relative to
             the maximum eigenvalue. The default is matrix size * float epsilon.
+            For the `statespace`, `sparse` and `toeplitz` solvers, the jitter
+            added to the diagonal, relative to the variance of the process.
+            For `fitc` and `nystrom`, the jitter added to the covariance
+            matrix of the inducing points, relative to its trace.
+        inducing : int or array
+            For the `fitc` and `nystrom` solvers, either the inducing points
+            (an array with the same dtype of the points, its shape is
+            ignored) or their number. In the latter case, they are chosen
+            evenly spaced among the sorted points (in their order if the
+            points are structured, and then there must be only one key). The inducing points can be
+            hyperparameters in `empbayes_fit`.
+        tol, maxiter : positive float, positive int
+            For the `cg` solver, the tolerance on the residual relative to
+            the norm of the right hand side (default 1e-10) and the maximum
+            number of iterations (default 10 * matrix size).
+        nprobes, nlanczos, seed : int
+            For the `cg` solver, the number of random vectors and Lanczos
+            steps of the log-determinant estimate (both 32 by default) and
+            the seed of the random vectors (default 0).
+        matfree : bool
+            For the `cg` solver, evaluate the kernel on blocks of rows at
+            each matrix-vector product instead of storing the covariance
+            matrix of the data, so the memory is O(n) instead of O(n^2) at
+            the cost of computing the kernel again at each iteration.
+            Default False. It is not used (the matrix is stored) if some
+            key is a transformation or the covariance matrix depends on
+            hyperparameters derived with autograd. The symmetry and
+            positivity of the matrix are not checked.
+        maxcond : positive float
+            For the `auto` solver, the maximum condition number for using the
+            Cholesky decomposition. Default 1e-6 / eps.
         rank : positive integer
             For the `lowrank` solver, the target rank. It should be much
             smaller than the matrix size for the method to be convenient.
@@ -205,18 +457,59 @@ class GP:
             raise TypeError('covariance function must be of class Kernel')
         self._covfun = covfun
         self._elements = dict() # key -> _Element
-        self._canaddx = True
         self._checkpositive = bool(checkpos)
         decomp = {
+            'auto'   : _linalg.AutoDecomp,
             'eigcut+': _linalg.EigCutFullRank,
             'eigcut-': _linalg.EigCutLowRank,
             'lowrank': _linalg.ReduceRank,
             'gersh'  : _linalg.CholGersh,
-            'maxeigv': _linalg.CholMaxEig
+            'maxeigv': _linalg.CholMaxEig,
+            'cg'     : _linalg.CGDecomp,
+            'kron'   : _linalg.KronDecomp,
+            'statespace': _linalg.KalmanDecomp,
+            'sparse' : _linalg.SparseDecomp,
+            'toeplitz': _linalg.ToeplitzDecomp,
+            'fitc'   : _linalg.DiagLowRank,
+            'nystrom': _linalg.DiagLowRank
         }[solver]
+        if solver in ('fitc', 'nystrom'):
+            inducing = kw.pop('inducing', None)
+            if inducing is None:
+                raise ValueError('solver {} requires the `inducing` argument'.format(solver))
+            if not isinstance(inducing, (int, np.integer)) and not _isarraylike(inducing):
+                raise TypeError('inducing must be int or array')
+            if isinstance(inducing, (int, np.integer)) and inducing < 1:
+                raise ValueError('number of inducing points {} < 1'.format(inducing))
+            self._inducing = inducing
+        self._matfree = bool(kw.pop('matfree', False)) if solver == 'cg' else False
+        self._solvername = solver
+        self._decompkw = kw
         self._decompclass = lambda K, **kwargs: decomp(K, **kwargs, **kw)
+        self._autopaths = dict(chol=0, eigcut=0)
+        if solver == 'auto':
+            def decompclass(K, **kwargs):
+                d = decomp(K, **kwargs, **kw)
+                self._autopaths[d.path] += 1
+                return d
+            self._decompclass = decompclass
         self._checkfinite = bool(checkfinite)
         self._checksym = bool(checksym)
+        if checklevel not in ('off', 'probabilistic', 'full'):
+            raise ValueError('unknown checklevel {!r}'.format(checklevel))
+        self._checklevel = checklevel
+        if checklevel == 'off':
+            self._checkpositive = False
+            self._checksym = False
+        self._cachesize = int(cachesize)
+        if self._cachesize < 0:
+            raise ValueError('cachesize = {} < 0'.format(cachesize))
+        self._solvercache = collections.OrderedDict()
+        self._incremental = bool(incremental)
+        self.cache_clear()
+        if distcache is not None and not isinstance(distcache, _Kernel.DistanceCache):
+            raise TypeError('distcache must be a DistanceCache')
+        self._distcache = distcache
     
     # TODO after I implement block solving, add per-key solver option
     def addx(self, x, key=None, deriv=0):
@@ -235,8 +528,10 @@ class GP:
         change will be reflected on the result. However, after the GP has
         computed internally its covariance matrix, the x are ignored.
         
-        If you use in some way the `gvar` prior, e.g. by calling `prior` or
-        `pred` using `gvar`s, you can't call `addx` any more.
+        If you already used in some way the `gvar` prior, e.g. by calling
+        `prior` or `pred` using `gvar`s, the prior for the new points is
+        obtained conditioning on the prior of the previous points, so the old
+        `gvar`s remain valid and correlated with the new ones.
         
         Parameters
         ----------
@@ -250,10 +545,6 @@ class GP:
             be converted to `Deriv` (see Deriv's help).
         
         """
-        if not self._canaddx:
-            raise RuntimeError('can not add x any more to this process')
-            # TODO remove if I implement the lazy gvar prior
-        
         deriv = _Deriv.Deriv(deriv)
         
         if _isarraylike(x):
@@ -376,16 +667,21 @@ class GP:
         assert isinstance(y, _Points)
         kernel = self._covfun.diff(x.deriv, y.deriv)
         
-        if x is y and not self._checksym:
+        if x is y and (not self._checksym or self._checklevel == 'probabilistic'):
             indices, back = _triu_indices_and_back(x.size)
-            x = x.x.reshape(-1)[indices]
-            y = y.x.reshape(-1)[indices]
+            x = x.x.reshape(-1)[indices[0]]
+            y = y.x.reshape(-1)[indices[1]]
             halfcov = kernel(x, y)
             cov = halfcov[back]
         else:
+            usecache = self._distcache is not None and not x.deriv and not y.deriv
             x = x.x.reshape(-1)[:, None]
             y = y.x.reshape(-1)[None, :]
-            cov = kernel(x, y)
+            if usecache:
+                with self._distcache._use():
+                    cov = kernel(x, y)
+            else:
+                cov = kernel(x, y)
         
         return cov
     
@@ -423,10 +719,39 @@ class GP:
 
         if self._checkfinite and not np.all(np.isfinite(cov)):
             raise RuntimeError('covariance block ({}, {}) is not finite'.format(xkey, ykey))
-        if self._checksym and xkey == ykey and not np.allclose(cov, cov.T):
+        if self._checksym and xkey == ykey and not self._issym(xkey, ykey, cov):
             raise RuntimeError('covariance block ({}, {}) is not symmetric'.format(xkey, ykey))
 
         return cov
+    
+    _checkprobes = 32 # number of entries sampled by the probabilistic checks
+    _checksteps = 30 # Lanczos steps of the probabilistic positivity check
+    
+    def _issym(self, xkey, ykey, cov):
+        """
+        Check that the covariance block (xkey, ykey) is the transpose of the
+        block (ykey, xkey). With the probabilistic check level, only a random
+        sample of entries is compared, evaluating the kernel with swapped
+        arguments, and the block (ykey, xkey) is not computed.
+        """
+        x = self._elements[xkey]
+        y = self._elements[ykey]
+        points = isinstance(x, _Points) and isinstance(y, _Points)
+        if self._checklevel != 'probabilistic' or not points:
+            if xkey == ykey:
+                return np.allclose(cov, cov.T)
+            else:
+                return np.allclose(cov, self._makecovblock(ykey, xkey).T)
+        
+        rng = numpy.random.default_rng(0)
+        i = rng.integers(x.size, size=self._checkprobes)
+        j = rng.integers(y.size, size=self._checkprobes)
+        if xkey == ykey:
+            # the lower triangle is a copy of the upper one
+            i, j = numpy.minimum(i, j), numpy.maximum(i, j)
+        kernel = self._covfun.diff(y.deriv, x.deriv)
+        covT = kernel(y.x.reshape(-1)[j], x.x.reshape(-1)[i])
+        return np.allclose(cov[i, j], covT)
 
     def _covblock(self, row, col):
         if not self._elements:
@@ -439,9 +764,7 @@ class GP:
             block = self._makecovblock(row, col)
             _linalg.noautograd(block).flags['WRITEABLE'] = False
             if row != col:
-                if self._checksym:
-                    blockT = self._makecovblock(col, row)
-                    if not np.allclose(block.T, blockT):
+                if self._checksym and not self._issym(row, col, block):
                         raise RuntimeError('covariance block ({}, {}) is not symmetric'.format(row, col))
                 self._covblocks[col, row] = block.T
             self._covblocks[row, col] = block
@@ -460,57 +783,517 @@ class GP:
         plus the matrix ycov.
         """
         # TODO Block matrix solving. Example: solve a subproblem with kronecker,
-        # another plain. Cache decompositions of blocks. Caching is effective
-        # with data if I can reuse the decomposition of Kxx to compute the
-        # decomposition of Kxx + ycov, i.e. it works in all cases if ycov is
-        # scalar, and in some cases if ycov is diagonal. Is there an efficient
-        # way to update a Cholesky decomposition if I add a diagonal matrix?
+        # another plain. Caching is effective with data if I can reuse the
+        # decomposition of Kxx to compute the decomposition of Kxx + ycov,
+        # i.e. it works in all cases if ycov is scalar, and in some cases if
+        # ycov is diagonal. Is there an efficient way to update a Cholesky
+        # decomposition if I add a diagonal matrix?
+        keys = list(keys)
+        # The covariance blocks are fixed for a given GP object, so the
+        # decompositions depend only on the keys and ycov.
+        cacheable = self._cachesize > 0 and not _isboxed(ycov)
+        if cacheable:
+            ycov = _linalg.noautograd(ycov)
+            cachekey = (tuple(keys), _fingerprint(ycov))
+            entry = self._solvercache.get(cachekey, None)
+            if entry is not None and _samecov(entry[1], ycov):
+                self._solvercache.move_to_end(cachekey)
+                self._cachestats['hits'] += 1
+                return entry[2]
+        
+        decomp = None
+        if self._solvername == 'kron':
+            decomp = self._kronsolver(keys, ycov)
+        elif self._solvername == 'statespace':
+            decomp = self._statespacesolver(keys, ycov)
+        elif self._solvername == 'sparse':
+            decomp = self._sparsesolver(keys, ycov)
+        elif self._solvername == 'toeplitz':
+            decomp = self._toeplitzsolver(keys, ycov)
+        elif self._solvername in ('fitc', 'nystrom'):
+            decomp = self._inducingsolver(keys, ycov)
+        elif self._matfree:
+            decomp = self._matfreesolver(keys, ycov)
+        elif cacheable and self._incremental:
+            decomp = self._updatesolver(keys, ycov)
+        if decomp is None:
+            Kxx = self._assemblecovblocks(keys)
+            if self._checklevel == 'full':
+                assert np.allclose(Kxx, Kxx.T) # TODO remove
+            if self._solvername == 'toeplitz':
+                decomp = _linalg.EigCutFullRank(Kxx + ycov, **self._decompkw)
+            else:
+                decomp = self._decompclass(Kxx + ycov)
+        
+        if cacheable:
+            self._cachestats['misses'] += 1
+            ycovcopy = ycov if np.isscalar(ycov) else numpy.array(ycov)
+            self._solvercache[cachekey] = (keys, ycovcopy, decomp)
+            while len(self._solvercache) > self._cachesize:
+                self._solvercache.popitem(last=False)
+        return decomp
+    
+    def _updatesolver(self, keys, ycov):
+        """
+        If a cached decomposition is for a subset of the keys `keys` which
+        comes first and with the same data covariance, extend it with a block
+        update. Return None if not possible.
+        """
+        scalar = np.isscalar(ycov) or not np.shape(ycov)
+        if scalar and ycov != 0:
+            return None
+        for oldkeys, oldycov, decomp in reversed(self._solvercache.values()):
+            if isinstance(decomp, _linalg.GenEig):
+                continue
+            if len(oldkeys) >= len(keys) or keys[:len(oldkeys)] != oldkeys:
+                continue
+            n = sum(self._elements[key].size for key in oldkeys)
+            if scalar != (np.isscalar(oldycov) or not np.shape(oldycov)):
+                continue
+            if not scalar and not np.array_equal(ycov[:n, :n], oldycov):
+                continue
+            newkeys = keys[len(oldkeys):]
+            S = self._assemblecovblocks(newkeys)
+            Q = self._assemblecovblocks(oldkeys, newkeys)
+            if not scalar:
+                S = S + ycov[n:, n:]
+                Q = Q + ycov[:n, n:]
+            self._cachestats['updates'] += 1
+            decompclass = self._decompclass
+            if self._solvername != 'lowrank':
+                diag = np.concatenate([np.diag(self._covblock(key, key)) for key in keys])
+                if not scalar:
+                    diag = diag + np.diag(ycov)
+                maxeigv = np.sum(diag) # upper bound
+                decompclass = lambda K: self._decompclass(K, maxeigv=maxeigv)
+            return _linalg.BlockDecomp(decomp, S, Q, decompclass)
+        return None
+    
+    _geneigsolvers = ('auto', 'eigcut+', 'eigcut-', 'gersh', 'maxeigv')
+    
+    # solvers whose decompositions give correct second derivatives with
+    # autograd
+    _hessiansolvers = _geneigsolvers + ('lowrank', 'statespace', 'nystrom')
+    
+    def _noisesolver(self, keys, ycov, noisescale):
+        """
+        Like _solver, for the matrix of keys `keys` plus noisescale * ycov.
+        For the dense solvers, decompose with a generalized diagonalization of
+        the pair (prior covariance, ycov), which is cached and reused for
+        other values of noisescale.
+        """
+        if noisescale is None:
+            return self._solver(keys, ycov)
+        cacheable = self._cachesize > 0 and not _isboxed(ycov)
+        scalar = np.isscalar(ycov) or not np.shape(ycov)
+        if not cacheable or self._solvername not in self._geneigsolvers or (scalar and ycov == 0):
+            return self._solver(keys, noisescale * ycov)
+        
+        keys = list(keys)
+        ycov = _linalg.noautograd(ycov)
+        cachekey = ('geneig', tuple(keys), _fingerprint(ycov))
+        entry = self._solvercache.get(cachekey, None)
+        if entry is not None and _samecov(entry[1], ycov):
+            self._solvercache.move_to_end(cachekey)
+            self._cachestats['hits'] += 1
+            return entry[2].shift(noisescale)
+        
         Kxx = self._assemblecovblocks(keys)
-        assert np.allclose(Kxx, Kxx.T) # TODO remove
-        return self._decompclass(Kxx + ycov)
+        if _isboxed(Kxx):
+            return self._solver(keys, noisescale * ycov)
+        try:
+            geneig = _linalg.GenEig(Kxx, ycov, self._decompkw.get('eps', None))
+        except numpy.linalg.LinAlgError:
+            # ycov is not positive definite
+            return self._solver(keys, noisescale * ycov)
+        
+        self._cachestats['misses'] += 1
+        ycovcopy = ycov if scalar else numpy.array(ycov)
+        self._solvercache[cachekey] = (keys, ycovcopy, geneig)
+        while len(self._solvercache) > self._cachesize:
+            self._solvercache.popitem(last=False)
+        return geneig.shift(noisescale)
+    
+    def cache_info(self):
+        """
         
-    def _checkpos(self, cov):
-        eigv = linalg.eigvalsh(_linalg.noautograd(cov))
-        mineigv = np.min(eigv)
+        Return statistics on the cache of matrix decompositions. Each
+        decomposition is identified by the list of keys and the covariance
+        matrix of the data. The cache is not used when the covariance matrix
+        of the data is being differentiated with autograd. The generalized
+        diagonalizations used with the `noisescale` argument of `pred` and
+        `marginal_likelihood` are cached together with the decompositions.
+        
+        Returns
+        -------
+        info : dict
+            With keys 'hits', 'misses' (decompositions computed), 'updates'
+            (misses obtained by extending a cached decomposition of a subset
+            of the keys, only with incremental=True), 'size' and 'maxsize'.
+        
+        """
+        return dict(
+            size=len(self._solvercache),
+            maxsize=self._cachesize,
+            **self._cachestats
+        )
+    
+    def solver_info(self):
+        """
+        
+        Return how many decompositions were computed by the `auto` solver
+        with Cholesky and with the fallback to `eigcut+`.
+        
+        Returns
+        -------
+        info : dict
+            With keys 'chol' and 'eigcut'.
+        
+        """
+        return dict(self._autopaths)
+    
+    def cache_clear(self):
+        """
+        Empty the cache of matrix decompositions and reset the statistics.
+        """
+        self._solvercache.clear()
+        self._cachestats = dict(hits=0, misses=0, updates=0)
+    
+    def _kronsolver(self, keys, ycov):
+        """
+        Like _solver, but decompose the covariance matrix as a kronecker
+        product, without assembling it.
+        """
+        if len(keys) != 1:
+            raise ValueError('kron solver works with one key, got {}'.format(len(keys)))
+        key = keys[0]
+        x = self._elements[key]
+        if not isinstance(x, _Points) or x.deriv:
+            raise ValueError('kron solver works only with points without derivatives')
+        
+        factors = self._covfun._kronfactors
+        if factors is None:
+            raise ValueError('kernel is not a product of kernels on separate fields')
+        axes = _kronaxes(x.x, factors)
+        if axes is None:
+            raise ValueError('x[{}] is not a lattice over fields {}'.format(repr(key), list(factors)))
+        noise = _diagnoise(ycov)
+        if noise is None:
+            raise ValueError('kron solver requires a covariance of `given` proportional to the identity')
+        
+        Ks = []
+        for i, dims in enumerate(axes):
+            index = tuple(slice(None) if j == i else 0 for j in range(len(x.shape)))
+            line = x.x[index]
+            K = np.ones((len(line), len(line)))
+            for dim in dims:
+                K = K * factors[dim](line[:, None], line[None, :])
+            if self._checkfinite and not np.all(np.isfinite(K)):
+                raise RuntimeError('covariance matrix along axis {} of x[{}] is not finite'.format(i, repr(key)))
+            Ks.append(K)
+        
+        return self._decompclass(Ks, noise=noise)
+    
+    def _statespacesolver(self, keys, ycov):
+        """
+        Like _solver, but use a Kalman filter on the concatenated points of
+        all the keys, without assembling the covariance matrix.
+        """
+        terms = self._covfun._ssterms
+        if terms is None:
+            raise ValueError('kernel is not a sum of Matérn kernels with half-integer nu')
+        xs = []
+        for key in keys:
+            x = self._elements[key]
+            if not isinstance(x, _Points) or x.deriv:
+                raise ValueError('statespace solver works only with points without derivatives')
+            if x.x.dtype.names is not None:
+                raise ValueError('statespace solver works only with non-structured x, x[{}] is structured'.format(repr(key)))
+            xs.append(x.x.reshape(-1))
+        noise = _diagcov(ycov)
+        if noise is None:
+            raise ValueError('statespace solver requires a diagonal covariance of `given`')
+        return self._decompclass(np.concatenate(xs), terms=terms, noise=noise)
+    
+    def _sparsesolver(self, keys, ycov):
+        """
+        Like _solver, but compute only the nonzero entries of the covariance
+        matrix and use a sparse decomposition.
+        """
+        support = self._covfun._support
+        if support is None:
+            raise ValueError('kernel has not finite support')
+        radius, dim = support
+        radius = float(_linalg.noautograd(radius))
+        xs = []
+        for key in keys:
+            x = self._elements[key]
+            if not isinstance(x, _Points) or x.deriv:
+                raise ValueError('sparse solver works only with points without derivatives')
+            xs.append(x.x.reshape(-1))
+        noise = _diagcov(ycov)
+        if noise is None:
+            raise ValueError('sparse solver requires a diagonal covariance of `given`')
+        
+        # Find the pairs of points in the support with a kd-tree.
+        offsets = numpy.cumsum([0] + [len(x) for x in xs])
+        n = offsets[-1]
+        tree = spatial.cKDTree(numpy.concatenate([_coords(x, dim) for x in xs]))
+        pairs = tree.query_pairs(radius, output_type='ndarray')
+        rows = numpy.concatenate([pairs[:, 0], pairs[:, 1], numpy.arange(n)])
+        cols = numpy.concatenate([pairs[:, 1], pairs[:, 0], numpy.arange(n)])
+        
+        # Evaluate the kernel on the pairs, grouped by keys.
+        rowkey = numpy.searchsorted(offsets, rows, side='right') - 1
+        colkey = numpy.searchsorted(offsets, cols, side='right') - 1
+        values = []
+        order = []
+        for a, xa in enumerate(xs):
+            for b, xb in enumerate(xs):
+                sel = numpy.flatnonzero((rowkey == a) & (colkey == b))
+                if len(sel):
+                    x = xa[rows[sel] - offsets[a]]
+                    y = xb[cols[sel] - offsets[b]]
+                    values.append(self._covfun(x, y))
+                    order.append(sel)
+        order = numpy.concatenate(order)
+        values = np.concatenate(values)
+        if self._checkfinite and not np.all(np.isfinite(values)):
+            raise RuntimeError('covariance matrix of keys {} is not finite'.format(keys))
+        
+        return self._decompclass(rows[order], cols=cols[order], values=values, n=n, noise=noise)
+    
+    def _toeplitzsolver(self, keys, ycov):
+        """
+        Like _solver, but compute only the first row of the covariance matrix
+        and use a Toeplitz decomposition. Return None if the points are not
+        equispaced or the kernel is not stationary.
+        """
+        if not self._covfun._stationary:
+            return None
+        xs = []
+        for key in keys:
+            x = self._elements[key]
+            if not isinstance(x, _Points) or x.deriv or x.x.dtype.names is not None:
+                return None
+            xs.append(x.x.reshape(-1))
+        noise = _diagnoise(ycov)
+        if noise is None:
+            return None
+        x = np.concatenate(xs)
+        if len(x) > 1:
+            dx = np.diff(_linalg.noautograd(x))
+            if dx[0] == 0 or not np.allclose(dx, dx[0]):
+                return None
+        t = self._covfun(x[:1], x)
+        if self._checkfinite and not np.all(np.isfinite(t)):
+            raise RuntimeError('covariance matrix of keys {} is not finite'.format(keys))
+        t = t + noise * (np.arange(len(t)) == 0)
+        return self._decompclass(t)
+    
+    _matfreechunk = 256 # number of rows computed at once by _matfreesolver
+    
+    def _matfreesolver(self, keys, ycov):
+        """
+        Like _solver, but for the `cg` solver with matfree=True: the
+        covariance matrix is computed on blocks of rows at each product
+        with a matrix. Return None if some key is a transformation or the
+        covariance matrix depends on autograd-traced hyperparameters.
+        """
+        if _isboxed(ycov):
+            return None
+        xs = []
+        derivs = []
+        diags = []
+        for key in keys:
+            x = self._elements[key]
+            if not isinstance(x, _Points):
+                return None
+            xs.append(x.x.reshape(-1))
+            derivs.append(x.deriv)
+            diag = self._covfun.diff(x.deriv, x.deriv)(xs[-1], xs[-1])
+            if _isboxed(diag):
+                return None
+            diags.append(diag)
+        diag = np.concatenate(diags)
+        if not (np.isscalar(ycov) or not np.shape(ycov)):
+            diag = diag + np.diag(ycov)
+        if self._checkfinite and not np.all(np.isfinite(diag)):
+            raise RuntimeError('covariance matrix of keys {} is not finite'.format(keys))
+        
+        sizes = [len(x) for x in xs]
+        starts = numpy.cumsum([0] + sizes)
+        chunk = self._matfreechunk
+        def matmat(V):
+            out = numpy.empty(V.shape)
+            for x, xd, start in zip(xs, derivs, starts):
+                for i in range(0, len(x), chunk):
+                    rows = x[i:i + chunk, None]
+                    K = numpy.concatenate([
+                        self._covfun.diff(xd, yd)(rows, y[None, :])
+                        for y, yd in zip(xs, derivs)
+                    ], axis=1)
+                    if self._checkfinite and not np.all(np.isfinite(K)):
+                        raise RuntimeError('covariance matrix of keys {} is not finite'.format(keys))
+                    out[start + i:start + i + len(rows)] = K @ V
+            return out + ycov @ V if np.shape(ycov) else out + ycov * V
+        return self._decompclass(matmat, diag=diag)
+    
+    def _inducingsolver(self, keys, ycov):
+        """
+        Like _solver, but approximate the covariance matrix with the inducing
+        points as a diagonal plus low rank matrix.
+        """
+        xs = []
+        for key in keys:
+            x = self._elements[key]
+            if not isinstance(x, _Points):
+                raise ValueError('{} solver works only with points, {} is a transformation'.format(self._solvername, repr(key)))
+            xs.append(x)
+        noise = _diagcov(ycov)
+        if noise is None:
+            raise ValueError('{} solver requires a diagonal covariance of `given`'.format(self._solvername))
+        
+        u = self._inducing
+        if isinstance(u, (int, np.integer)):
+            if xs[0].x.dtype.names is None:
+                x = numpy.sort(numpy.concatenate([_linalg.noautograd(x.x).reshape(-1) for x in xs]))
+            elif len(xs) == 1:
+                x = xs[0].x.reshape(-1)
+            else:
+                raise ValueError('can not choose inducing points among structured x of multiple keys, pass them explicitly')
+            u = x[numpy.unique(numpy.linspace(0, len(x) - 1, u).round().astype(int))]
+        else:
+            u = _asarray(u).reshape(-1)
+        
+        Kuu = self._covfun(u[:, None], u[None, :])
+        Kxu = _concatenate_noop([
+            self._covfun.diff(x.deriv, 0)(x.x.reshape(-1)[:, None], u[None, :])
+            for x in xs
+        ], axis=0)
+        if self._checkfinite and not (np.all(np.isfinite(Kuu)) and np.all(np.isfinite(Kxu))):
+            raise RuntimeError('covariance matrix of inducing points is not finite')
+        
+        # Kuu + jitter = L L^T, K ~= Kxu Kuu^-1 Kux = U U^T with U = Kxu L^-T
+        eps = self._decompkw.get('eps', None)
+        if eps is None:
+            eps = len(Kuu) * np.finfo(float).eps
+        jitter = eps * np.trace(Kuu)
+        L = np.linalg.cholesky(Kuu + jitter * np.eye(len(Kuu)))
+        U = linalg.solve_triangular(L, Kxu.T, lower=True).T
+        
+        if self._solvername == 'fitc':
+            var = _concatenate_noop([
+                self._covfun.diff(x.deriv, x.deriv)(x.x.reshape(-1), x.x.reshape(-1))
+                for x in xs
+            ])
+            d = var - np.sum(U ** 2, axis=1)
+            d = np.where(d > jitter, d, jitter)
+        else:
+            d = jitter * np.ones(len(U))
+        return _linalg.DiagLowRank(d + noise, U)
+    
+    def _checkpos(self, cov, maxeigv=None, eps=None):
+        """
+        Check that cov is positive semidefinite within `eps` (default matrix
+        size * float epsilon) relative to the maximum eigenvalue, or to
+        `maxeigv` if specified. With the probabilistic check level, the
+        extreme eigenvalues are estimated with the Lanczos algorithm.
+        """
+        if self._checklevel == 'probabilistic':
+            mineigv, topeigv = _linalg.extreme_eigvals(cov, self._checksteps)
+        else:
+            eigv = linalg.eigvalsh(_linalg.noautograd(cov))
+            mineigv = np.min(eigv)
+            topeigv = np.max(eigv)
         if mineigv < 0:
-            bound = -len(cov) * np.finfo(float).eps * np.max(eigv)
+            if eps is None:
+                eps = len(cov) * np.finfo(float).eps
+            if maxeigv is None:
+                maxeigv = topeigv
+            bound = -eps * maxeigv
             if mineigv < bound:
                 msg = 'covariance matrix is not positive definite: '
                 msg += 'mineigv = {:.4g} < {:.4g}'.format(mineigv, bound)
                 raise ValueError(msg)
         
-    @property
-    def _prior(self):
-        # TODO I think that gvar internals would let me build the prior
-        # one block at a time although everything is correlated, but I don't
-        # know how to do it. In case it is possible, replace this with a
-        # method that gets the prior for a key without necessarily generating
-        # the whole prior. Finally, remove the _canaddx check in GP.addx.
+    def _prior(self, keys):
+        """
+        Return the gvar prior as a BufferDict containing at least the keys in
+        `keys`. The prior is built lazily: keys not yet present are added
+        conditionally on the ones already built, so all the keys are
+        correlated as they should regardless of the order they are requested.
+        """
+        missing = []
+        for key in keys:
+            if key not in missing and not (hasattr(self, '_priordict') and key in self._priordict):
+                missing.append(key)
         if not hasattr(self, '_priordict'):
             if self._checkpositive:
-                fullcov = self._assemblecovblocks(list(self._elements))
+                fullcov = self._assemblecovblocks(missing)
                 self._checkpos(fullcov)
             mean = {
-                key: np.zeros(x.shape)
-                for key, x in self._elements.items()
+                key: np.zeros(self._elements[key].shape)
+                for key in missing
             }
             cov = {
-                (row, col): self._covblock(row, col).reshape(x.shape + y.shape)
-                for row, x in self._elements.items()
-                for col, y in self._elements.items()
+                (row, col): self._covblock(row, col).reshape(self._elements[row].shape + self._elements[col].shape)
+                for row in missing
+                for col in missing
             }
             self._priordict = gvar.gvar(mean, cov)
             self._priordict.buf.flags['WRITEABLE'] = False
-            self._canaddx = False
+        elif missing:
+            self._extendprior(missing)
         return self._priordict
     
+    def _extendprior(self, newkeys):
+        """
+        Add to the prior the keys in `newkeys`, conditionally on the prior
+        of the keys already present.
+        """
+        oldkeys = list(self._priordict)
+        if not hasattr(self, '_priordecomp'):
+            self._priordecomp = _linalg.EigCutLowRank(self._assemblecovblocks(oldkeys))
+        
+        # The Schur complement has the roundoff of the whole matrix, whose
+        # maximum eigenvalue is bounded by the trace. Dropping the small
+        # eigenvalues (instead of raising them) keeps the Schur complement
+        # positive when the matrix is ill-conditioned.
+        diag = np.concatenate([np.diag(self._covblock(key, key)) for key in oldkeys + newkeys])
+        maxeigv = np.sum(diag)
+        decomp = _linalg.BlockDecomp(
+            self._priordecomp,
+            self._assemblecovblocks(newkeys),
+            self._assemblecovblocks(oldkeys, newkeys),
+            lambda K: _linalg.EigCutLowRank(K, maxeigv=maxeigv)
+        )
+        if self._checkpositive:
+            self._checkpos(decomp._schur, maxeigv=maxeigv, eps=len(diag) * np.finfo(float).eps)
+        
+        # new = A @ old + independent part with the Schur complement as cov
+        mean, jac, primary, cov = _gvarjac(self._priordict.buf)
+        A = decomp._invPQ.T
+        flatnew = _gvarfromjac(A @ mean, A @ jac, primary, cov)
+        flatnew = flatnew + gvar.gvar(np.zeros(len(flatnew)), decomp._schur)
+        
+        prior = gvar.BufferDict(self._priordict)
+        for key, slic in zip(newkeys, self._slices(newkeys)):
+            prior[key] = flatnew[slic].reshape(self._elements[key].shape)
+        prior.buf.flags['WRITEABLE'] = False
+        self._priordict = prior
+        self._priordecomp = decomp
+    
     def prior(self, key=None, raw=False):
         """
         
         Return an array or a dictionary of arrays of `gvar`s representing the
         prior for the gaussian process. The returned object is not unique but
         the `gvar`s stored inside are, so all the correlations are kept between
-        objects returned by different calls to `prior`.
+        objects returned by different calls to `prior`. The `gvar`s for a key
+        are created only the first time they are needed, conditionally on
+        those already existing, so the correlations do not depend on the
+        order of the calls.
         
         Calling without arguments returns the complete prior as a dictionary.
         If you specify `key`, only the array for the requested key is returned.
@@ -555,11 +1338,12 @@ class GP:
         elif raw:
             return self._covblock(key, key)
         elif outkeys is not None:
+            prior = self._prior(outkeys)
             return gvar.BufferDict({
-                key: self._prior[key] for key in outkeys
+                key: prior[key] for key in outkeys
             })
         else:
-            return self._prior[key]
+            return self._prior([key])[key]
         
     def _flatgiven(self, given, givencov):
         if _isarraylike_nostructured(given):
@@ -581,6 +1365,7 @@ class GP:
         
         ylist = []
         keylist = []
+        batchshape = None
         for key, l in given.items():
             if key not in self._elements:
                 raise KeyError(key)
@@ -593,22 +1378,38 @@ class GP:
             # has this bug:
             # array([object()]) -> array([array([object()])])
             shape = self._elements[key].shape
-            if l.shape != shape:
+            nbatch = len(l.shape) - len(shape)
+            if nbatch < 0 or l.shape[nbatch:] != shape:
                 raise ValueError('given[{}] has shape {} different from shape {}'.format(repr(key), l.shape, shape))
+            if batchshape is None:
+                batchshape = l.shape[:nbatch]
+            elif l.shape[:nbatch] != batchshape:
+                raise ValueError('given[{}] has batch shape {} different from {}'.format(repr(key), l.shape[:nbatch], batchshape))
             if l.dtype != object and not np.issubdtype(l.dtype, np.number):
                     raise ValueError('given[{}] has non-numerical dtype {}'.format(repr(key), l.dtype))
             
-            ylist.append(l.reshape(-1))
+            ylist.append(l.reshape(batchshape + (-1,)))
             keylist.append(key)
         
         if givencov is not None:
-            covblocks = [
-                [
-                    givencov[keylist[i], keylist[j]].reshape(ylist[i].shape + ylist[j].shape)
-                    for j in range(len(keylist))
+            covblocks = []
+            batched = False
+            for i in range(len(keylist)):
+                row = []
+                for j in range(len(keylist)):
+                    block = givencov[keylist[i], keylist[j]]
+                    ndim = len(self._elements[keylist[i]].shape) + len(self._elements[keylist[j]].shape)
+                    blockbatch = block.shape[:len(block.shape) - ndim]
+                    if blockbatch not in [(), batchshape]:
+                        raise ValueError('givencov[{}, {}] has batch shape {} different from {}'.format(repr(keylist[i]), repr(keylist[j]), blockbatch, batchshape))
+                    batched = batched or bool(blockbatch)
+                    row.append(block.reshape(blockbatch + (ylist[i].shape[-1], ylist[j].shape[-1])))
+                covblocks.append(row)
+            if batched:
+                covblocks = [
+                    [np.broadcast_to(block, batchshape + block.shape[-2:]) for block in row]
+                    for row in covblocks
                 ]
-                for i in range(len(keylist))
-            ]
         else:
             covblocks = None
             
@@ -623,7 +1424,35 @@ class GP:
         stops = np.concatenate([[0], np.cumsum(sizes)])
         return [slice(stops[i - 1], stops[i]) for i in range(1, len(stops))]
     
-    def pred(self, given, key=None, givencov=None, fromdata=None, raw=False, keepcorr=None):
+    def _givencov(self, y, ycovblocks):
+        """
+        Return the covariance matrix of the flattened `given` `y`, from the
+        blocks of `givencov` if specified, else from the `gvar`s in `y`, else
+        0. If `y` has batch axes, the covariance matrix is computed
+        separately for each batch element, ignoring correlations between
+        them, and it is returned without batch axes if it is the same for all
+        of them.
+        """
+        if ycovblocks is not None:
+            ycov = _block_matrix(ycovblocks)
+        elif y.dtype == object:
+            gvary = gvar.gvar(y).reshape(-1, y.shape[-1])
+            # TODO this gvar.gvar(y) is here because gvar.evalcov is picky and
+            # won't accept a non-gvar scalar in the array. I should modify
+            # gvar.evalcov, since gvar.mean and gvar.sdev accept non-gvars.
+            ycov = numpy.stack([gvar.evalcov(row) for row in gvary])
+            ycov = ycov.reshape(y.shape[:-1] + ycov.shape[-2:])
+        else:
+            return 0
+        if self._checkfinite and not np.all(np.isfinite(ycov)):
+            raise ValueError('covariance matrix of `given` is not finite')
+        if len(ycov.shape) > 2 and not _isboxed(ycov):
+            flat = ycov.reshape((-1,) + ycov.shape[-2:])
+            if np.all(flat == flat[0]):
+                ycov = flat[0]
+        return ycov
+    
+    def pred(self, given, key=None, givencov=None, fromdata=None, raw=False, keepcorr=None, diagonal=False, noisescale=None, predictor=False):
         """
         
         Compute the posterior for the gaussian process, either on all points,
@@ -640,6 +1469,12 @@ class GP:
         to the keys in the GP as added by `addx`. You can pass an array if
         there is only one key in the GP.
         
+        The arrays in `given` can have additional leading axes (the same for
+        all keys) to condition on many datasets at once, like in
+        `marginal_likelihood`, provided their covariance matrix is the same.
+        The output means have the same leading axes, while the covariance
+        matrix is shared. This requires keepcorr=False.
+        
         Parameters
         ----------
         given : array or dictionary of arrays
@@ -665,6 +1500,22 @@ class GP:
             prior and the data/fit. If False, they have the correct covariance
             between themselves, but are independent from all other preexisting
             `gvar`s.
+        diagonal : bool (default False)
+            If True, compute only the variances of the posterior, without the
+            covariances between different points. The output points are
+            processed in chunks, so the full covariance matrix and the full
+            cross covariance with the inputs are never held in memory.
+            Implies keepcorr=False. With raw=False the returned `gvar`s are
+            independent.
+        noisescale : scalar, optional
+            If specified, the covariance matrix of `given` is multiplied by
+            `noisescale`, see `marginal_likelihood`. Requires fromdata=True
+            and keepcorr=False.
+        predictor : bool (default False)
+            If True, return a `Posterior` object, which holds the
+            decomposition and computes the posterior on any new points,
+            which do not need to be added to the GP. Requires `key`, `raw`,
+            `keepcorr` and `diagonal` to be left unspecified. See `posterior`.
         
         Returns
         -------
@@ -680,18 +1531,33 @@ class GP:
         pcov : 2D array or dictionary of 2D arrays
             The covariance matrix of the posterior. If `pmean` is a dictionary,
             the keys of `pcov` are pairs of keys of `pmean`. Equivalent to
-            `gvar.evalcov(posterior)`.
+            `gvar.evalcov(posterior)`. If diagonal=True, the variances, with
+            the same format of `pmean`.
+        
+        If predictor=True:
+        
+        posterior : Posterior
+            The posterior, evaluated on new points with `Posterior.pred`.
         
         """
         
         if fromdata is None:
             raise ValueError('you must specify if `given` is data or fit result')
+        if predictor:
+            if key is not None or raw or keepcorr is not None or diagonal:
+                raise ValueError('predictor=True with key, raw, keepcorr or diagonal specified')
+            return self.posterior(given, givencov, fromdata, noisescale=noisescale)
         fromdata = bool(fromdata)
         raw = bool(raw)
+        diagonal = bool(diagonal)
         if keepcorr is None:
-            keepcorr = not raw
+            keepcorr = not raw and not diagonal
         if keepcorr and raw:
             raise ValueError('both keepcorr=True and raw=True')
+        if keepcorr and diagonal:
+            raise ValueError('both keepcorr=True and diagonal=True')
+        if noisescale is not None and (keepcorr or not fromdata):
+            raise ValueError('noisescale requires fromdata=True and keepcorr=False')
         
         strip = False
         if key is None:
@@ -704,19 +1570,44 @@ class GP:
         outslices = self._slices(outkeys)
         
         ylist, inkeys, ycovblocks = self._flatgiven(given, givencov)
-        y = _concatenate_noop(ylist)
+        y = _concatenate_noop(ylist, axis=-1)
+        batchshape = y.shape[:-1]
+        if batchshape and keepcorr:
+            raise ValueError('`given` has batch shape {}, use keepcorr=False'.format(batchshape))
+        
+        if diagonal:
+            mean, var = self._preddiag(inkeys, outkeys, y, ycovblocks, fromdata, noisescale)
+            if not raw:
+                flatout = gvar.gvar(mean, np.sqrt(var))
+                if strip:
+                    return flatout.reshape(flatout.shape[:-1] + self._elements[outkeys[0]].shape)
+                return gvar.BufferDict({
+                    key: flatout[..., slic].reshape(flatout.shape[:-1] + self._elements[key].shape)
+                    for key, slic in zip(outkeys, outslices)
+                })
+            elif strip:
+                shape = self._elements[outkeys[0]].shape
+                return mean.reshape(batchshape + shape), var.reshape(var.shape[:-1] + shape)
+            else:
+                meandict, vardict = [
+                    {
+                        key: a[..., slic].reshape(a.shape[:-1] + self._elements[key].shape)
+                        for key, slic in zip(outkeys, outslices)
+                    }
+                    for a in (mean, var)
+                ]
+                return meandict, vardict
         
         # I think it is good to have Kxxs row-major and Kxsx column-major
         Kxxs = self._assemblecovblocks(inkeys, outkeys)
         Kxsx = Kxxs.T
         
         # TODO remove
-        assert np.allclose(Kxxs, self._assemblecovblocks(outkeys, inkeys).T)
+        if self._checklevel == 'full':
+            assert np.allclose(Kxxs, self._assemblecovblocks(outkeys, inkeys).T)
         
-        if ycovblocks is not None:
-            ycov = _block_matrix(ycovblocks)
-        elif (fromdata or raw or not keepcorr) and y.dtype == object:
-            ycov = gvar.evalcov(gvar.gvar(y))
+        if ycovblocks is not None or fromdata or raw or not keepcorr:
+            ycov = self._givencov(y, ycovblocks)
             # TODO use evalcov_block? If fromdata=True, it doesn't really
             # make a difference because I just use ycov in Kxx + ycov. If
             # fromdata=False, typically ycov will be dense. The only reason
@@ -726,8 +1617,8 @@ class GP:
             # caching of decompositions and ycov is diagonal. Or: ycov is zero,
             # then evalcov builds a matrix of zeros anyway -> make a method
             # to replace evalcov.
-            if self._checkfinite and not np.all(np.isfinite(ycov)):
-                raise ValueError('covariance matrix of `given` is not finite')
+            if len(np.shape(ycov)) > 2:
+                raise ValueError('covariance matrix of `given` varies along the batch axes, not supported by pred')
         else:
             ycov = 0
         
@@ -735,16 +1626,17 @@ class GP:
             
             Kxsxs = self._assemblecovblocks(outkeys)
 
-            assert np.allclose(Kxsxs, Kxsxs.T) # TODO remove
+            if self._checklevel == 'full':
+                assert np.allclose(Kxsxs, Kxsxs.T) # TODO remove
             
             ymean = gvar.mean(y)
             if self._checkfinite and not np.all(np.isfinite(ymean)):
                 raise ValueError('mean of `given` is not finite')
             
             if fromdata:
-                solver = self._solver(inkeys, ycov)
+                solver = self._noisesolver(inkeys, ycov, noisescale)
                 cov = Kxsxs - solver.quad(Kxxs)
-                mean = solver.solve(Kxxs).T @ ymean
+                mean = ymean @ solver.solve(Kxxs)
             else:
                 solver = self._solver(inkeys)
                 A = solver.solve(Kxxs).T
@@ -757,20 +1649,29 @@ class GP:
                     cov = Kxsxs + A @ ycov @ A.T - solver.quad(Kxxs)
                 # equivalent formula:
                 # cov = Kxsxs - A @ (Kxx - ycov) @ A.T
-                mean = A @ ymean
+                mean = ymean @ A.T
             
         else: # (keepcorr and not raw)        
-            yplist = [self._prior[key].reshape(-1) for key in inkeys]
-            ysplist = [self._prior[key].reshape(-1) for key in outkeys]
+            prior = self._prior(inkeys + outkeys)
+            yplist = [prior[key].reshape(-1) for key in inkeys]
+            ysplist = [prior[key].reshape(-1) for key in outkeys]
             yp = _concatenate_noop(yplist)
             ysp = _concatenate_noop(ysplist)
             
+            # Work with the means and derivatives w.r.t. primary gvars as
+            # float matrices instead of using arrays of gvars, then build the
+            # output in one go.
             mat = ycov if fromdata else 0
-            flatout = Kxsx @ self._solver(inkeys, mat).usolve(y - yp) + ysp
+            solver = self._solver(inkeys, mat)
+            n = len(yp)
+            mean, jac, primary, cov = _gvarjac(_concatenate_noop([y - yp, ysp]))
+            outmean = Kxsx @ solver.solve(mean[:n]) + mean[n:]
+            outjac = Kxsx @ solver.solve(jac[:n]) + jac[n:]
+            flatout = _gvarfromjac(outmean, outjac, primary, cov)
         
         if raw and not strip:
             meandict = {
-                key: mean[slic].reshape(self._elements[key].shape)
+                key: mean[..., slic].reshape(batchshape + self._elements[key].shape)
                 for key, slic in zip(outkeys, outslices)
             }
             
@@ -785,22 +1686,83 @@ class GP:
             
         elif raw:
             assert len(outkeys) == 1
-            mean = mean.reshape(self._elements[outkeys[0]].shape)
+            mean = mean.reshape(batchshape + self._elements[outkeys[0]].shape)
             cov = cov.reshape(2 * self._elements[outkeys[0]].shape)
             return mean, cov
         
         elif not keepcorr:
-            flatout = gvar.gvar(mean, cov)
+            flatout = numpy.array([
+                gvar.gvar(m, cov) for m in mean.reshape(-1, mean.shape[-1])
+            ]).reshape(mean.shape)
         
         if not strip:
             return gvar.BufferDict({
-                key: flatout[slic].reshape(self._elements[key].shape)
+                key: flatout[..., slic].reshape(batchshape + self._elements[key].shape)
                 for key, slic in zip(outkeys, outslices)
             })
         else:
             assert len(outkeys) == 1
-            return flatout.reshape(self._elements[outkeys[0]].shape)
+            return flatout.reshape(batchshape + self._elements[outkeys[0]].shape)
+        
+    _predchunk = 256 # number of output points processed at once by _preddiag
+    
+    def _crosscovchunk(self, inkeys, outkey, index):
+        """
+        Return the covariance matrix between the keys `inkeys` and the
+        flattened points of `outkey` selected by `index`, and the variance of
+        the latter. The kernel is evaluated only on the required points if
+        possible.
+        """
+        out = self._elements[outkey]
+        if isinstance(out, _Points) and all(isinstance(self._elements[k], _Points) for k in inkeys):
+            xout = out.x.reshape(-1)[index]
+            blocks = []
+            for key in inkeys:
+                x = self._elements[key]
+                kernel = self._covfun.diff(x.deriv, out.deriv)
+                blocks.append(kernel(x.x.reshape(-1)[:, None], xout[None, :]))
+            cov = _concatenate_noop(blocks, axis=0)
+            var = self._covfun.diff(out.deriv, out.deriv)(xout, xout)
+            if self._checkfinite and not (np.all(np.isfinite(cov)) and np.all(np.isfinite(var))):
+                raise RuntimeError('covariance with key {} is not finite'.format(repr(outkey)))
+        else:
+            cov = self._assemblecovblocks(inkeys, [outkey])[:, index]
+            var = np.diag(self._covblock(outkey, outkey))[index]
+        return cov, var
+    
+    def _preddiag(self, inkeys, outkeys, y, ycovblocks, fromdata, noisescale=None):
+        """
+        Compute the mean and the variance of the posterior on `outkeys`,
+        chunking over the output points. Used by `pred` with diagonal=True.
+        """
+        ycov = self._givencov(y, ycovblocks)
+        if len(np.shape(ycov)) > 2:
+            raise ValueError('covariance matrix of `given` varies along the batch axes, not supported by pred')
+        ymean = gvar.mean(y)
+        if self._checkfinite and not np.all(np.isfinite(ymean)):
+            raise ValueError('mean of `given` is not finite')
         
+        solver = self._noisesolver(inkeys, ycov, noisescale) if fromdata else self._solver(inkeys)
+        alpha = solver.solve(ymean.reshape(-1, ymean.shape[-1]).T)
+        addycov = not fromdata and not (np.isscalar(ycov) and ycov == 0)
+        
+        means = []
+        variances = []
+        for key in outkeys:
+            size = self._elements[key].size
+            for start in range(0, size, self._predchunk):
+                index = slice(start, min(start + self._predchunk, size))
+                Kxxs, var = self._crosscovchunk(inkeys, key, index)
+                invKKxxs = solver.solve(Kxxs)
+                var = var - np.sum(Kxxs * invKKxxs, axis=0)
+                if addycov:
+                    var = var + np.sum(invKKxxs * (ycov @ invKKxxs), axis=0)
+                means.append(alpha.T @ Kxxs)
+                variances.append(var)
+        
+        mean = np.concatenate(means, axis=-1).reshape(ymean.shape[:-1] + (-1,))
+        return mean, np.concatenate(variances)
+    
     def predfromfit(self, *args, **kw):
         """
         Like `pred` with `fromdata=False`.
@@ -813,7 +1775,77 @@ class GP:
         """
         return self.pred(*args, fromdata=True, **kw)
 
-    def marginal_likelihood(self, given, givencov=None):
+    def posterior(self, given, givencov=None, fromdata=None, hyperparams=None, noisescale=None):
+        """
+        
+        Compute the posterior conditioned on `given` in a compact form, a
+        `Posterior` object, which can be evaluated on new points without
+        adding them to the GP, and saved to file.
+        
+        Parameters
+        ----------
+        given, givencov, fromdata :
+            As in `pred`. The keys in `given` must have been added with
+            `addx`, and `given` can not have batch axes.
+        hyperparams : dict, optional
+            Hyperparameters used to build the kernel, saved along with the
+            posterior.
+        noisescale : scalar, optional
+            As in `pred`. Requires fromdata=True.
+        
+        Returns
+        -------
+        posterior : Posterior
+            If `given` contains `gvar`s and `noisescale` is not specified,
+            the posterior keeps them and by default `Posterior.pred` returns
+            `gvar`s correlated with them.
+        
+        """
+        if fromdata is None:
+            raise ValueError('you must specify if `given` is data or fit result')
+        if noisescale is not None and not fromdata:
+            raise ValueError('noisescale requires fromdata=True')
+        
+        ylist, inkeys, ycovblocks = self._flatgiven(given, givencov)
+        y = _concatenate_noop(ylist, axis=-1)
+        if len(y.shape) > 1:
+            raise ValueError('`given` has batch shape {}, not supported by posterior'.format(y.shape[:-1]))
+        for key in inkeys:
+            if not isinstance(self._elements[key], _Points):
+                raise ValueError('key {} is a transformation, not supported by posterior'.format(repr(key)))
+        ycov = self._givencov(y, ycovblocks)
+        ymean = gvar.mean(y)
+        if self._checkfinite and not np.all(np.isfinite(ymean)):
+            raise ValueError('mean of `given` is not finite')
+        
+        n = len(ymean)
+        if np.isscalar(ycov) and ycov == 0:
+            givenfactor = numpy.empty((n, 0))
+        else:
+            givenfactor = _linalg.psdfactor(ycov * numpy.eye(n) if np.isscalar(ycov) else ycov)
+        if fromdata:
+            solver = self._noisesolver(inkeys, ycov, noisescale)
+            negfactor = numpy.empty((n, 0))
+        else:
+            # cov = Kxsxs - Kxsx @ (K^-1 - K^-1 @ ycov @ K^-1) @ Kxxs
+            solver = self._solver(inkeys)
+            negfactor = solver.solve(givenfactor)
+        
+        # with noisescale, ycov is not the covariance of the gvars in y
+        given = y if y.dtype == object and noisescale is None else None
+        return _Posterior.Posterior(
+            self._covfun,
+            {key: self._elements[key].x for key in inkeys},
+            {key: self._elements[key].deriv for key in inkeys},
+            _linalg.noautograd(solver.solve(ymean)),
+            _linalg.invfactor(solver, n),
+            _linalg.noautograd(negfactor),
+            hyperparams,
+            given,
+            givenfactor if given is not None else None
+        )
+
+    def marginal_likelihood(self, given, givencov=None, noisescale=None, likelihood='gaussian', dispersion=None, amplitude=None):
         """
         
         Compute (the logarithm of) the marginal likelihood given data, i.e. the
@@ -828,6 +1860,15 @@ class GP:
         The input is an array or dictionary of arrays, `given`. You can pass an
         array only if the GP has only one key. The contents of `given`
         represent the input data.
+        
+        The arrays in `given` can have additional leading axes (the same for
+        all keys) to compute the marginal likelihood of many datasets at once,
+        e.g. one for each region on the same points. If the covariance
+        matrix of the data is the same for all of them, the covariance matrix
+        is decomposed only once. Otherwise, the blocks of `givencov` must
+        have the same leading axes, and the matrices are diagonalized
+        together, ignoring the `solver` of the GP. Correlations between the
+        datasets are ignored.
                 
         Parameters
         ----------
@@ -838,34 +1879,232 @@ class GP:
         givencov : array or dictionary of arrays
             Covariance matrix of `given`. If not specified, the covariance
             is extracted from `given` with `gvar.evalcov(given)`.
+        noisescale : scalar, optional
+            If specified, the covariance matrix of `given` is multiplied by
+            `noisescale`. With the solvers `auto`, `eigcut+`, `eigcut-`,
+            `gersh` and `maxeigv`, the prior covariance matrix and the covariance matrix
+            of `given` are diagonalized together once and the decomposition
+            is cached, so calling again with a different `noisescale` costs
+            O(n^2) instead of O(n^3). It can be differentiated with
+            autograd, e.g. as a hyperparameter in `empbayes_fit`.
+        amplitude : scalar or array, optional
+            If specified, the prior covariance matrix is multiplied by
+            `amplitude`, which can be an array broadcastable to the leading
+            axes of `given` to have a different amplitude for each dataset,
+            e.g. for each region. Since a K + s D = a (K + s/a D), the
+            decomposition is obtained as for `noisescale`, so with the dense
+            solvers all the datasets share a single diagonalization if the
+            covariance matrix of `given` is the same. It can be
+            differentiated with autograd.
+        likelihood : str
+            'gaussian' (default), or a likelihood for count data, 'poisson'
+            or 'negbin', see `laplace`. In the latter case `given` contains
+            the counts and the result is the Laplace approximation of the
+            marginal likelihood, which can be differentiated with autograd.
+        dispersion : scalar, optional
+            The dispersion parameter of the 'negbin' likelihood.
         
         Returns
         -------
-        marglike : scalar
-            The logarithm of the marginal likelihood.
+        marglike : scalar or array
+            The logarithm of the marginal likelihood. An array with the
+            leading axes of `given` if it has any.
             
         """        
+        if likelihood != 'gaussian':
+            if givencov is not None or noisescale is not None or amplitude is not None:
+                raise ValueError('givencov, noisescale and amplitude not supported with likelihood {}'.format(repr(likelihood)))
+            _, _, _, _, logml = self._laplace(given, likelihood, dispersion)
+            return logml
+        
         ylist, inkeys, ycovblocks = self._flatgiven(given, givencov)
-        y = _concatenate_noop(ylist)
-
-        if ycovblocks is not None:
-            ycov = _block_matrix(ycovblocks)
-            ymean = gvar.mean(y)
-        elif y.dtype == object:
-            gvary = gvar.gvar(y)
-            # TODO this gvar.gvar(y) is here because gvar.evalcov is picky and
-            # won't accept a non-gvar scalar in the array. I should modify
-            # gvar.evalcov, since gvar.mean and gvar.sdev accept non-gvars.
-            ycov = gvar.evalcov(gvary)
-            ymean = gvar.mean(gvary)
+        y = _concatenate_noop(ylist, axis=-1)
+        ycov = self._givencov(y, ycovblocks)
+        ymean = gvar.mean(y) if y.dtype == object else y
+        
+        if self._checkfinite and not np.all(np.isfinite(ymean)):
+            raise ValueError('mean of `given` is not finite')
+        
+        n = y.shape[-1]
+        if len(np.shape(ycov)) > 2:
+            Kxx = self._assemblecovblocks(inkeys)
+            if noisescale is not None:
+                ycov = noisescale * ycov
+            if amplitude is not None:
+                Kxx = np.reshape(amplitude, np.shape(amplitude) + (1, 1)) * Kxx
+            decomp = _linalg.BatchEigCutFullRank(Kxx + ycov)
+            quad = decomp.quad(ymean)
+            logdet = decomp.logdet()
+        elif amplitude is not None:
+            # a K + s D = a (K + s/a D)
+            amplitude = amplitude * np.ones(y.shape[:-1])
+            A = amplitude.reshape(-1)
+            Y = ymean.reshape(-1, n)
+            s = 1 if noisescale is None else noisescale
+            quad = []
+            logdet = []
+            for i in range(len(Y)):
+                decomp = self._noisesolver(inkeys, ycov, s / A[i])
+                quad.append(decomp.quad(Y[i]) / A[i])
+                logdet.append(decomp.logdet() + n * np.log(A[i]))
+            quad = np.reshape(np.stack(quad), y.shape[:-1])
+            logdet = np.reshape(np.stack(logdet), y.shape[:-1])
+        elif len(y.shape) > 1:
+            decomp = self._noisesolver(inkeys, ycov, noisescale)
+            Y = ymean.reshape(-1, n).T
+            quad = np.sum(Y * decomp.solve(Y), axis=0).reshape(y.shape[:-1])
+            logdet = decomp.logdet()
         else:
-            ycov = 0
-            ymean = y
+            decomp = self._noisesolver(inkeys, ycov, noisescale)
+            quad = decomp.quad(ymean)
+            logdet = decomp.logdet()
+        return -1/2 * (quad + logdet + n * np.log(2 * np.pi))
+    
+    def _laplace(self, given, likelihood, dispersion):
+        """
+        Find the mode of the latent process given the counts `given`. Return
+        the keys and the flattened mode, gradient and minus hessian of the
+        log likelihood, and the approximate log marginal likelihood.
+        """
+        ylist, inkeys, _ = self._flatgiven(given, None)
+        y = _concatenate_noop(ylist, axis=-1)
+        if len(y.shape) > 1:
+            raise ValueError('`given` has batch shape {}, not supported with likelihood {}'.format(y.shape[:-1], repr(likelihood)))
+        if y.dtype == object:
+            raise TypeError('`given` must contain counts, not gvars, with likelihood {}'.format(repr(likelihood)))
+        if not np.all(np.isfinite(y)) or np.any(y < 0):
+            raise ValueError('counts in `given` are not finite and nonnegative')
+        
+        Kxx = self._assemblecovblocks(inkeys)
+        if self._solvername in self._geneigsolvers:
+            decompclass = self._decompclass
+        else:
+            decompclass = lambda K: _linalg.EigCutFullRank(K, **self._decompkw)
+        f, grad, W, logml = _laplace.newton(Kxx, y, likelihood, dispersion, decompclass)
+        return inkeys, f, grad, W, logml
+    
+    def laplace(self, given, likelihood='poisson', dispersion=None):
+        """
+        
+        Laplace approximation of the posterior of the process given counts,
+        where the process is the logarithm of the mean of the counts. The
+        mode is found with Newton iterations, decomposing the matrices with
+        the solver of the GP (`eigcut+` if it is not a dense solver).
+        
+        The result is returned as gaussian pseudo-data for the process,
+        which gives the Laplace approximation of the posterior when passed
+        to `pred` with fromdata=True, on any keys.
         
+        Parameters
+        ----------
+        given : array or dictionary of arrays
+            The counts for some/all of the points in the GP.
+        likelihood : str
+            'poisson' (default) for y ~ Poisson(exp(f)), or 'negbin' for a
+            negative binomial with mean mu = exp(f) and variance
+            mu + mu^2 / dispersion.
+        dispersion : scalar, optional
+            The dispersion parameter of the 'negbin' likelihood.
+        
+        Returns
+        -------
+        pseudodata : array or dictionary of arrays
+            `gvar`s with the same format of `given`, with mean f + grad / W
+            and standard deviation 1 / sqrt(W), where f is the mode, and grad
+            and W the gradient and minus the hessian of the log likelihood at
+            the mode.
+        
+        """
+        inkeys, f, grad, W, _ = self._laplace(given, likelihood, dispersion)
+        flat = gvar.gvar(f + grad / W, 1 / np.sqrt(W))
+        if _isarraylike_nostructured(given):
+            return flat.reshape(self._elements[inkeys[0]].shape)
+        return gvar.BufferDict({
+            key: flat[slic].reshape(self._elements[key].shape)
+            for key, slic in zip(inkeys, self._slices(inkeys))
+        })
+    
+    def crossval(self, given, givencov=None, folds=None, noisescale=None):
+        """
+        
+        Cross validation of the model on data, computed in closed form from
+        a single decomposition of the covariance matrix of the data. Each
+        fold of points is predicted conditioning on all the other points.
+        
+        Parameters
+        ----------
+        given, givencov, noisescale :
+            The data, as in `marginal_likelihood`. `given` can not have batch
+            axes.
+        folds : None, int or list of arrays of indices
+            If None (default), leave-one-out. If an int k, split the points
+            in k contiguous blocks. If a list, each element is an array of
+            indices of the points in the fold, where the points are numbered
+            by flattening the arrays in `given` and concatenating them in
+            order. E.g. [numpy.arange(n - k, n)] to hold out the last k
+            points only. The folds must not overlap.
+        
+        Returns
+        -------
+        mean : array or dictionary of arrays
+            The predictive mean of each point conditioned on the points not
+            in its fold, in the same format of `given`. nan for points not in
+            any fold.
+        var : array or dictionary of arrays
+            The predictive variances, including the variance of the data.
+        logp : 1D array
+            The logarithm of the joint predictive density of each fold. The
+            sum can be used to compare models like `marginal_likelihood`.
+        
+        """
+        ylist, inkeys, ycovblocks = self._flatgiven(given, givencov)
+        y = _concatenate_noop(ylist, axis=-1)
+        if len(y.shape) > 1:
+            raise ValueError('`given` has batch shape {}, not supported by crossval'.format(y.shape[:-1]))
+        ycov = self._givencov(y, ycovblocks)
+        ymean = gvar.mean(y) if y.dtype == object else y
         if self._checkfinite and not np.all(np.isfinite(ymean)):
             raise ValueError('mean of `given` is not finite')
-        if self._checkfinite and not np.all(np.isfinite(ycov)):
-            raise ValueError('covariance matrix of `given` is not finite')
         
-        decomp = self._solver(inkeys, ycov)
-        return -1/2 * (decomp.quad(ymean) + decomp.logdet() + len(y) * np.log(2 * np.pi))
+        n = len(ymean)
+        if folds is None:
+            folds = [[i] for i in range(n)]
+        elif isinstance(folds, (int, np.integer)):
+            if not 1 <= folds <= n:
+                raise ValueError('number of folds {} not in [1, {}]'.format(folds, n))
+            folds = numpy.array_split(numpy.arange(n), folds)
+        folds = [numpy.asarray(fold, int).reshape(-1) for fold in folds]
+        count = numpy.zeros(n, int)
+        for fold in folds:
+            numpy.add.at(count, fold, 1)
+        if numpy.any(count > 1):
+            raise ValueError('the folds overlap')
+        
+        # For the fold I, mean = y_I - inv(B) alpha_I and cov = inv(B), where
+        # alpha = inv(K) y and B = inv(K)_II
+        solver = self._noisesolver(inkeys, ycov, noisescale)
+        invK = _linalg.noautograd(solver.solve(numpy.eye(n)))
+        alpha = invK @ ymean
+        mean = numpy.full(n, numpy.nan)
+        var = numpy.full(n, numpy.nan)
+        logp = numpy.empty(len(folds))
+        for i, fold in enumerate(folds):
+            B = invK[numpy.ix_(fold, fold)]
+            cov = numpy.linalg.inv(B)
+            invBalpha = cov @ alpha[fold]
+            mean[fold] = ymean[fold] - invBalpha
+            var[fold] = numpy.diag(cov)
+            _, logdetB = numpy.linalg.slogdet(B)
+            logp[i] = -1/2 * (alpha[fold] @ invBalpha - logdetB + len(fold) * np.log(2 * np.pi))
+        
+        if _isarraylike_nostructured(given):
+            shape = self._elements[inkeys[0]].shape
+            return mean.reshape(shape), var.reshape(shape), logp
+        meandict, vardict = [
+            {
+                key: a[slic].reshape(self._elements[key].shape)
+                for key, slic in zip(inkeys, self._slices(inkeys))
+            }
+            for a in (mean, var)
+        ]
+        return meandict, vardict, logp
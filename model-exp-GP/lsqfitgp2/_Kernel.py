@@ -1,6 +1,11 @@
 from __future__ import division
 
 import sys
+import math
+import contextlib
+import contextvars
+import collections
+import hashlib
 
 import autograd
 from autograd import numpy as np
@@ -14,7 +19,8 @@ __all__ = [
     'IsotropicKernel',
     'kernel',
     'isotropickernel',
-    'where'
+    'where',
+    'DistanceCache'
 ]
 
 def _asarray(x):
@@ -61,6 +67,31 @@ def _prod_recurse_dtype(fun, *args):
     times = lambda a, b: a * b
     return _reduce_recurse_dtype(fun, *args, reductor=times, npreductor=np.prod)
 
+def _selectdim(x, dim):
+    """
+    Select field `dim` of `x`, keeping it as a field if it has a shape.
+    """
+    if dim is None:
+        return x
+    elif x.dtype.names is None:
+        raise ValueError('kernel called on non-structured array but dim="{}"'.format(dim))
+    elif x.dtype.fields[dim][0].shape:
+        return x[[dim]]
+    else:
+        return x[dim]
+
+def _sqdist(x, y):
+    """
+    Squared euclidean distance between x and y, summed over all fields. If a
+    DistanceCache is in use, the distance is looked up by the contents of `x`
+    and `y`.
+    """
+    compute = lambda: _sum_recurse_dtype(lambda x, y: (x - y) ** 2, x, y)
+    cache = _distcache.get()
+    if cache is not None and type(x) is np.ndarray and type(y) is np.ndarray:
+        return cache._get(x, y, compute)
+    return compute()
+
 def _transf_recurse_dtype(transf, x):
     if x.dtype.names is None:
         return transf(x)
@@ -70,6 +101,84 @@ def _transf_recurse_dtype(transf, x):
             x[name] = _transf_recurse_dtype(transf, x[name])
         return x
 
+class DistanceCache:
+    """
+    
+    Cache of the squared distances between points computed by isotropic
+    kernels. The distances do not depend on the `scale` of the kernels, so
+    when many `GP` objects are built on the same points with different
+    hyperparameters, e.g. in the `gpfactory` function of `empbayes_fit`, they
+    can share a cache to avoid computing the distances again. Pass the cache
+    to `GP` with the `distcache` argument.
+    
+    The distances are identified by the contents of the arrays the
+    isotropic kernels are actually called on, so they are computed again if
+    the points change or if a kernel transforms its input. Derivatives and
+    points which depend on hyperparameters (through `autograd`) are not
+    cached.
+    
+    Parameters
+    ----------
+    maxsize : int
+        The maximum number of distance matrices kept in memory (default 16).
+        The least recently used is discarded first.
+    
+    Attributes
+    ----------
+    hits, misses : int
+        The number of times the distances were found in the cache or computed.
+    
+    """
+    
+    def __init__(self, maxsize=16):
+        self._maxsize = int(maxsize)
+        if self._maxsize < 1:
+            raise ValueError('maxsize = {} < 1'.format(maxsize))
+        self._cache = collections.OrderedDict() # (xid, yid) -> squared distance
+        self.hits = 0
+        self.misses = 0
+    
+    def clear(self):
+        """
+        Empty the cache.
+        """
+        self._cache.clear()
+    
+    @staticmethod
+    def _fingerprint(x):
+        x = np.ascontiguousarray(x)
+        return x.shape, str(x.dtype), hashlib.sha1(x.view(np.uint8)).hexdigest()
+    
+    @contextlib.contextmanager
+    def _use(self):
+        """
+        Context in which isotropic kernels use the cache. Contexts can be
+        nested and are local to the thread.
+        """
+        token = _distcache.set(self)
+        try:
+            yield
+        finally:
+            _distcache.reset(token)
+    
+    def _get(self, x, y, compute):
+        key = (self._fingerprint(x), self._fingerprint(y))
+        q = self._cache.get(key, None)
+        if q is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return q
+        q = compute()
+        q.flags['WRITEABLE'] = False
+        self._cache[key] = q
+        while len(self._cache) > self._maxsize:
+            self._cache.popitem(last=False)
+        self.misses += 1
+        return q
+
+# The DistanceCache in use while the GP computes a covariance block.
+_distcache = contextvars.ContextVar('distcache', default=None)
+
 class _KernelBase:
     """
     
@@ -96,7 +205,7 @@ class _KernelBase:
     
     """
     
-    def __init__(self, kernel, *, dim=None, loc=None, scale=None, forcebroadcast=False, forcekron=False, derivable=False, **kw):
+    def __init__(self, kernel, *, dim=None, loc=None, scale=None, forcebroadcast=False, forcekron=False, derivable=False, statespace=None, derivs=None, stationary=False, **kw):
         """
         
         Initialize the object with callable `kernel`.
@@ -128,6 +237,21 @@ class _KernelBase:
             error checking purposes. Default is False. True means infinitely
             many times derivable. If callable, it is called with the same
             keyword arguments of `kernel`.
+        statespace : None, int or callable
+            If the kernel is a Matérn kernel with nu = p + 1/2, the integer p.
+            It is used by the state space solver of `GP`. If callable, it is
+            called with the same keyword arguments of `kernel`.
+        derivs : None or dict
+            Closed form derivatives of `kernel`, used by `diff` in place of
+            `autograd` when deriving along a single scalar variable. A
+            dictionary mapping (xorder, yorder) to a function with the same
+            signature of `kernel` which computes the derivative of `kernel`
+            of order xorder w.r.t. `x` and yorder w.r.t. `y`.
+        stationary : bool
+            If True, the kernel depends only on x - y. It is used by the
+            Toeplitz solver of `GP`. Default False. Isotropic kernels are
+            always stationary, sums and products of stationary kernels are
+            stationary.
         **kw :
             Other keyword arguments are passed to `kernel`: kernel(x, y, **kw).
         
@@ -159,16 +283,38 @@ class _KernelBase:
             derivable = 0
         self._derivable = (derivable, derivable)
         
+        # Convert statespace to an integer or None.
+        if callable(statespace):
+            statespace = statespace(**kw)
+        assert statespace is None or isinstance(statespace, (int, np.integer)) and statespace >= 0
+        self._ssorder = statespace
+        
+        self._stationary = bool(stationary)
+        
+        # Representation of the kernel as a sum of Matérn kernels, used by the
+        # state space solver: a list of tuples (variance, p, scale) where
+        # nu = p + 1/2. None if the kernel can't be represented in this way.
+        self._ssterms = None
+        
+        # Support of the kernel, used by the sparse solver: a tuple (radius,
+        # dim) meaning that the kernel is zero when the euclidean distance
+        # between x[dim] and y[dim] (x and y if dim is None) is larger than
+        # radius. None if the kernel has not finite support.
+        self._support = None
+        
+        # Closed form derivatives, see _closedderiv: a dictionary mapping a
+        # field (None for non-structured input) to a dictionary mapping
+        # (xorder, yorder) to a function of x, y computing the derivative of
+        # the kernel w.r.t. that field.
+        self._derivs = {}
+        
+        # Memoization of `diff`.
+        self._diffcache = {}
+        
         transf = lambda x: x
         
         if isinstance(dim, str):
-            def transf(x):
-                if x.dtype.names is None:
-                    raise ValueError('kernel called on non-structured array but dim="{}"'.format(dim))
-                elif x.dtype.fields[dim][0].shape:
-                    return x[[dim]]
-                else:
-                    return x[dim]
+            transf = lambda x: _selectdim(x, dim)
         
         if loc is not None:
             assert np.isscalar(loc)
@@ -196,6 +342,18 @@ class _KernelBase:
             _kernel = lambda x, y: kernel(transf(x), transf(y), **kw)
         
         self._kernel = _kernel
+        
+        if derivs is not None:
+            factor = 1 if scale is None else scale
+            self._derivs[dim] = {
+                orders: _scalederiv(lambda x, y, f=f: f(transf(x), transf(y), **kw), factor ** -sum(orders))
+                for orders, f in derivs.items()
+            }
+        
+        # Factorization of the kernel as a product of kernels each acting on
+        # a single field, used by the kronecker solver. None if the kernel is
+        # not known to be separable.
+        self._kronfactors = {dim: self} if isinstance(dim, str) else None
     
     def __call__(self, x, y):
         x = _asarray(x)
@@ -214,8 +372,12 @@ class _KernelBase:
         """
         
         Return a Kernel-like object that computes the derivatives of this
-        kernel. The derivatives are computed automatically with `autograd`. If
-        `xderiv` and `yderiv` are trivial, this is a no-op.
+        kernel. When deriving along a single scalar variable, the closed form
+        derivatives of the kernel (see the `derivs` option) of the highest
+        available order are used, and the remaining orders, if any, are
+        computed with `autograd` on top of them. Otherwise the derivatives
+        are computed with `autograd`. The result is memoized. If `xderiv` and
+        `yderiv` are trivial, this is a no-op.
         
         Parameters
         ----------
@@ -238,7 +400,10 @@ class _KernelBase:
         if any(orders[i] > self._derivable[i] for i in range(2)):
             raise RuntimeError('derivative orders {} greater than kernel maximum {}'.format(orders, self._derivable))
         
-        kernel = self._kernel
+        key = (xderiv, yderiv)
+        if key in self._diffcache:
+            return self._diffcache[key]
+        
         def fun(x, y):
             # Check derivatives are ok for x and y.
             if x.dtype.names is not None:
@@ -251,59 +416,201 @@ class _KernelBase:
             elif not xderiv.implicit or not yderiv.implicit:
                 raise ValueError('explicit derivatives with non-structured array')
             
+            # Start from the highest closed form derivative available.
+            kernel, xd, yd = self._closedderiv(x, xderiv, yderiv)
+            
             # Handle the non-structured case.
             if x.dtype.names is None:
                 f = kernel
-                for _ in range(xderiv.order):
+                for _ in range(xd.order):
                     f = autograd.elementwise_grad(f, 0)
-                for _ in range(yderiv.order):
+                for _ in range(yd.order):
                     f = autograd.elementwise_grad(f, 1)
-                if xderiv:
+                if xd:
                     x = _asfloat(x)
-                if yderiv:
+                if yd:
                     y = _asfloat(y)
                 return f(x, y)
                 
             # Autograd-friendly wrap of structured arrays.
-            if xderiv:
+            if xd:
                 x = _array.StructuredArray(x)
-            if yderiv:
+            if yd:
                 y = _array.StructuredArray(y)
             
             # Wrap of kernel with derivable arguments only.
             def f(*args):
                 i = -1
-                for i, dim in enumerate(xderiv):
+                for i, dim in enumerate(xd):
                     x[dim] = args[i]
-                for j, dim in enumerate(yderiv):
+                for j, dim in enumerate(yd):
                     y[dim] = args[1 + i + j]
                 return kernel(x, y)
             
             # Make derivatives.
             i = -1
-            for i, dim in enumerate(xderiv):
-                for _ in range(xderiv[dim]):
+            for i, dim in enumerate(xd):
+                for _ in range(xd[dim]):
                     f = autograd.elementwise_grad(f, i)
-            for j, dim in enumerate(yderiv):
-                for _ in range(yderiv[dim]):
+            for j, dim in enumerate(yd):
+                for _ in range(yd[dim]):
                     f = autograd.elementwise_grad(f, 1 + i + j)
             
             # Make argument list and call function.
             args = []
-            for dim in xderiv:
+            for dim in xd:
                 args.append(_asfloat(x[dim]))
-            for dim in yderiv:
+            for dim in yd:
                 args.append(_asfloat(y[dim]))
             return f(*args)
         
         cls = Kernel if xderiv == yderiv else _KernelDeriv
         obj = cls(fun, forcebroadcast=True)
         obj._derivable = tuple(self._derivable[i] - orders[i] for i in range(2))
+        self._diffcache[key] = obj
         return obj
-
+    
+    def _closedderiv(self, x, xderiv, yderiv):
+        """
+        Find the closed form derivative of the highest order not exceeding
+        `xderiv`, `yderiv` for input like `x`. Return the function and the
+        derivatives which remain to be computed.
+        """
+        nothing = (self._kernel, xderiv, yderiv)
+        dims = set(xderiv) | set(yderiv)
+        if len(dims) != 1:
+            return nothing
+        dim, = dims
+        if x.dtype.names is not None and (dim is None or x.dtype.fields[dim][0].shape):
+            return nothing
+        table = self._derivs.get(dim, None)
+        if not table:
+            return nothing
+        a, b = xderiv.order, yderiv.order
+        orders = [(i, j) for i, j in table if i <= a and j <= b]
+        if not orders:
+            return nothing
+        i, j = max(orders, key=sum)
+        if dim is None:
+            return table[i, j], _Deriv.Deriv(a - i), _Deriv.Deriv(b - j)
+        else:
+            return table[i, j], _Deriv.Deriv([a - i, dim]), _Deriv.Deriv([b - j, dim])
+    
 class _KernelDeriv(_KernelBase):
     pass
-    
+
+def _opadd(k, q):
+    return lambda x, y: k(x, y) + q(x, y)
+
+def _opmul(k, q):
+    return lambda x, y: k(x, y) * q(x, y)
+
+def _oppow(k, q):
+    return lambda x, y: k(x, y) ** q(x, y)
+
+def _scalederiv(f, factor):
+    if factor == 1:
+        return f
+    return lambda x, y: factor * f(x, y)
+
+def _derivtable(kernel, dim):
+    """
+    Closed form derivatives of `kernel` w.r.t. field `dim`, see
+    _KernelBase._derivs. Return 0 if the kernel does not depend on `dim`,
+    None if the derivatives are not available.
+    """
+    if dim in kernel._derivs:
+        return kernel._derivs[dim]
+    factors = kernel._kronfactors
+    if dim is not None and factors is not None and dim not in factors:
+        return 0
+    return None
+
+def _derivsadd(k, q):
+    """
+    Closed form derivatives of k + q, see _KernelBase._derivs.
+    """
+    out = {}
+    for dim in set(k._derivs) | set(q._derivs):
+        t1 = _derivtable(k, dim)
+        t2 = _derivtable(q, dim)
+        if t1 is None or t2 is None:
+            continue
+        if t2 == 0:
+            out[dim] = t1
+        elif t1 == 0:
+            out[dim] = t2
+        else:
+            out[dim] = {
+                orders: (lambda f1, f2: lambda x, y: f1(x, y) + f2(x, y))(t1[orders], t2[orders])
+                for orders in set(t1) & set(t2)
+            }
+    return out
+
+def _derivsmul(k, q):
+    """
+    Closed form derivatives of k * q, see _KernelBase._derivs. The
+    derivatives of the product are computed with the Leibniz rule, so all the
+    lower orders of both factors must be available.
+    """
+    def lookup(kernel, table, i, j):
+        if (i, j) == (0, 0):
+            return kernel._kernel
+        return table.get((i, j), None)
+    
+    def leibniz(a, b, t1, t2):
+        terms = []
+        for i in range(a + 1):
+            for j in range(b + 1):
+                # a factor which does not depend on the field (table 0) has
+                # zero derivatives
+                if t1 == 0 and (i, j) != (0, 0) or t2 == 0 and (a - i, b - j) != (0, 0):
+                    continue
+                f1 = lookup(k, t1, i, j)
+                f2 = lookup(q, t2, a - i, b - j)
+                if f1 is None or f2 is None:
+                    return None
+                c = math.comb(a, i) * math.comb(b, j)
+                terms.append((c, f1, f2))
+        return lambda x, y: sum(c * f1(x, y) * f2(x, y) for c, f1, f2 in terms)
+    
+    out = {}
+    for dim in set(k._derivs) | set(q._derivs):
+        t1 = _derivtable(k, dim)
+        t2 = _derivtable(q, dim)
+        if t1 is None or t2 is None:
+            continue
+        orders = set(t1 or {}) | set(t2 or {})
+        table = {}
+        for a, b in orders:
+            f = leibniz(a, b, t1, t2)
+            if f is not None:
+                table[a, b] = f
+        out[dim] = table
+    return out
+
+def _kronmul(kernel, value):
+    """
+    Compute the separable factors of kernel * value, see
+    _KernelBase._kronfactors.
+    """
+    factors = kernel._kronfactors
+    if factors is None:
+        return None
+    factors = dict(factors)
+    if isinstance(value, Kernel):
+        if value._kronfactors is None:
+            return None
+        for dim, factor in value._kronfactors.items():
+            if dim in factors:
+                factors[dim] = factors[dim]._binary(factor, _opmul)
+            else:
+                factors[dim] = factor
+    else:
+        dim = next(iter(factors))
+        factors[dim] = factors[dim]._binary(value, _opmul)
+    return factors
+
 class Kernel(_KernelBase):
     
     @property
@@ -327,18 +634,67 @@ class Kernel(_KernelBase):
         return obj
     
     def __add__(self, value):
-        return self._binary(value, lambda k, q: lambda x, y: k(x, y) + q(x, y))
+        obj = self._binary(value, _opadd)
+        if isinstance(obj, Kernel):
+            if isinstance(value, Kernel):
+                obj._derivs = _derivsadd(self, value)
+                obj._stationary = self._stationary and value._stationary
+            else:
+                obj._derivs = self._derivs
+                obj._stationary = self._stationary
+            if isinstance(value, Kernel) and self._ssterms is not None and value._ssterms is not None:
+                obj._ssterms = self._ssterms + value._ssterms
+            if isinstance(value, Kernel) and self._support is not None and value._support is not None:
+                (r1, dim1), (r2, dim2) = self._support, value._support
+                if dim1 == dim2:
+                    obj._support = (max(r1, r2), dim1)
+        return obj
     
     __radd__ = __add__
     
     def __mul__(self, value):
-        return self._binary(value, lambda k, q: lambda x, y: k(x, y) * q(x, y))
+        obj = self._binary(value, _opmul)
+        if isinstance(obj, Kernel):
+            if isinstance(value, Kernel):
+                obj._derivs = _derivsmul(self, value)
+                obj._stationary = self._stationary and value._stationary
+            else:
+                obj._derivs = {
+                    dim: {
+                        orders: _scalederiv(f, value)
+                        for orders, f in table.items()
+                    }
+                    for dim, table in self._derivs.items()
+                }
+                obj._stationary = self._stationary
+            obj._kronfactors = _kronmul(self, value)
+            if not isinstance(value, Kernel) and self._ssterms is not None:
+                obj._ssterms = [
+                    (value * var, p, scale)
+                    for var, p, scale in self._ssterms
+                ]
+            supports = [self._support]
+            if isinstance(value, Kernel):
+                supports.append(value._support)
+            supports = [s for s in supports if s is not None]
+            if supports:
+                obj._support = min(supports, key=lambda s: s[0])
+        return obj
     
     __rmul__ = __mul__
     
     def __pow__(self, value):
         if np.isscalar(value):
-            return self._binary(value, lambda k, q: lambda x, y: k(x, y) ** q(x, y))
+            obj = self._binary(value, _oppow)
+            obj._stationary = self._stationary
+            if self._kronfactors is not None:
+                obj._kronfactors = {
+                    dim: factor._binary(value, _oppow)
+                    for dim, factor in self._kronfactors.items()
+                }
+            if value > 0:
+                obj._support = self._support
+            return obj
         else:
             return NotImplemented
     
@@ -354,7 +710,7 @@ class IsotropicKernel(Kernel):
     # TODO add the `distance` parameter to supply an arbitrary distance, maybe
     # allow string keywords for premade distances, like euclidean, hamming.
     
-    def __init__(self, kernel, *, input='squared', scale=None, **kw):
+    def __init__(self, kernel, *, input='squared', scale=None, support=None, derivs=None, **kw):
         """
         
         Parameters
@@ -366,6 +722,13 @@ class IsotropicKernel(Kernel):
             See "input options" below.
         scale : scalar
             The distance is divided by `scale`.
+        support : None or scalar
+            If the kernel is zero for distances (divided by `scale`) larger
+            than `support`, this value. It is used by the sparse solver of
+            `GP`.
+        derivs : None or dict
+            Closed form derivatives of the kernel as a function of x and y
+            (not of the distance), with `scale` = 1. See `Kernel.__init__`.
         **kw :
             Other keyword arguments are passed to the `Kernel` init.
         
@@ -388,7 +751,7 @@ class IsotropicKernel(Kernel):
             assert scale > 0
         
         def function(x, y, **kwargs):
-            q = _sum_recurse_dtype(lambda x, y: (x - y) ** 2, x, y)
+            q = _sqdist(x, y)
             if scale is not None:
                 q = q / scale ** 2
             if input == 'soft':
@@ -399,11 +762,25 @@ class IsotropicKernel(Kernel):
                 q = np.sqrt(q + eps ** 2)
             return kernel(q, **kwargs)
         
-        super().__init__(function, **kw)
+        if derivs is not None and scale is not None:
+            derivs = {
+                orders: (lambda f, n: lambda x, y, **kw: f(x / scale, y / scale, **kw) / scale ** n)(f, sum(orders))
+                for orders, f in derivs.items()
+            }
+        
+        super().__init__(function, derivs=derivs, **kw)
+        self._stationary = True
+        
+        if self._ssorder is not None and kw.get('dim', None) is None:
+            self._ssterms = [(1, self._ssorder, 1 if scale is None else scale)]
+        
+        if support is not None:
+            assert np.isscalar(support) and support > 0
+            self._support = (support * (1 if scale is None else scale), kw.get('dim', None))
     
     def _binary(self, value, op):
         obj = super()._binary(value, op)
-        if isinstance(obj, Kernel) and isinstance(value, __class__):
+        if isinstance(obj, Kernel) and (isinstance(value, __class__) or np.isscalar(value)):
             obj.__class__ = __class__
         return obj
     
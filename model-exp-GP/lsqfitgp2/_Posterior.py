@@ -0,0 +1,293 @@
+from __future__ import division
+
+import gvar
+import numpy
+
+from . import _Kernel
+from . import _Deriv
+from . import _array
+from . import _GP
+
+__all__ = [
+    'Posterior'
+]
+
+def _tonumpy(x):
+    """
+    Convert a StructuredArray back to a numpy structured array.
+    """
+    if isinstance(x, _array.StructuredArray):
+        out = numpy.empty(x.shape, x.dtype)
+        for name in x.dtype.names:
+            out[name] = _tonumpy(x[name])
+        return out
+    else:
+        return numpy.asarray(x)
+
+def _derivtoarrays(deriv):
+    """
+    Convert a Deriv to an array of variable names ('' for the implicit
+    variable) and an array of orders.
+    """
+    names = ['' if dim is None else dim for dim in deriv]
+    orders = [deriv[dim] for dim in deriv]
+    return numpy.array(names, dtype=str), numpy.array(orders, dtype=int)
+
+def _derivfromarrays(names, orders):
+    if len(names) == 1 and names[0] == '':
+        return _Deriv.Deriv(int(orders[0]))
+    spec = []
+    for name, order in zip(names, orders):
+        spec += [int(order), str(name)]
+    return _Deriv.Deriv(spec)
+
+class Posterior:
+    """
+    
+    The posterior of a gaussian process conditioned on data or on a fit
+    result, in a compact form that does not need the GP object. It can be
+    evaluated at any new points and saved to and loaded from a single `.npz`
+    file. Build it with `GP.pred(..., predictor=True)`, `GP.posterior` or
+    `Posterior.load`.
+    
+    The posterior is stored as the points of the given keys, alpha = K^-1 y,
+    where K is the prior covariance matrix of the given points (plus the
+    data covariance if conditioning on data), and factors of the matrix
+    which gives the posterior covariance as Kss - Ksx @ M @ Kxs. If built
+    from a GP, it also keeps the `gvar`s it was conditioned on, to correlate
+    the posterior with them; these are not saved to file.
+    
+    Attributes
+    ----------
+    kernel : Kernel
+        The covariance kernel.
+    hyperparams : dict
+        The hyperparameters used to build the kernel, saved along with the
+        posterior. Empty if not specified.
+    
+    Methods
+    -------
+    pred :
+        Compute the posterior on new points.
+    save :
+        Save the posterior to file.
+    load :
+        Load a posterior from file (class method).
+    
+    """
+    
+    def __init__(self, kernel, x, deriv, alpha, posfactor, negfactor, hyperparams=None, given=None, givenfactor=None):
+        """
+        
+        Parameters
+        ----------
+        kernel : Kernel
+            The covariance kernel.
+        x : dict
+            The arrays of given points, indexed by key.
+        deriv : dict
+            The `Deriv` objects of the given points, indexed by key.
+        alpha : 1D array
+            K^-1 y, with the keys concatenated in the order of `x`.
+        posfactor, negfactor : 2D arrays
+            The matrix M of the posterior covariance is posfactor @
+            posfactor.T - negfactor @ negfactor.T.
+        hyperparams : dict, optional
+            The hyperparameters of the kernel.
+        given : 1D array of gvars, optional
+            The `gvar`s the posterior is conditioned on, concatenated like
+            `alpha`. Required to correlate the posterior with them.
+        givenfactor : 2D array, optional
+            A matrix W such that W @ W.T is the covariance matrix of `given`
+            used to compute the posterior. Required with `given`.
+        
+        """
+        if not isinstance(kernel, _Kernel.Kernel):
+            raise TypeError('covariance function must be of class Kernel')
+        self.kernel = kernel
+        self._x = dict(x)
+        self._deriv = {key: _Deriv.Deriv(deriv[key]) for key in self._x}
+        self._alpha = alpha
+        self._posfactor = posfactor
+        self._negfactor = negfactor
+        self.hyperparams = dict(hyperparams) if hyperparams is not None else dict()
+        n = sum(x.size for x in self._x.values())
+        if alpha.shape != (n,) or len(posfactor) != n or len(negfactor) != n:
+            raise ValueError('alpha or factors shapes {}, {}, {} do not match {} points'.format(alpha.shape, posfactor.shape, negfactor.shape, n))
+        if (given is None) != (givenfactor is None):
+            raise ValueError('given and givenfactor must be specified together')
+        if given is not None and (given.shape != (n,) or len(givenfactor) != n):
+            raise ValueError('given or givenfactor shapes {}, {} do not match {} points'.format(given.shape, givenfactor.shape, n))
+        self._given = given
+        self._givenfactor = givenfactor
+    
+    def _crosscov(self, x, deriv):
+        blocks = []
+        for key, xkey in self._x.items():
+            kernel = self.kernel.diff(self._deriv[key], deriv)
+            blocks.append(kernel(xkey.reshape(-1)[:, None], x[None, :]))
+        return numpy.concatenate(blocks, axis=0)
+    
+    _predchunk = 256 # number of points processed at once with diagonal=True
+    
+    def _predchunk_diag(self, x, deriv):
+        Kxxs = self._crosscov(x, deriv)
+        var = self.kernel.diff(deriv, deriv)(x, x)
+        pos = self._posfactor.T @ Kxxs
+        neg = self._negfactor.T @ Kxxs
+        var = var - numpy.sum(pos ** 2, axis=0) + numpy.sum(neg ** 2, axis=0)
+        return self._alpha @ Kxxs, var
+    
+    def pred(self, x, deriv=0, raw=False, keepcorr=None, diagonal=False):
+        """
+        
+        Compute the posterior on the points `x`. Only the covariance between
+        `x` and the given points and the covariance of `x` are computed.
+        
+        Parameters
+        ----------
+        x : array
+            The points where the posterior is computed.
+        deriv :
+            Derivative specification, as in `GP.addx`.
+        raw : bool (default False)
+            If True, return mean and covariance instead of `gvar`s.
+        keepcorr : bool
+            If True, the returned `gvar`s are correlated with the `gvar`s
+            the posterior was conditioned on, e.g. the parameters of a fit.
+            If False, they are new primary `gvar`s. Default True if the
+            posterior keeps the conditioning `gvar`s (see `GP.posterior`)
+            and raw=False and diagonal=False, otherwise False.
+        diagonal : bool (default False)
+            If True, compute only the variances. The points are processed
+            in chunks, so the memory used does not grow with the square of
+            the number of points. With raw=False the returned `gvar`s are
+            independent.
+        
+        Returns
+        -------
+        If raw=False (default):
+        
+        posterior : array
+            An array of `gvar`s with the shape of `x`.
+        
+        If raw=True:
+        
+        pmean : array
+            The mean of the posterior, with the shape of `x`.
+        pcov : array
+            The covariance matrix, with shape x.shape + x.shape. If
+            diagonal=True, the variances, with the shape of `x`.
+        
+        """
+        if keepcorr is None:
+            keepcorr = self._given is not None and not raw and not diagonal
+        if keepcorr and (raw or diagonal):
+            raise ValueError('keepcorr=True with raw=True or diagonal=True')
+        if keepcorr and self._given is None:
+            raise ValueError('keepcorr=True but the posterior does not keep the gvars it was conditioned on')
+        
+        deriv = _Deriv.Deriv(deriv)
+        x = _GP._asarray(x)
+        shape = x.shape
+        x = x.reshape(-1)
+        
+        if diagonal:
+            chunks = [
+                self._predchunk_diag(x[start:start + self._predchunk], deriv)
+                for start in range(0, len(x), self._predchunk)
+            ]
+            mean = numpy.concatenate([m for m, _ in chunks])
+            var = numpy.concatenate([v for _, v in chunks])
+            if raw:
+                return mean.reshape(shape), var.reshape(shape)
+            else:
+                return gvar.gvar(mean, numpy.sqrt(var)).reshape(shape)
+        
+        Kxxs = self._crosscov(x, deriv)
+        Kxsxs = self.kernel.diff(deriv, deriv)(x[:, None], x[None, :])
+        pos = self._posfactor.T @ Kxxs
+        neg = self._negfactor.T @ Kxxs
+        mean = self._alpha @ Kxxs
+        cov = Kxsxs - pos.T @ pos + neg.T @ neg
+        if raw:
+            return mean.reshape(shape), cov.reshape(2 * shape)
+        elif not keepcorr:
+            return gvar.gvar(mean, cov).reshape(shape)
+        
+        # The posterior is A @ given plus an independent part, where
+        # A = Ksx @ posfactor @ posfactor.T, so the independent part has
+        # covariance cov - A @ givencov @ A.T.
+        AT = self._posfactor @ pos
+        corr = self._givenfactor.T @ AT
+        _, jac, primary, gcov = _GP._gvarjac(self._given)
+        out = gvar.gvar(mean, cov - corr.T @ corr)
+        if gcov is not None:
+            out = out + _GP._gvarfromjac(numpy.zeros(len(mean)), AT.T @ jac, primary, gcov)
+        return out.reshape(shape)
+    
+    def save(self, file):
+        """
+        
+        Save the posterior to `file` (a path or a file object) in numpy's
+        `.npz` format, without pickling. The keys of the given points and
+        the names of the hyperparameters must be strings. The kernel and the
+        `gvar`s the posterior was conditioned on are not saved, the former
+        must be provided again to `load`.
+        
+        """
+        arrays = dict(
+            alpha=self._alpha,
+            posfactor=self._posfactor,
+            negfactor=self._negfactor,
+        )
+        keys = list(self._x)
+        if not all(isinstance(key, str) for key in keys):
+            raise ValueError('keys {} are not all strings, can not save'.format(keys))
+        arrays['keys'] = numpy.array(keys, dtype=str)
+        for i, key in enumerate(keys):
+            arrays['x{}'.format(i)] = _tonumpy(self._x[key])
+            names, orders = _derivtoarrays(self._deriv[key])
+            arrays['derivnames{}'.format(i)] = names
+            arrays['derivorders{}'.format(i)] = orders
+        hpnames = list(self.hyperparams)
+        if not all(isinstance(name, str) for name in hpnames):
+            raise ValueError('hyperparameter names {} are not all strings, can not save'.format(hpnames))
+        arrays['hpnames'] = numpy.array(hpnames, dtype=str)
+        for i, name in enumerate(hpnames):
+            arrays['hp{}'.format(i)] = numpy.asarray(gvar.mean(self.hyperparams[name]))
+        numpy.savez(file, **arrays)
+    
+    @classmethod
+    def load(cls, file, kernel):
+        """
+        
+        Load a posterior saved with `save`.
+        
+        Parameters
+        ----------
+        file : path or file object
+            The `.npz` file.
+        kernel : Kernel or callable
+            The covariance kernel, or a function which takes the dictionary
+            of saved hyperparameters and returns the kernel.
+        
+        Returns
+        -------
+        posterior : Posterior
+        
+        """
+        with numpy.load(file, allow_pickle=False) as arrays:
+            hyperparams = {
+                str(name): arrays['hp{}'.format(i)][()]
+                for i, name in enumerate(arrays['hpnames'])
+            }
+            if not isinstance(kernel, _Kernel.Kernel):
+                kernel = kernel(hyperparams)
+            x = dict()
+            deriv = dict()
+            for i, key in enumerate(arrays['keys']):
+                key = str(key)
+                x[key] = _array._wrapifstructured(arrays['x{}'.format(i)])
+                deriv[key] = _derivfromarrays(arrays['derivnames{}'.format(i)], arrays['derivorders{}'.format(i)])
+            return cls(kernel, x, deriv, arrays['alpha'], arrays['posfactor'], arrays['negfactor'], hyperparams)
@@ -4,6 +4,7 @@ from ._kernels import *
 from ._array import *
 from ._fit import *
 from ._Deriv import *
+from ._Posterior import *
 
 __doc__ = """
 
@@ -17,8 +18,13 @@ The main class is `GP`, which represents a gaussian process over arbitrary
 input. It can be used both autonomously and with lsqfit. The inputs/outputs can
 be arrays or dictionaries of arrays. It supports doing inference with the
 derivatives of the process, using `autograd` to compute automatically
-derivatives of the kernels. Indirectly, this can be used to make inference with
-integrals.
+derivatives of the kernels (the most common built-in kernels have closed form
+derivatives up to the second order). Indirectly, this can be used to make
+inference with integrals. The posterior can be extracted from the `GP` as a
+`Posterior` object, which is evaluated on new points without recomputing the
+decomposition and can be saved to file and loaded back. Count data can be
+fitted with a Poisson or negative binomial likelihood using the Laplace
+approximation (`GP.laplace`), also in `empbayes_fit`.
 
 The covariance kernels are represented by subclasses of class `Kernel`. There's
 also `StationaryKernel` for covariance functions that depend only on the
@@ -77,33 +83,29 @@ Reference: Rasmussen et al. (2006), "Gaussian Processes for Machine Learning".
 # Stabilize Matern kernel near r == 0, then Matern derivatives for real nu
 # (quick partial fix: larger eps in IsotropicKernel.__init__).
 #
-# Kronecker optimization: subclass GPKron where addx has a parameter `dim` and
-# it accepts only non-structured arrays. Or, more flexible: make a class
-# Lattice that is structured-array-like but different shapes for each field,
-# and a field _kronok in Kernel update automatically when doing operations with
-# kernels. Also, take a look at the pymc3 implementation. Can I use the
-# kronecker optimization when the data covariance is non-null? -> Yes with a
-# reasonable approximation of the marginal likelihood, but the data covariance
-# must be diagonal. Other desiderata: separation along arbitrary subsets of
-# the dimensions, it would be important when combining different keys with
-# addtransf (I don't remember why). Can I implement a "kronecker" numpy array
-# using the numpy internal interfaces so that I can let it roam around without
-# changing the code and use autograd? Something like pydata/sparse (if that
-# works).
-#
-# Sparse algorithms. Make a custom minimal CSR class that allows an autograd
-# box as values buffer with only kernel operations implemented (addition,
-# multiplication, matrix multiplication, power). Make two decompositions
-# specifically for sparse matrices, sparselu and sparselowrank. Finite support
-# kernels have a parameter sparse=True to return a sparse matrix. Operations
-# between a sparse and a dense object should raise an error while computing
-# the kernel if the result is dense, but not while making prediction.
-# Alternative: make pydata/sparse work with autograd. I hope I can inject the
-# code into the module so I don't have to rely on a fork. Probably I have to
-# define some missing basic functions and define the vjp of the constructors.
-#
-# DiagLowRank for low rank matrix + multiple of the identity (multiple rank-1
-# updates to the Cholesky factor? Would it be useful anyway?)
+# Kronecker optimization: the `kron` solver handles a single key which is a
+# lattice with a data covariance proportional to the identity. Missing: make
+# it work with a diagonal data covariance (with a reasonable approximation of
+# the marginal likelihood), with derivatives, with multiple keys and with
+# addtransf. Separation along arbitrary subsets of the dimensions. Second
+# derivatives of the logdet. Also, take a look at the pymc3 implementation.
+#
+# Sparse algorithms. The `sparse` solver computes only the nonzero entries for
+# kernels with finite support and uses SuperLU. Missing: derivatives,
+# addtransf, sparse prediction (Kxxs is still dense), a sparse Cholesky
+# (CHOLMOD) when available, a cheaper gradient of the logdet (selected
+# inversion), sparselowrank. Alternative: make pydata/sparse work with
+# autograd.
+#
+# Toeplitz. The `toeplitz` solver handles stationary kernels on equispaced 1D
+# points with a multiple of the identity as data covariance. Missing: a
+# superfast O(n log^2 n) solver, Toeplitz-block-Toeplitz for lattices,
+# sampling with circulant embedding.
+#
+# Inducing points. The `fitc` and `nystrom` solvers use DiagLowRank. Missing:
+# keepcorr=True without building the dense prior, addtransf, a smarter
+# default choice of the inducing points (k-means), variational (Titsias)
+# approximation.
 #
 # Long-term: move to a variable-oriented approach like gvar instead of the
 # monolithic GP object I'm doing now. It should be doable because what I'm
@@ -115,9 +117,8 @@ Reference: Rasmussen et al. (2006), "Gaussian Processes for Machine Learning".
 # Invent a simpler alternative to Where/Choose and GP.addtransf for the case
 # of adding various kernels and getting the separate prediction for each one.
 #
-# Option to compute only the diagonal of the output covariance matrix, and
-# allow diagonal-only input covariance for data (will be fundamental for
-# kronecker). For the output it already works implicitly when using gvars.
+# Allow diagonal-only input covariance for data (will be fundamental for
+# kronecker). The diagonal of the output covariance is `pred(diagonal=True)`.
 #
 # Accept xarray.DataSet and pandas.DataFrame as inputs. Probably I can't use
 # these as core formats due to autograd.
@@ -140,8 +141,8 @@ Reference: Rasmussen et al. (2006), "Gaussian Processes for Machine Learning".
 #
 # Is there a smooth version of the Wiener process? like, softmin(x, y)?
 #
-# Experiment on using second order corrections in empbayes_fit. I can
-# probably half-use the least squares derivative estimation on the residuals
-# term and a normal hessian on the logdet term.
+# empbayes_fit uses the exact hessian from autograd, which costs one backward
+# pass per hyperparameter. Experiment with the Fisher information (expected
+# hessian), which needs only first derivatives of the covariance matrix.
 #
 # Test recursive dtype support.
@@ -5,11 +5,18 @@ from autograd import numpy as np
 from autograd.scipy import linalg
 import autograd
 from scipy import optimize
+from scipy import special
+import functools
+import multiprocessing
+import warnings
+import numpy
 
 from . import _GP
+from . import _linalg
 
 __all__ = [
-    'empbayes_fit'
+    'empbayes_fit',
+    'empbayes_grid'
 ]
 
 def _asarrayorbufferdict(x):
@@ -52,7 +59,71 @@ def _unflat(x, original, expand_transf):
                         d[key[len(transf) + 1:-1]] = _transf[transf](d[key])
         return d
 
-def empbayes_fit(hyperprior, gpfactory, data):
+def _empbayes_objective(hyperprior, gpfactory, data, noisescale, likelihood='gaussian', dispersion=None, amplitude=None):
+    """
+    Return the minus log posterior of the hyperparameters, up to a constant,
+    as a function of the flattened hyperparameters.
+    """
+    flathp = _flat(hyperprior)
+    hpcov = gvar.evalcov(flathp) # TODO use gvar.evalcov_blocks
+    chol = linalg.cholesky(hpcov, lower=True)
+    hpmean = gvar.mean(flathp)
+    
+    def fun(p):
+        hp = _unflat(p, hyperprior, True)
+        gp = gpfactory(hp)
+        assert isinstance(gp, _GP.GP)
+        kw = {} if noisescale is None else dict(noisescale=noisescale(hp))
+        if amplitude is not None:
+            kw.update(amplitude=amplitude(hp))
+        if likelihood != 'gaussian':
+            kw.update(likelihood=likelihood)
+            if dispersion is not None:
+                kw.update(dispersion=dispersion(hp))
+        res = p - hpmean
+        diagres = linalg.solve_triangular(chol, res, lower=True)
+        return -np.sum(gp.marginal_likelihood(data, **kw)) + 1/2 * np.sum(diagres ** 2)
+    
+    return fun
+
+def _invhess(hess):
+    """
+    Invert the hessian at the minimum to get the covariance matrix. If the
+    hessian is not positive definite, i.e. the minimization did not converge
+    to a proper minimum, use the absolute values of its eigenvalues.
+    """
+    w, V = numpy.linalg.eigh((hess + hess.T) / 2)
+    if not numpy.all(w > 0):
+        warnings.warn('the hessian at the minimum is not positive definite, eigenvalues {}'.format(w[w <= 0]))
+        w = numpy.abs(w)
+    return (V / w) @ V.T
+
+def _empbayes_run(hyperprior, gpfactory, data, method, noisescale, amplitude, likelihood, dispersion, start):
+    """
+    Minimize the minus log posterior from `start`. Return the minimum, the
+    value of the function there and the covariance matrix.
+    """
+    fun = _empbayes_objective(hyperprior, gpfactory, data, noisescale, likelihood, dispersion, amplitude)
+    if method == 'newton':
+        gp = gpfactory(_unflat(start, hyperprior, True))
+        if gp._solvername not in gp._hessiansolvers:
+            raise ValueError('solver {} does not support second derivatives, use method=\'bfgs\''.format(repr(gp._solvername)))
+        hess = autograd.hessian(fun)
+        result = optimize.minimize(autograd.value_and_grad(fun), start, jac=True, hess=hess, method='trust-exact')
+        cov = _invhess(hess(result.x))
+    elif method == 'bfgs':
+        result = optimize.minimize(autograd.value_and_grad(fun), start, jac=True, method='BFGS')
+        cov = (result.hess_inv + result.hess_inv.T) / 2
+    else:
+        raise ValueError('unknown method {}'.format(repr(method)))
+    return result.x, result.fun, cov
+
+def _empbayes_run_dumped(dumped, gpfactory, method, noisescale, amplitude, likelihood, dispersion, start):
+    # pickle would lose the correlations between the gvars
+    hyperprior, data = gvar.loads(dumped)
+    return _empbayes_run(hyperprior, gpfactory, data, method, noisescale, amplitude, likelihood, dispersion, start)
+
+def empbayes_fit(hyperprior, gpfactory, data, method='bfgs', noisescale=None, multistart=None, processes=None, seed=0, likelihood='gaussian', dispersion=None, amplitude=None):
     """
     Empirical bayes fit. Maximizes the marginal likelihood of the data with
     a gaussian process model that depends on hyperparameters.
@@ -70,32 +141,241 @@ def empbayes_fit(hyperprior, gpfactory, data):
         A function with signature gpfactory(hyperparams) -> GP object.
     data : dictionary
         Dictionary of data that is passed to GP.marginal_likelihood on the
-        GP object returned by `gpfactory`.
+        GP object returned by `gpfactory`. If the arrays have leading axes
+        with many datasets (see GP.marginal_likelihood), the marginal
+        likelihoods are summed, so the hyperparameters are shared between
+        the datasets.
+    method : str
+        The minimization method. 'bfgs' (default) uses only the gradient,
+        and the covariance matrix of the result is the BFGS approximation of
+        the inverse of the hessian. 'newton' uses the exact hessian computed
+        with `autograd` in a trust region Newton method, which converges in
+        fewer iterations, each more expensive, and the covariance matrix is
+        the inverse of the exact hessian. It requires a solver which
+        supports second derivatives: `auto`, `eigcut+`, `eigcut-`, `gersh`,
+        `maxeigv`, `lowrank`, `statespace` or `nystrom`. In both cases the
+        gradient is computed with `autograd` (with `cg` it is stochastic).
+    noisescale : callable, optional
+        A function with signature noisescale(hyperparams) -> scalar, whose
+        result is passed as `noisescale` to GP.marginal_likelihood, i.e. it
+        multiplies the covariance matrix of the data. If `gpfactory` returns
+        always the same GP object, the decomposition is reused across
+        different values of the noise scale.
+    amplitude : callable, optional
+        A function with signature amplitude(hyperparams) -> scalar or array,
+        whose result is passed as `amplitude` to GP.marginal_likelihood,
+        i.e. it multiplies the prior covariance matrix, with a different
+        value for each dataset if it is an array with the leading axes of
+        `data`. E.g. one amplitude hyperparameter per region, with all the
+        regions sharing the decomposition.
+    multistart : int or 2D array, optional
+        If specified, run many minimizations and return all the distinct
+        local maxima found. If an int, the number of starting points, drawn
+        from the hyperprior. If an array, each row is a starting point of
+        the flattened hyperparameters, e.g. the best points found by
+        `empbayes_grid`. Runs whose results are within 0.1 standard
+        deviations of each other are merged.
+    processes : int, optional
+        With `multistart`, run the minimizations in a pool of this many
+        processes. `gpfactory`, `data`, `noisescale` and `amplitude` must be
+        picklable, e.g. `gpfactory` must be a module-level function or a
+        `functools.partial` of one.
+    seed : int
+        The seed used to draw the starting points, default 0.
+    likelihood : str
+        'gaussian' (default), or 'poisson' or 'negbin' to fit counts with
+        the Laplace approximation of the marginal likelihood, see
+        GP.laplace. `data` must then contain the counts.
+    dispersion : callable, optional
+        A function with signature dispersion(hyperparams) -> scalar, the
+        dispersion of the 'negbin' likelihood.
     
     Returns
     -------
+    If multistart is not specified:
+    
     hyperparams : array or dictionary of arrays of gvars
         The hyperparameters that maximize the marginal likelihood. The
         covariance matrix is computed as the inverse of the hessian of the
-        marginal likelihood.
+        minus log posterior, see `method`. If the hessian is not positive
+        definite, a warning is emitted and the absolute values of its
+        eigenvalues are used.
+    
+    If multistart is specified:
+    
+    modes : list of tuples
+        A tuple (hyperparams, logz, count) for each distinct maximum, sorted
+        by decreasing `logz`. `hyperparams` is as above, `logz` is the
+        Laplace approximation of the logarithm of the evidence of the mode,
+        i.e. of the integral of the marginal likelihood times the hyperprior
+        around the mode, and `count` is the number of runs which converged
+        to the mode.
     """
     assert isinstance(data, (dict, gvar.BufferDict))
     assert callable(gpfactory)
     
     hyperprior = _asarrayorbufferdict(hyperprior)
     flathp = _flat(hyperprior)
-    hpcov = gvar.evalcov(flathp) # TODO use gvar.evalcov_blocks
-    chol = linalg.cholesky(hpcov, lower=True)
     hpmean = gvar.mean(flathp)
     
-    def fun(p):
-        gp = gpfactory(_unflat(p, hyperprior, True))
+    def shaped(x, cov):
+        uresult = gvar.gvar(x, cov)
+        return _asarrayorbufferdict(_unflat(uresult, hyperprior, False))
+    
+    if multistart is None:
+        x, _, cov = _empbayes_run(hyperprior, gpfactory, data, method, noisescale, amplitude, likelihood, dispersion, hpmean)
+        return shaped(x, cov)
+    
+    hpcov = gvar.evalcov(flathp)
+    chol = linalg.cholesky(hpcov, lower=True)
+    if isinstance(multistart, (int, numpy.integer)):
+        z = numpy.random.default_rng(seed).standard_normal((multistart, len(hpmean)))
+        starts = hpmean + z @ chol.T
+    else:
+        starts = numpy.array(multistart, dtype=float)
+        if starts.ndim != 2 or starts.shape[1] != len(hpmean):
+            raise ValueError('multistart has shape {}, expected (nstarts, {})'.format(starts.shape, len(hpmean)))
+    
+    if processes is None:
+        task = functools.partial(_empbayes_run, hyperprior, gpfactory, data, method, noisescale, amplitude, likelihood, dispersion)
+        runs = list(map(task, starts))
+    else:
+        dumped = gvar.dumps((hyperprior, data))
+        task = functools.partial(_empbayes_run_dumped, dumped, gpfactory, method, noisescale, amplitude, likelihood, dispersion)
+        with multiprocessing.Pool(processes) as pool:
+            runs = pool.map(task, starts)
+    
+    # Merge the runs in order of increasing minimum, so each mode is
+    # represented by its best run.
+    modes = []
+    for x, fun, cov in sorted(runs, key=lambda run: run[1]):
+        for mode in modes:
+            dx = x - mode[0]
+            if dx @ numpy.linalg.solve(mode[2], dx) < 0.1 ** 2:
+                mode[3] += 1
+                break
+        else:
+            modes.append([x, fun, cov, 1])
+    
+    # log Z = log(marginal likelihood * prior) at the mode + Laplace volume,
+    # and fun lacks the prior normalization -1/2 log det(2 pi hpcov)
+    _, logdetprior = numpy.linalg.slogdet(hpcov)
+    out = []
+    for x, fun, cov, count in modes:
+        _, logdetcov = numpy.linalg.slogdet(cov)
+        logz = -fun - 1/2 * (logdetprior - logdetcov)
+        out.append((shaped(x, cov), logz, count))
+    out.sort(key=lambda mode: -mode[1])
+    return out
+
+def _gridchunk(hyperprior, gpfactory, data, noisescale, points):
+    """
+    Compute the marginal likelihood for each row of `points`, stacking the
+    covariance matrices and decomposing them together.
+    """
+    Ks = []
+    for p in points:
+        hp = _unflat(p, hyperprior, True)
+        gp = gpfactory(hp)
         assert isinstance(gp, _GP.GP)
-        res = p - hpmean
-        diagres = linalg.solve_triangular(chol, res, lower=True)
-        return -gp.marginal_likelihood(data) + 1/2 * np.sum(diagres ** 2)
+        ylist, inkeys, ycovblocks = gp._flatgiven(data, None)
+        y = _GP._concatenate_noop(ylist, axis=-1)
+        ycov = gp._givencov(y, ycovblocks)
+        if len(np.shape(ycov)) > 2:
+            raise ValueError('covariance matrix of the data varies along the batch axes, not supported by empbayes_grid')
+        if noisescale is not None:
+            ycov = noisescale(hp) * ycov
+        Ks.append(gp._assemblecovblocks(inkeys) + ycov)
+    ymean = gvar.mean(y) if y.dtype == object else y
+    decomp = _linalg.BatchEigCutFullRank(numpy.stack(Ks))
+    n = y.shape[-1]
+    nbatch = ymean.size // n
+    quad = decomp.quad(ymean.reshape(-1, 1, n)) # (datasets, points)
+    return -1/2 * (np.sum(quad, axis=0) + nbatch * (decomp.logdet() + n * np.log(2 * np.pi)))
+
+def _gridchunk_dumped(dumped, gpfactory, noisescale, points):
+    # pickle would lose the correlations between the gvars
+    hyperprior, data = gvar.loads(dumped)
+    return _gridchunk(hyperprior, gpfactory, data, noisescale, points)
+
+def empbayes_grid(hyperprior, gpfactory, data, points, method='lhs', span=3, seed=0, noisescale=None, processes=None, chunksize=32):
+    """
+    Evaluate the marginal likelihood of the data on many values of the
+    hyperparameters at once, e.g. to look at the likelihood surface or to
+    find starting points for `empbayes_fit`.
+    
+    The covariance matrices of a group of `chunksize` points are stacked
+    and diagonalized together with numpy's batched routines, ignoring the
+    `solver` of the GP.
+    
+    Parameters
+    ----------
+    hyperprior, gpfactory, data, noisescale :
+        As in `empbayes_fit`. `gpfactory` receives numpy scalars and must
+        put the data always on the same keys. The data covariance matrix
+        must not vary along the leading axes of `data`.
+    points : int or 2D array
+        If an array, each row is a value of the flattened hyperparameters
+        (in the order of `hyperprior.buf` if `hyperprior` is a dictionary).
+        If an int, the number of points generated from the hyperprior with
+        `method`.
+    method : str
+        'lhs' (default): Latin hypercube sample of `points` points from the
+        hyperprior. 'grid': a regular grid with `points` points per
+        hyperparameter, from -`span` to +`span` standard deviations. In both
+        cases the correlations of the hyperprior are taken into account.
+    span : scalar
+        The extent of the grid for method='grid', default 3.
+    seed : int
+        The seed of the Latin hypercube sample, default 0.
+    processes : int, optional
+        If specified, the chunks of points are processed in a pool of this
+        many processes. `gpfactory`, `data` and `noisescale` must be
+        picklable, e.g. `gpfactory` must be a module-level function or a
+        `functools.partial` of one.
+    chunksize : int
+        The number of covariance matrices diagonalized together, default 32.
+    
+    Returns
+    -------
+    points : 2D array
+        The flattened hyperparameters, one per row.
+    marglike : 1D array
+        The logarithm of the marginal likelihood on each point.
+    """
+    assert isinstance(data, (dict, gvar.BufferDict))
+    assert callable(gpfactory)
     
-    result = optimize.minimize(autograd.value_and_grad(fun), hpmean, jac=True)
-    uresult = gvar.gvar(result.x, result.hess_inv)
-    shapedresult = _unflat(uresult, hyperprior, False)
-    return _asarrayorbufferdict(shapedresult)
+    hyperprior = _asarrayorbufferdict(hyperprior)
+    flathp = _flat(hyperprior)
+    hpmean = gvar.mean(flathp)
+    
+    if isinstance(points, (int, numpy.integer)):
+        hpcov = gvar.evalcov(flathp)
+        chol = linalg.cholesky(hpcov, lower=True)
+        d = len(hpmean)
+        if method == 'lhs':
+            rng = numpy.random.default_rng(seed)
+            strata = numpy.stack([rng.permutation(points) for _ in range(d)], axis=1)
+            z = special.ndtri((strata + rng.uniform(size=(points, d))) / points)
+        elif method == 'grid':
+            axes = [numpy.linspace(-span, span, points)] * d
+            z = numpy.stack(numpy.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, d)
+        else:
+            raise ValueError('unknown method {}'.format(repr(method)))
+        points = hpmean + z @ chol.T
+    else:
+        points = numpy.array(points, dtype=float)
+        if points.ndim != 2 or points.shape[1] != len(hpmean):
+            raise ValueError('points has shape {}, expected (npoints, {})'.format(points.shape, len(hpmean)))
+    
+    chunks = [points[i:i + chunksize] for i in range(0, len(points), chunksize)]
+    if processes is None:
+        task = functools.partial(_gridchunk, hyperprior, gpfactory, data, noisescale)
+        results = list(map(task, chunks))
+    else:
+        dumped = gvar.dumps((hyperprior, data))
+        task = functools.partial(_gridchunk_dumped, dumped, gpfactory, noisescale)
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(task, chunks)
+    return points, numpy.concatenate(results)
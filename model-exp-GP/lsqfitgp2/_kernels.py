@@ -35,6 +35,20 @@ __all__ = [
 
 def _dot(x, y):
     return _Kernel._sum_recurse_dtype(lambda x, y: x * y, x, y)
+
+def _isoderivs(d1, d2):
+    """
+    Closed form derivatives (see the `derivs` option of `Kernel`) of a 1D
+    isotropic kernel k(x, y) = f(x - y), given the first and second
+    derivatives `d1`, `d2` of f.
+    """
+    return {
+        (1, 0): lambda x, y, **kw: d1(x - y, **kw),
+        (0, 1): lambda x, y, **kw: -d1(x - y, **kw),
+        (1, 1): lambda x, y, **kw: -d2(x - y, **kw),
+        (2, 0): lambda x, y, **kw: d2(x - y, **kw),
+        (0, 2): lambda x, y, **kw: d2(x - y, **kw),
+    }
     
 @isotropickernel(derivable=True)
 def Constant(r2):
@@ -52,7 +66,12 @@ def White(r2):
     """
     return np.where(r2 == 0, 1, 0)
 
-@isotropickernel(derivable=True)
+_expquad_derivs = _isoderivs(
+    lambda r: -r * np.exp(-1/2 * r ** 2),
+    lambda r: (r ** 2 - 1) * np.exp(-1/2 * r ** 2)
+)
+
+@isotropickernel(derivable=True, derivs=_expquad_derivs)
 def ExpQuad(r2):
     """
     Gaussian kernel. It is very smooth, and has a strict typical lengthscale:
@@ -61,7 +80,15 @@ def ExpQuad(r2):
     """
     return np.exp(-1/2 * r2)
 
-@kernel(derivable=True)
+_linear_derivs = {
+    (1, 0): lambda x, y: y * np.ones_like(x),
+    (0, 1): lambda x, y: x * np.ones_like(y),
+    (1, 1): lambda x, y: np.ones(np.broadcast(x, y).shape),
+    (2, 0): lambda x, y: np.zeros(np.broadcast(x, y).shape),
+    (0, 2): lambda x, y: np.zeros(np.broadcast(x, y).shape),
+}
+
+@kernel(derivable=True, derivs=_linear_derivs)
 def Linear(x, y):
     """
     Kernel which just returns x * y. It is equivalent to fitting with a
@@ -116,14 +143,24 @@ extend.defvjp(
     lambda ans, x, p: lambda g: g * _maternp_deriv(x, p)
 )
 
+def _ishalfint(nu):
+    return (2 * nu) % 2 == 1
+
 def _matern_derivable(**kw):
     nu = kw.get('nu', None)
-    if np.isscalar(nu) and nu > 0 and (2 * nu) % 1 == 0:
+    if np.isscalar(nu) and nu > 0 and _ishalfint(nu):
         return int(nu - 1/2)
     else:
         return False   
 
-@isotropickernel(input='soft', derivable=_matern_derivable)
+def _matern_statespace(**kw):
+    nu = kw.get('nu', None)
+    if np.isscalar(nu) and nu > 0 and _ishalfint(nu):
+        return int(nu - 1/2)
+    else:
+        return None
+
+@isotropickernel(input='soft', derivable=_matern_derivable, statespace=_matern_statespace)
 def Matern(r, nu=None):
     """
     Matérn kernel of order `nu` > 0. The nearest integer below `nu` indicates
@@ -136,12 +173,12 @@ def Matern(r, nu=None):
     assert np.isscalar(nu)
     assert nu > 0
     x = np.sqrt(2 * nu) * r
-    if (2 * nu) % 1 == 0:
+    if _ishalfint(nu):
         return _maternp(x, int(nu - 1/2))
     else:
         return 2 ** (1 - nu) / special.gamma(nu) * x ** nu * _kv(nu, x)
 
-@isotropickernel(input='soft')
+@isotropickernel(input='soft', statespace=0)
 def Matern12(r):
     """
     Matérn kernel of order 1/2 (continuous, not derivable).
@@ -157,7 +194,15 @@ extend.defvjp(
     lambda ans, x: lambda g: g * -x * np.exp(-x)
 )
 
-@isotropickernel(input='soft', derivable=1)
+def _matern32_d1(r):
+    x = np.sqrt(3) * np.abs(r)
+    return -3 * r * np.exp(-x)
+
+def _matern32_d2(r):
+    x = np.sqrt(3) * np.abs(r)
+    return -3 * (1 - x) * np.exp(-x)
+
+@isotropickernel(input='soft', derivable=1, statespace=1, derivs=_isoderivs(_matern32_d1, _matern32_d2))
 def Matern32(r):
     """
     Matérn kernel of order 3/2 (derivable one time).
@@ -173,7 +218,33 @@ extend.defvjp(
     lambda ans, x: lambda g: g * -x/3 * _matern32(x)
 )
 
-@isotropickernel(input='soft', derivable=2)
+# The derivatives are primitives because autograd would get wrong the
+# derivatives of np.abs(r) at r = 0 needed for the (2, 2) derivative.
+
+@extend.primitive
+def _matern52_d1(r):
+    x = np.sqrt(5) * np.abs(r)
+    return -5/3 * r * (1 + x) * np.exp(-x)
+
+@extend.primitive
+def _matern52_d2(r):
+    x = np.sqrt(5) * np.abs(r)
+    return -5/3 * (1 + x * (1 - x)) * np.exp(-x)
+
+@extend.primitive
+def _matern52_d3(r):
+    x = np.sqrt(5) * np.abs(r)
+    return 25/3 * r * (3 - x) * np.exp(-x)
+
+def _matern52_d4(r):
+    x = np.sqrt(5) * np.abs(r)
+    return 25/3 * (3 - x * (5 - x)) * np.exp(-x)
+
+extend.defvjp(_matern52_d1, lambda ans, r: lambda g: g * _matern52_d2(r))
+extend.defvjp(_matern52_d2, lambda ans, r: lambda g: g * _matern52_d3(r))
+extend.defvjp(_matern52_d3, lambda ans, r: lambda g: g * _matern52_d4(r))
+
+@isotropickernel(input='soft', derivable=2, statespace=2, derivs=_isoderivs(_matern52_d1, _matern52_d2))
 def Matern52(r):
     """
     Matérn kernel of order 5/2 (derivable two times).
@@ -192,7 +263,14 @@ def GammaExp(r, gamma=1):
     assert 0 < gamma <= 2
     return np.exp(-(r ** gamma))
 
-@isotropickernel(derivable=True)
+def _ratquad_d1(r, alpha=2):
+    return -r * (1 + r ** 2 / (2 * alpha)) ** (-alpha - 1)
+
+def _ratquad_d2(r, alpha=2):
+    u = 1 + r ** 2 / (2 * alpha)
+    return ((1 + 1 / alpha) * r ** 2 - u) * u ** (-alpha - 2)
+
+@isotropickernel(derivable=True, derivs=_isoderivs(_ratquad_d1, _ratquad_d2))
 def RatQuad(r2, alpha=2):
     """
     Rational quadratic kernel. It is equivalent to a lengthscale mixture of
@@ -244,7 +322,15 @@ def Gibbs(x, y, scalefun=lambda x: 1):
     factor = np.sqrt(2 * sx * sy / denom)
     return factor * np.exp(-(x - y) ** 2 / denom)
 
-@isotropickernel(input='soft', derivable=True)
+def _periodic_d1(r, outerscale=1):
+    q = outerscale ** 2
+    return -np.sin(r) / q * np.exp(-(1 - np.cos(r)) / q)
+
+def _periodic_d2(r, outerscale=1):
+    q = outerscale ** 2
+    return (np.sin(r) ** 2 / q - np.cos(r)) / q * np.exp(-(1 - np.cos(r)) / q)
+
+@isotropickernel(input='soft', derivable=True, derivs=_isoderivs(_periodic_d1, _periodic_d2))
 def Periodic(r, outerscale=1):
     """
     A gaussian kernel over a transformed periodic space. It represents a
@@ -287,7 +373,7 @@ def Rescaling(x, y, stdfun=None):
         stdfun = lambda x: np.ones_like(x)
     return stdfun(x) * stdfun(y)
 
-@isotropickernel(input='soft', derivable=True)
+@isotropickernel(input='soft', derivable=True, derivs=_isoderivs(lambda r: -np.sin(r), lambda r: -np.cos(r)))
 def Cos(r):
     return np.cos(r)
 
@@ -311,7 +397,7 @@ def _ppkernel_derivable(**kw):
     else:
         return 0
 
-@isotropickernel(input='soft', derivable=_ppkernel_derivable)
+@isotropickernel(input='soft', derivable=_ppkernel_derivable, support=1)
 def PPKernel(r, q=0, D=1):
     """
     Piecewise polynomial kernel. An isotropic kernel with finite support.
@@ -0,0 +1,123 @@
+from __future__ import division
+
+from autograd import numpy as np
+from autograd.scipy import special
+import numpy
+
+from . import _linalg
+
+__doc__ = """
+
+Laplace approximation of the posterior of a latent gaussian process with a
+non-gaussian likelihood for count data, following Rasmussen et al. (2006),
+algorithms 3.1 and 5.1. The process is the logarithm of the mean of the
+counts.
+
+Likelihoods
+-----------
+poisson :
+    y ~ Poisson(exp(f)).
+negbin :
+    y ~ NegativeBinomial with mean mu = exp(f) and variance mu + mu^2 / r,
+    where r is the `dispersion`.
+
+"""
+
+def _poisson(y, f, r):
+    """
+    Return the log likelihood, its gradient and minus its (diagonal)
+    hessian w.r.t. f.
+    """
+    mu = np.exp(f)
+    loglik = np.sum(y * f - mu - special.gammaln(y + 1))
+    return loglik, y - mu, mu
+
+def _negbin(y, f, r):
+    mu = np.exp(f)
+    loglik = np.sum(
+        special.gammaln(y + r) - special.gammaln(r) - special.gammaln(y + 1)
+        + r * np.log(r / (r + mu)) + y * np.log(mu / (r + mu))
+    )
+    grad = (y - mu) * r / (r + mu)
+    W = (y + r) * mu * r / (r + mu) ** 2
+    return loglik, grad, W
+
+likelihoods = {
+    'poisson': _poisson,
+    'negbin': _negbin,
+}
+
+def _newtonstep(K, y, f, r, lik, decompclass):
+    """
+    One Newton step from f. Return the new f and the vector a such that
+    f = K @ a.
+    """
+    _, grad, W = lik(y, f, r)
+    sW = np.sqrt(W)
+    B = np.eye(len(y)) + sW[:, None] * K * sW[None, :]
+    b = W * f + grad
+    a = b - sW * decompclass(B).solve(sW * (K @ b))
+    f = K @ a
+    return f, a
+
+def newton(K, y, likelihood, dispersion, decompclass, maxiter=100, tol=1e-8):
+    """
+    Find the mode of the posterior of the latent process with prior
+    covariance matrix K, given the counts y. Decompose the matrices with
+    `decompclass`.
+    
+    The iterations are done without autograd, then two last Newton steps
+    and the marginal likelihood are computed with the possibly
+    autograd-boxed K and dispersion: since the Newton steps converge
+    quadratically, the error on the derivatives of the mode w.r.t. K is of
+    order 4 after two steps, so the first and second derivatives of the
+    marginal likelihood are correct.
+    
+    Return the mode f, the gradient and minus the hessian of the log
+    likelihood at the mode, and the Laplace approximation of the logarithm
+    of the marginal likelihood.
+    """
+    if likelihood not in likelihoods:
+        raise ValueError('unknown likelihood {}'.format(repr(likelihood)))
+    lik = likelihoods[likelihood]
+    if likelihood == 'negbin':
+        if dispersion is None:
+            raise ValueError('likelihood negbin requires the dispersion')
+        r = dispersion
+    else:
+        r = None
+    
+    Kval = _linalg.noautograd(K)
+    rval = _linalg.noautograd(r)
+    def psi(f, a):
+        # log likelihood + log prior, up to a constant
+        return lik(y, f, rval)[0] - 1/2 * (a @ f)
+    
+    f = numpy.zeros(len(y))
+    a = numpy.zeros(len(y))
+    oldpsi = psi(f, a)
+    with numpy.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        for _ in range(maxiter):
+            newf, newa = _newtonstep(Kval, y, f, rval, lik, decompclass)
+            newpsi = psi(newf, newa)
+            # far from the mode the step may overshoot, then halve it
+            for _ in range(50):
+                if numpy.isfinite(newpsi) and newpsi >= oldpsi:
+                    break
+                newa = (a + newa) / 2
+                newf = Kval @ newa
+                newpsi = psi(newf, newa)
+            converged = numpy.max(numpy.abs(newf - f)) <= tol * (1 + numpy.max(numpy.abs(newf)))
+            f, a, oldpsi = newf, newa, newpsi
+            if converged:
+                break
+        else:
+            raise RuntimeError('Newton iterations did not converge in {} steps'.format(maxiter))
+    
+    for _ in range(2):
+        f, a = _newtonstep(K, y, f, r, lik, decompclass)
+    loglik, grad, W = lik(y, f, r)
+    sW = np.sqrt(W)
+    B = np.eye(len(y)) + sW[:, None] * K * sW[None, :]
+    logml = -1/2 * (a @ f) + loglik - 1/2 * decompclass(B).logdet()
+    return f, grad, W, logml
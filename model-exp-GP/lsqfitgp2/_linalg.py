@@ -2,6 +2,10 @@ from autograd import numpy as np
 from autograd.scipy import linalg
 from autograd import extend
 from scipy.sparse import linalg as slinalg
+from scipy import sparse
+from scipy import linalg as slinalg_dense
+from scipy import special
+import numpy # to bypass autograd
 
 __doc__ = """
 
@@ -23,14 +27,34 @@ EigCutLowRank :
     Diagonalization removing small eigenvalues.
 ReduceRank :
     Partial diagonalization with higher eigenvalues only.
+CGDecomp :
+    Conjugate gradient with a stochastic estimate of the log-determinant.
 Chol :
     Cholesky decomposition.
 CholMaxEig :
     Cholesky regularized using the maximum eigenvalue.
 CholGersh :
     Cholesky regularized using an estimate of the maximum eigenvalue.
+AutoDecomp :
+    CholGersh, or EigCutFullRank if the matrix is too ill-conditioned.
 BlockDecomp :
     Decompose a block matrix.
+KronDecomp :
+    Decompose a kronecker product of matrices plus a multiple of the identity.
+KalmanDecomp :
+    Decompose the covariance matrix of a sum of 1D Matérn processes plus
+    diagonal noise with a Kalman filter.
+SparseDecomp :
+    Sparse LU decomposition of a sparse matrix plus a diagonal.
+ToeplitzDecomp :
+    Decompose a symmetric Toeplitz matrix with the Levinson-Durbin recursion.
+DiagLowRank :
+    Decompose a diagonal plus a low rank matrix with the Woodbury formula.
+BatchEigCutFullRank :
+    Like EigCutFullRank, for a stack of matrices.
+GenEig :
+    Generalized diagonalization of a pair of matrices K, D, to decompose
+    K + s D for any scalar s.
 
 """
 
@@ -93,10 +117,17 @@ class DecompMeta(type):
                     assert AB.shape == g.shape[:-len(b.shape)] + K.shape
                     return -AB
                 return vjp
+            def solve_vjp_b(ans, self, K, b):
+                def vjp(g):
+                    axis = -len(b.shape)
+                    A = solve_autograd(self, K, np.moveaxis(g, axis, 0))
+                    return np.moveaxis(A, 0, axis)
+                return vjp
             extend.defvjp(
                 solve_autograd,
                 solve_vjp,
-                argnums=[1]
+                solve_vjp_b,
+                argnums=[1, 2]
             )
             def solve(self, b):
                 return solve_autograd(self, self._K, b)
@@ -125,7 +156,7 @@ class DecompMeta(type):
                 assert ans.shape == ()
                 assert K.shape[0] == K.shape[1]
                 def vjp(g):
-                    invK = self.solve._autograd(self, K, np.eye(len(K)))
+                    invK = self._logdetgrad(K)
                     return g[..., None, None] * invK
                 return vjp
             extend.defvjp(
@@ -201,6 +232,13 @@ class Decomposition(metaclass=DecompMeta):
         Compute log(det(K)).
         """
         raise NotImplementedError
+    
+    def _logdetgrad(self, K):
+        """
+        Compute the gradient of log(det(K)) w.r.t. K, i.e. inv(K). Used by
+        the autograd support, `K` is the matrix possibly wrapped by autograd.
+        """
+        return self.solve._autograd(self, K, np.eye(len(K)))
 
 class Diag(Decomposition):
     """
@@ -222,33 +260,35 @@ class Diag(Decomposition):
     def logdet(self):
         return np.sum(np.log(self._w))
     
-    def _eps(self, eps):
+    def _eps(self, eps, maxeigv=None):
         w = self._w
         if eps is None:
             eps = len(w) * np.finfo(asinexact(w.dtype)).eps
         assert np.isscalar(eps) and 0 <= eps < 1
-        return eps * np.max(w)
+        if maxeigv is None:
+            maxeigv = np.max(w)
+        return eps * maxeigv
 
 class EigCutFullRank(Diag):
     """
     Diagonalization. Eigenvalues below `eps` are set to `eps`, where `eps` is
-    relative to the largest eigenvalue.
+    relative to the largest eigenvalue, or to `maxeigv` if specified.
     """
     
-    def __init__(self, K, eps=None, **kw):
+    def __init__(self, K, eps=None, maxeigv=None, **kw):
         super().__init__(K, **kw)
-        eps = self._eps(eps)
+        eps = self._eps(eps, maxeigv)
         self._w[self._w < eps] = eps
             
 class EigCutLowRank(Diag):
     """
     Diagonalization. Eigenvalues below `eps` are removed, where `eps` is
-    relative to the largest eigenvalue.
+    relative to the largest eigenvalue, or to `maxeigv` if specified.
     """
     
-    def __init__(self, K, eps=None, **kw):
+    def __init__(self, K, eps=None, maxeigv=None, **kw):
         super().__init__(K, **kw)
-        eps = self._eps(eps)
+        eps = self._eps(eps, maxeigv)
         subset = slice(np.sum(self._w < eps), None) # w is sorted ascending
         self._w = self._w[subset]
         self._V = self._V[:, subset]
@@ -262,6 +302,195 @@ class ReduceRank(Diag):
         assert isinstance(rank, (int, np.integer)) and rank >= 1
         self._w, self._V = slinalg.eigsh(K, k=rank, which='LM')
 
+def _cg(A, B, tol, maxiter):
+    """
+    Solve A @ X = B with the conjugate gradient method, separately for each
+    column of the 2D array B. Stop when the residual of each column is below
+    `tol` relative to the column norm. Return X and whether all the columns
+    converged within `maxiter` iterations.
+    """
+    X = numpy.zeros(B.shape)
+    R = numpy.array(B, dtype=float)
+    P = R.copy()
+    rr = numpy.sum(R ** 2, axis=0)
+    stop = tol ** 2 * rr
+    for _ in range(maxiter):
+        active = rr > stop
+        if not numpy.any(active):
+            break
+        AP = A @ P[:, active]
+        alpha = rr[active] / numpy.sum(P[:, active] * AP, axis=0)
+        X[:, active] += alpha * P[:, active]
+        R[:, active] -= alpha * AP
+        newrr = numpy.sum(R[:, active] ** 2, axis=0)
+        P[:, active] = R[:, active] + newrr / rr[active] * P[:, active]
+        rr[active] = newrr
+    return X, not numpy.any(rr > stop)
+
+def _lanczos(A, Z, m):
+    """
+    Run `m` steps of the Lanczos algorithm on the symmetric matrix A starting
+    from each column of Z, with full reorthogonalization. Return the
+    diagonals and the off-diagonals of the tridiagonal matrices, with shapes
+    (k, m) and (k, m - 1) where k is the number of columns of Z. The number
+    of steps is reduced if it exceeds the matrix size.
+    """
+    n, k = Z.shape
+    m = min(m, n)
+    Q = numpy.empty((m, n, k))
+    alpha = numpy.empty((k, m))
+    beta = numpy.zeros((k, m - 1))
+    q = Z / numpy.linalg.norm(Z, axis=0)
+    for j in range(m):
+        Q[j] = q
+        w = A @ q
+        alpha[:, j] = numpy.sum(q * w, axis=0)
+        for _ in range(2):
+            w -= numpy.einsum('jnk,jk->nk', Q[:j + 1], numpy.einsum('jnk,nk->jk', Q[:j + 1], w))
+        if j < m - 1:
+            beta[:, j] = numpy.linalg.norm(w, axis=0)
+            q = w / numpy.where(beta[:, j] > 0, beta[:, j], 1)
+    return alpha, beta
+
+def _slq_logdet(A, Z, m):
+    """
+    Stochastic Lanczos quadrature estimate of log(det(A)) with the probe
+    vectors in the columns of Z, which must have elements with unit variance.
+    """
+    alpha, beta = _lanczos(A, Z, m)
+    estimates = []
+    for a, b in zip(alpha, beta):
+        w, V = slinalg_dense.eigh_tridiagonal(a, b)
+        estimates.append(numpy.sum(V[0] ** 2 * numpy.log(w)))
+    return A.shape[0] * numpy.mean(estimates)
+
+def psdfactor(A):
+    """
+    Return a matrix W such that W @ W.T = A for the symmetric positive
+    semidefinite matrix A, dropping the nonpositive eigenvalues.
+    """
+    w, V = numpy.linalg.eigh(noautograd(A))
+    keep = w > 0
+    return V[:, keep] * numpy.sqrt(w[keep])
+
+def invfactor(decomp, n):
+    """
+    Return a matrix W such that W @ W.T is the inverse of the n x n matrix
+    decomposed by `decomp`. Diagonalizations and Cholesky decompositions
+    provide it directly, other decompositions are used to compute the
+    inverse and then diagonalize it.
+    """
+    if isinstance(decomp, AutoDecomp):
+        return invfactor(decomp._decomp, n)
+    elif isinstance(decomp, Diag):
+        return noautograd(decomp._V) / numpy.sqrt(noautograd(decomp._w))
+    elif isinstance(decomp, Chol):
+        L = noautograd(decomp._L)
+        return slinalg_dense.solve_triangular(L, numpy.eye(n), lower=True).T
+    else:
+        inv = noautograd(decomp.solve(numpy.eye(n)))
+        return psdfactor((inv + inv.T) / 2)
+
+def extreme_eigvals(A, m, seed=0):
+    """
+    Estimate the smallest and largest eigenvalues of the symmetric matrix A
+    with `m` steps of the Lanczos algorithm from a random vector, O(n^2 m).
+    The estimates are respectively an upper bound on the smallest and a
+    lower bound on the largest eigenvalue.
+    """
+    A = noautograd(A)
+    z = numpy.random.default_rng(seed).standard_normal((len(A), 1))
+    alpha, beta = _lanczos(A, z, m)
+    w = slinalg_dense.eigvalsh_tridiagonal(alpha[0], beta[0])
+    return w[0], w[-1]
+
+class CGDecomp(Decomposition):
+    """
+    Solve linear systems with the conjugate gradient method, preconditioned
+    with the diagonal of the matrix, using only matrix-vector products. The
+    matrix can be given as a function which computes the products, so it
+    does not need to be stored. The matrix is corrected for numerical
+    roundoff like in CholGersh.
+    
+    The log-determinant and its gradient are stochastic estimates, computed
+    with stochastic Lanczos quadrature and Hutchinson's trace estimator with
+    `nprobes` random vectors and `nlanczos` Lanczos steps. Their relative
+    error is of order 1/sqrt(nprobes) and does not decrease with `tol`. The
+    random vectors are drawn from `seed`, so the error is the same in all
+    the calls with the same seed and matrix size, and changes with `seed`.
+    """
+    
+    def __init__(self, K, eps=None, maxeigv=None, tol=1e-10, maxiter=None, nprobes=32, nlanczos=32, seed=0, diag=None):
+        """
+        K is the matrix or a function computing K @ V for a 2D array V. In
+        the latter case the diagonal of K must be specified with `diag`, and
+        the default `maxeigv` is the trace of K instead of the Gershgorin
+        bound. A function can not be differentiated with autograd, but the
+        solve and quad methods can be differentiated w.r.t. their argument.
+        """
+        if callable(K):
+            if diag is None:
+                raise ValueError('the diagonal must be specified if the matrix is a function')
+            if isinstance(diag, np.numpy_boxes.ArrayBox) or isinstance(maxeigv, np.numpy_boxes.ArrayBox):
+                raise TypeError('the matrix given as a function can not be differentiated with autograd')
+            n = len(diag)
+            if maxeigv is None:
+                maxeigv = numpy.sum(diag) # upper bound
+        else:
+            n = len(K)
+            diag = numpy.diag(K)
+            if maxeigv is None:
+                maxeigv = _gershgorin_eigval_bound(K)
+        if eps is None:
+            eps = n * np.finfo(asinexact(diag.dtype)).eps
+        assert np.isscalar(eps) and 0 <= eps < 1
+        d = diag + eps * maxeigv
+        self._scale = 1 / numpy.sqrt(d)
+        if callable(K):
+            s = self._scale[:, None]
+            jitter = eps * maxeigv * s ** 2
+            def matmat(V):
+                KV = K(s * V)
+                if isinstance(KV, np.numpy_boxes.ArrayBox):
+                    raise TypeError('the matrix given as a function can not be differentiated with autograd')
+                return s * KV + jitter * V
+            matvec = lambda v: matmat(v.reshape(-1, 1)).reshape(v.shape)
+            self._A = slinalg.LinearOperator((n, n), matvec=matvec, matmat=matmat, dtype=float)
+        else:
+            self._A = self._scale[:, None] * K * self._scale[None, :]
+            self._A[numpy.diag_indices(n)] = 1
+        self._tol = tol
+        self._maxiter = 10 * n if maxiter is None else maxiter
+        self._Z = numpy.random.default_rng(seed).choice([-1., 1.], size=(n, nprobes))
+        self._nlanczos = nlanczos
+    
+    def _solve2d(self, b):
+        X, converged = _cg(self._A, self._scale[:, None] * b, self._tol, self._maxiter)
+        if not converged:
+            raise RuntimeError('conjugate gradient did not converge in {} iterations'.format(self._maxiter))
+        return self._scale[:, None] * X
+    
+    def solve(self, b):
+        return self._solve2d(numpy.reshape(b, (len(b), -1))).reshape(b.shape)
+    
+    def usolve(self, b):
+        if b.dtype == object:
+            # gvars can not go through the iteration since the coefficients
+            # depend on b
+            return self.solve(numpy.eye(len(b))) @ b
+        return self.solve(b)
+    
+    def logdet(self):
+        logdetA = _slq_logdet(self._A, self._Z, self._nlanczos)
+        return logdetA - 2 * numpy.sum(numpy.log(self._scale))
+    
+    def _logdetgrad(self, K):
+        # E[inv(K) z z^T] = inv(K) for z with unit covariance
+        Z = self._Z
+        invKZ = self._solve2d(Z)
+        grad = invKZ @ Z.T / Z.shape[1]
+        return (grad + grad.T) / 2
+
 def solve_triangular(a, b, lower=False):
     """
     Pure python implementation of scipy.linalg.solve_triangular for when
@@ -329,13 +558,14 @@ class Chol(Decomposition):
 class CholMaxEig(Chol):
     """
     Cholesky decomposition. The matrix is corrected for numerical roundoff
-    by adding to the diagonal a small number relative to the maximum eigenvalue.
-    `eps` multiplies this number.
+    by adding to the diagonal a small number relative to the maximum eigenvalue
+    (or to `maxeigv` if specified). `eps` multiplies this number.
     """
     
-    def __init__(self, K, eps=None, **kw):
-        w = slinalg.eigsh(K, k=1, which='LM', return_eigenvectors=False)
-        eps = self._eps(eps, K, w[0])
+    def __init__(self, K, eps=None, maxeigv=None, **kw):
+        if maxeigv is None:
+            maxeigv = slinalg.eigsh(K, k=1, which='LM', return_eigenvectors=False)[0]
+        eps = self._eps(eps, K, maxeigv)
         super().__init__(K + np.diag(np.full(len(K), eps)), **kw)
 
 
@@ -344,25 +574,75 @@ class CholGersh(Chol):
     Cholesky decomposition. The matrix is corrected for numerical roundoff
     by adding to the diagonal a small number relative to the maximum eigenvalue.
     `eps` multiplies this number. The maximum eigenvalue is estimated
-    with the Gershgorin theorem.
+    with the Gershgorin theorem, unless `maxeigv` is specified.
     """
     
-    def __init__(self, K, eps=None, **kw):
-        maxeigv = _gershgorin_eigval_bound(K)
+    def __init__(self, K, eps=None, maxeigv=None, **kw):
+        if maxeigv is None:
+            maxeigv = _gershgorin_eigval_bound(K)
         eps = self._eps(eps, K, maxeigv)
         super().__init__(K + np.diag(np.full(len(K), eps)), **kw)
 
+class AutoDecomp(Decomposition):
+    """
+    Cholesky decomposition regularized like CholGersh. If it fails, or if
+    the condition number estimated from the Cholesky factor (with LAPACK's
+    trcon, O(n^2)) exceeds `maxcond`, use EigCutFullRank instead, with the
+    same `eps` and `maxeigv`, so the result is the same of EigCutFullRank.
+    The default `maxcond` is 1e-6 / eps, i.e. the regularization changes the
+    smallest eigenvalue by less than 1 ppm. The attribute `path` is 'chol' or
+    'eigcut' depending on the decomposition used.
+    """
+    
+    def __init__(self, K, eps=None, maxeigv=None, maxcond=None):
+        cholmaxeigv = maxeigv
+        if cholmaxeigv is None:
+            cholmaxeigv = _gershgorin_eigval_bound(K)
+        if eps is None:
+            eps = len(K) * np.finfo(asinexact(K.dtype)).eps
+        if maxcond is None:
+            maxcond = 1e-6 / eps
+        try:
+            decomp = CholGersh(K, eps=eps, maxeigv=cholmaxeigv)
+            L = decomp._L
+            trcon, = slinalg_dense.lapack.get_lapack_funcs(('trcon',), (L,))
+            rcond, info = trcon(L, norm='1', uplo='L')
+            good = info == 0 and rcond > 0 and 1 / rcond ** 2 <= maxcond
+        except numpy.linalg.LinAlgError:
+            good = False
+        if good:
+            self.path = 'chol'
+        else:
+            decomp = EigCutFullRank(K, eps=eps, maxeigv=maxeigv)
+            self.path = 'eigcut'
+        self._decomp = decomp
+    
+    def solve(self, b):
+        return self._decomp.solve(b)
+    
+    def usolve(self, b):
+        return self._decomp.usolve(b)
+    
+    def quad(self, b):
+        return self._decomp.quad(b)
+    
+    def logdet(self):
+        return self._decomp.logdet()
+
 def _gershgorin_eigval_bound(K):
     """
     Upper bound on the largest magnitude eigenvalue of the matrix.
     """
     return np.max(np.sum(np.abs(K), axis=1))
 
-# TODO test this.
 class BlockDecomp:
     """
     Decomposition of a 2x2 symmetric block matrix using decompositions of the
-    diagonal blocks.
+    diagonal blocks. The decomposition of the upper left block can itself be
+    a BlockDecomp, so a decomposition can be extended by adding rows and
+    columns without decomposing again the whole matrix. Each operation calls
+    only once the corresponding operation of the upper left block, so the
+    cost grows linearly with the nesting depth.
     
     Reference: Gaussian Processes for Machine Learning, A.3, p. 201.
     """
@@ -385,40 +665,820 @@ class BlockDecomp:
             The other blocks.
         S_decomp_class : DecompMeta
             A subclass of Decomposition used to decompose S - Q.T P^-1 Q.
+            Since this Schur complement can be much smaller than A, a
+            regularizing decomposition should take the maximum eigenvalue of
+            A as reference (see the `maxeigv` argument of EigCutFullRank).
         """
         self._Q = Q
         self._invP = P_decomp
-        self._tildeS = S_decomp_class(S - P_decomp.quad(Q))
+        self._invPQ = P_decomp.solve(Q)
+        schur = S - Q.T @ self._invPQ
+        self._schur = (schur + schur.T) / 2
+        self._tildeS = S_decomp_class(self._schur)
     
     def solve(self, b):
-        invP = self._invP
-        tildeS = self._tildeS
-        Q = self._Q
-        f = b[:len(Q)]
-        g = b[len(Q):]
-        y = tildeS.solve(g - Q.T @ invP.solve(f)) # TODO invP.quad(Q, f)
-        x = invP.solve(f - Q @ y)
+        n = len(self._Q)
+        f = b[:n]
+        g = b[n:]
+        invPf = self._invP.solve(f)
+        y = self._tildeS.solve(g - self._Q.T @ invPf)
+        x = invPf - self._invPQ @ y
         return np.concatenate([x, y])
     
     def usolve(self, b):
-        invP = self._invP
-        tildeS = self._tildeS
-        Q = self._Q
-        f = b[:len(Q)]
-        g = b[len(Q):]
-        y = tildeS.usolve(g - Q.T @ invP.usolve(f))
-        x = invP.usolve(f - Q @ y)
+        n = len(self._Q)
+        f = b[:n]
+        g = b[n:]
+        invPf = self._invP.usolve(f)
+        y = self._tildeS.usolve(g - self._Q.T @ invPf)
+        x = invPf - self._invPQ @ y
         return np.concatenate([x, y])
     
     def quad(self, b):
-        invP = self._invP
-        tildeS = self._tildeS
-        Q = self._Q
-        f = b[:len(Q)]
-        g = b[len(Q):]
-        QTinvPf = Q.T @ invP.solve(f) # TODO invP.quad(Q, f)
-        fTinvPQtildeSg = QTinvPf.T @ tildeS.solve(g) # tildeS.quad(QTinvPf, g)
-        return invP.quad(f) + tildeS.quad(QTinvPf) - fTinvPQtildeSg - fTinvPQtildeSg.T + tildeS.quad(g)
+        n = len(self._Q)
+        f = b[:n]
+        g = b[n:]
+        invPf = self._invP.solve(f)
+        return f.T @ invPf + self._tildeS.quad(g - self._Q.T @ invPf)
 
     def logdet(self):
         return self._invP.logdet() + self._tildeS.logdet()
+
+def _outer(a, b):
+    """
+    Outer product of arrays, preserving the shapes.
+    """
+    a = np.array(a)
+    return np.reshape(a, a.shape + (1,) * len(b.shape)) * b
+
+def _kronmatmul(mats, b):
+    """
+    Compute (mats[0] ⊗ mats[1] ⊗ ...) @ b without forming the kronecker
+    product. b can be 1D or 2D.
+    """
+    shape = tuple(len(m) for m in mats)
+    rest = b.shape[1:]
+    x = np.reshape(b, shape + rest)
+    for i, m in enumerate(mats):
+        x = np.moveaxis(np.tensordot(m, x, axes=(1, i)), 0, i)
+    return np.reshape(x, b.shape)
+
+@extend.primitive
+def _kron_solve(decomp, b, noise, *Ks):
+    return decomp._solve(b)
+
+def _kron_solve_vjp(argnum, ans, args, kwargs):
+    decomp, b, noise, *Ks = args
+    def vjp(g):
+        u = _kron_solve(decomp, g, noise, *Ks)
+        if argnum == 1:
+            return u
+        elif argnum == 2:
+            return -np.sum(u * ans)
+        else:
+            return -decomp._contract(u, ans, argnum - 3, Ks)
+    return vjp
+
+extend.defvjp_argnum(_kron_solve, _kron_solve_vjp)
+
+@extend.primitive
+def _kron_logdet(decomp, noise, *Ks):
+    return decomp._logdet()
+
+def _kron_logdet_vjp(argnum, ans, args, kwargs):
+    decomp = args[0]
+    def vjp(g):
+        if argnum == 1:
+            return g * np.sum(1 / decomp._w)
+        else:
+            return g * decomp._invpartialtrace(argnum - 2)
+    return vjp
+
+extend.defvjp_argnum(_kron_logdet, _kron_logdet_vjp)
+
+class KronDecomp:
+    """
+    Decomposition of the matrix
+    
+    K = Ks[0] ⊗ Ks[1] ⊗ ... + noise * I
+    
+    where the Ks are symmetric positive semidefinite. Each factor is
+    diagonalized separately, so the cost is O(sum n_i^3) instead of
+    O(prod n_i^3). Eigenvalues of K below `eps` are set to `eps`, where `eps`
+    is relative to the largest eigenvalue, like EigCutFullRank. Supports
+    autograd (first derivatives only for `logdet`) both w.r.t. the factors and
+    the noise.
+    """
+    
+    # This is not a subclass of Decomposition because the __init__
+    # signature is different.
+    
+    def __init__(self, Ks, noise=0, eps=None):
+        """
+        Parameters
+        ----------
+        Ks : list of matrices
+            The factors of the kronecker product.
+        noise : scalar
+            Multiple of the identity added to the product.
+        eps : positive float
+            Threshold for small eigenvalues, relative to the maximum one.
+            Default is matrix size * float epsilon.
+        """
+        self._Ks = list(Ks)
+        self._noise = noise
+        self._lambdas = []
+        self._Vs = []
+        for K in self._Ks:
+            w, V = linalg.eigh(noautograd(K), check_finite=False)
+            self._lambdas.append(w)
+            self._Vs.append(V)
+        w = self._lambdas[0]
+        for lam in self._lambdas[1:]:
+            w = _outer(w, lam)
+        w = w + noautograd(noise)
+        if eps is None:
+            eps = w.size * np.finfo(asinexact(w.dtype)).eps
+        assert np.isscalar(eps) and 0 <= eps < 1
+        self._w = np.maximum(w, eps * np.max(w))
+    
+    @property
+    def _VTs(self):
+        return [V.T for V in self._Vs]
+    
+    def _solve(self, b):
+        VTb = _kronmatmul(self._VTs, b)
+        w = self._w.reshape((-1,) + (1,) * (len(b.shape) - 1))
+        return _kronmatmul(self._Vs, VTb / w)
+    
+    def _logdet(self):
+        return np.sum(np.log(self._w))
+    
+    def _contract(self, u, x, i, Ks):
+        """
+        Gradient of u.T @ K @ x w.r.t. Ks[i].
+        """
+        mats = [np.eye(len(K)) if j == i else K for j, K in enumerate(Ks)]
+        Kx = _kronmatmul(mats, x)
+        shape = tuple(len(K) for K in Ks)
+        U = np.reshape(u, shape + u.shape[1:])
+        X = np.reshape(Kx, shape + x.shape[1:])
+        axes = [j for j in range(len(U.shape)) if j != i]
+        return np.tensordot(U, X, axes=(axes, axes))
+    
+    def _invpartialtrace(self, i):
+        """
+        Gradient of log(det(K)) w.r.t. Ks[i].
+        """
+        lam = 1
+        for j, l in enumerate(self._lambdas):
+            lam = _outer(lam, np.ones_like(l) if j == i else l)
+        axes = tuple(j for j in range(len(self._lambdas)) if j != i)
+        c = np.sum(lam / self._w, axis=axes)
+        V = self._Vs[i]
+        return (V * c) @ V.T
+    
+    def solve(self, b):
+        return _kron_solve(self, b, self._noise, *self._Ks)
+    
+    usolve = _solve
+    
+    def quad(self, b):
+        return b.T @ self.solve(b)
+    
+    def logdet(self):
+        return _kron_logdet(self, self._noise, *self._Ks)
+
+_matern_ss_cache = {}
+
+def _matern_ss_unit(p):
+    """
+    State space representation of the Matérn process with nu = p + 1/2, unit
+    variance and rate 1, with state (f, f', ..., f^(p)). Return the feedback
+    matrix F and the stationary covariance of the state.
+    """
+    if p not in _matern_ss_cache:
+        d = p + 1
+        F = numpy.diag(numpy.ones(d - 1), 1)
+        F[-1] = [-special.binom(d, k) for k in range(d)]
+        L = numpy.zeros((d, d))
+        L[-1, -1] = 1
+        P = slinalg_dense.solve_continuous_lyapunov(F, -L)
+        P = (P + P.T) / 2
+        _matern_ss_cache[p] = (F, P / P[0, 0])
+    return _matern_ss_cache[p]
+
+def _matern_ss(dt, var, p, scale):
+    """
+    Transition matrices for the time steps `dt` and stationary covariance of
+    the Matérn process with nu = p + 1/2, variance `var` and length scale
+    `scale`.
+    """
+    F1, P1 = _matern_ss_unit(p)
+    d = p + 1
+    lam = np.sqrt(2 * p + 1) / scale
+    powers = lam ** np.arange(d)
+    Pinf = var * _outer(powers, powers) * P1
+    
+    # F + lam I is nilpotent, so the exponential is a finite sum.
+    D = numpy.diag(numpy.ones(d - 1), 1)
+    N = D + numpy.outer(numpy.arange(d) == d - 1, F1[-1]) * powers[::-1] * lam + lam * numpy.eye(d)
+    term = np.ones_like(dt)[:, None, None] * np.eye(d)
+    A = term
+    for k in range(1, d):
+        term = (dt[:, None, None] / k) * (term @ N)
+        A = A + term
+    A = np.exp(-lam * dt)[:, None, None] * A
+    return A, Pinf
+
+def _block_diag(blocks):
+    """
+    Block diagonal matrix from a list of arrays with shape (..., d_i, d_i).
+    """
+    sizes = [b.shape[-1] for b in blocks]
+    lead = blocks[0].shape[:-2]
+    rows = []
+    for i, b in enumerate(blocks):
+        row = [
+            b if j == i else np.zeros(lead + (sizes[i], size))
+            for j, size in enumerate(sizes)
+        ]
+        rows.append(np.concatenate(row, axis=-1))
+    return np.concatenate(rows, axis=-2)
+
+class KalmanDecomp:
+    """
+    Decomposition of the covariance matrix of a sum of Matérn processes with
+    half-integer nu, evaluated on 1D points, plus a diagonal noise. The
+    process is represented as a linear stochastic differential equation and
+    the Kalman filter computes the innovations, i.e. the data whitened with
+    the inverse of the Cholesky factor. All operations are O(n) in the number
+    of points. Supports autograd both w.r.t. the parameters of the processes
+    and the noise.
+    """
+    
+    # This is not a subclass of Decomposition because the __init__
+    # signature is different.
+    
+    def __init__(self, x, terms, noise=0, eps=None):
+        """
+        Parameters
+        ----------
+        x : 1D array
+            The points, in any order.
+        terms : list of tuples
+            Each tuple is (variance, p, scale) and represents a Matérn kernel
+            with nu = p + 1/2.
+        noise : scalar or 1D array
+            The diagonal of the noise covariance matrix.
+        eps : positive float
+            A jitter added to the diagonal, relative to the total variance of
+            the process. Default is matrix size * float epsilon.
+        """
+        x = noautograd(x)
+        assert len(x.shape) == 1 and len(x) > 0
+        n = len(x)
+        self._perm = numpy.argsort(x, kind='stable')
+        self._iperm = numpy.argsort(self._perm)
+        xs = numpy.asarray(x[self._perm], dtype=asinexact(x.dtype))
+        dt = xs[1:] - xs[:-1]
+        
+        As = []
+        Pinfs = []
+        H = []
+        for var, p, scale in terms:
+            A, Pinf = _matern_ss(dt, var, p, scale)
+            As.append(A)
+            Pinfs.append(Pinf)
+            H += [1] + [0] * p
+        A = _block_diag(As)
+        Pinf = _block_diag(Pinfs)
+        H = numpy.array(H, dtype=float)
+        Q = Pinf - np.einsum('tij,jk,tlk->til', A, Pinf, A)
+        
+        if eps is None:
+            eps = n * np.finfo(xs.dtype).eps
+        assert np.isscalar(eps) and 0 <= eps < 1
+        jitter = eps * sum(var for var, _, _ in terms)
+        R = (noise + np.zeros(n))[self._perm] + jitter
+        
+        ks = []
+        Ss = []
+        P = Pinf
+        for t in range(n):
+            if t > 0:
+                P = A[t - 1] @ P @ A[t - 1].T + Q[t - 1]
+            PH = P @ H
+            S = H @ PH + R[t]
+            k = PH / S
+            P = P - S * _outer(k, k)
+            P = (P + P.T) / 2
+            ks.append(k)
+            Ss.append(S)
+        
+        self._A = A
+        self._H = H
+        self._k = ks
+        self._S = np.stack(Ss)
+    
+    def _whiten(self, b):
+        """
+        Return the innovations of b (in sorted order, 2D).
+        """
+        b = b[self._perm]
+        b = np.reshape(b, (len(b), -1))
+        A, H, k = self._A, self._H, self._k
+        es = [b[0]]
+        s = _outer(k[0], b[0])
+        for t in range(1, len(b)):
+            pred = A[t - 1] @ s
+            e = b[t] - H @ pred
+            s = pred + _outer(k[t], e)
+            es.append(e)
+        return np.stack(es)
+    
+    def _whiten_adjoint(self, z):
+        """
+        Apply the transpose of the whitening to the 2D array z and restore
+        the original order.
+        """
+        A, H, k = self._A, self._H, self._k
+        n = len(z)
+        lam = np.zeros((len(H), z.shape[1]))
+        out = [None] * n
+        for t in reversed(range(n)):
+            out[t] = z[t] + k[t] @ lam
+            if t > 0:
+                lam = A[t - 1].T @ (lam - _outer(H, out[t]))
+        return np.stack(out)[self._iperm]
+    
+    def solve(self, b):
+        e = self._whiten(b)
+        x = self._whiten_adjoint(e / self._S[:, None])
+        return np.reshape(x, b.shape)
+    
+    usolve = solve
+    
+    def quad(self, b):
+        e = self._whiten(b)
+        out = e.T @ (e / self._S[:, None])
+        return np.reshape(out, b.shape[1:] * 2)
+    
+    def logdet(self):
+        return np.sum(np.log(self._S))
+
+@extend.primitive
+def _sparse_solve(decomp, b, values, noise):
+    return decomp._solve(b)
+
+def _sparse_solve_vjp(argnum, ans, args, kwargs):
+    decomp, b, values, noise = args
+    def vjp(g):
+        u = _sparse_solve(decomp, g, values, noise)
+        if argnum == 1:
+            return u
+        elif argnum == 2:
+            prod = u[decomp._rows] * ans[decomp._cols]
+        else:
+            prod = u * ans
+        prod = np.reshape(prod, prod.shape[:1] + (-1,))
+        out = -np.sum(prod, axis=1)
+        return out if np.ndim(noise) or argnum == 2 else np.sum(out)
+    return vjp
+
+extend.defvjp_argnum(_sparse_solve, _sparse_solve_vjp)
+
+@extend.primitive
+def _sparse_logdet(decomp, values, noise):
+    return decomp._logdet()
+
+def _sparse_logdet_vjp(argnum, ans, args, kwargs):
+    decomp, values, noise = args
+    def vjp(g):
+        if argnum == 1:
+            return g * decomp._selectedinv()
+        else:
+            diag = decomp._invdiag()
+            return g * (diag if np.ndim(noise) else np.sum(diag))
+    return vjp
+
+extend.defvjp_argnum(_sparse_logdet, _sparse_logdet_vjp)
+
+class SparseDecomp:
+    """
+    Decomposition of the matrix K + diag(noise) where K is sparse, given as
+    coordinates and values of the nonzero entries (both triangles). Uses the
+    sparse LU decomposition of SuperLU with symmetric ordering. Supports
+    autograd w.r.t. the values and the noise. The gradient of `logdet`
+    requires the entries of the inverse on the sparsity pattern, which are
+    computed solving for blocks of columns of the identity, so it is O(n) times
+    slower than the other operations.
+    """
+    
+    # This is not a subclass of Decomposition because the __init__
+    # signature is different.
+    
+    _chunk = 256 # columns of the identity solved at once by _selectedinv
+    
+    def __init__(self, rows, cols, values, n, noise=0, eps=None):
+        """
+        Parameters
+        ----------
+        rows, cols : 1D int arrays
+            The coordinates of the nonzero entries.
+        values : 1D array
+            The values of the nonzero entries.
+        n : int
+            The size of the matrix.
+        noise : scalar or 1D array
+            Added to the diagonal.
+        eps : positive float
+            A multiple of the identity times the maximum diagonal element is
+            added to the matrix to correct for roundoff. Default is matrix
+            size * float epsilon.
+        """
+        self._rows = numpy.asarray(rows)
+        self._cols = numpy.asarray(cols)
+        self._values = values
+        self._noise = noise
+        self._n = n
+        K = sparse.coo_matrix((noautograd(values), (self._rows, self._cols)), shape=(n, n))
+        K = K.tocsc() # sums duplicates
+        diag = K.diagonal() + noautograd(noise)
+        if eps is None:
+            eps = n * np.finfo(float).eps
+        assert np.isscalar(eps) and 0 <= eps < 1
+        diag = diag + eps * numpy.max(diag)
+        K.setdiag(diag)
+        self._lu = slinalg.splu(
+            K,
+            permc_spec='MMD_AT_PLUS_A',
+            diag_pivot_thresh=0,
+            options=dict(SymmetricMode=True)
+        )
+    
+    def _solve(self, b):
+        b = numpy.asarray(b)
+        x = self._lu.solve(numpy.reshape(b, (len(b), -1)).astype(float))
+        return numpy.reshape(x, b.shape)
+    
+    def _logdet(self):
+        return numpy.sum(numpy.log(numpy.abs(self._lu.U.diagonal())))
+    
+    def _selectedinv(self):
+        """
+        Entries of the inverse at the coordinates of the nonzero entries.
+        """
+        out = numpy.empty(len(self._rows))
+        for start in range(0, self._n, self._chunk):
+            stop = min(start + self._chunk, self._n)
+            I = numpy.zeros((self._n, stop - start))
+            I[numpy.arange(start, stop), numpy.arange(stop - start)] = 1
+            X = self._lu.solve(I)
+            sel = (self._cols >= start) & (self._cols < stop)
+            out[sel] = X[self._rows[sel], self._cols[sel] - start]
+        return out
+    
+    def _invdiag(self):
+        out = numpy.empty(self._n)
+        for start in range(0, self._n, self._chunk):
+            stop = min(start + self._chunk, self._n)
+            I = numpy.zeros((self._n, stop - start))
+            I[numpy.arange(start, stop), numpy.arange(stop - start)] = 1
+            X = self._lu.solve(I)
+            out[start:stop] = X[numpy.arange(start, stop), numpy.arange(stop - start)]
+        return out
+    
+    def solve(self, b):
+        return _sparse_solve(self, b, self._values, self._noise)
+    
+    def usolve(self, b):
+        if b.dtype == object:
+            # arrays of gvars can not go through SuperLU
+            return self._solve(numpy.eye(self._n)) @ b
+        return self._solve(b)
+    
+    def quad(self, b):
+        return b.T @ self.solve(b)
+    
+    def logdet(self):
+        return _sparse_logdet(self, self._values, self._noise)
+
+def _fftconvolve(a, b, n):
+    """
+    First n elements of the convolution of a with the columns of b, where
+    a is 1D and b is 1D or 2D with len(b) == n.
+    """
+    size = 1 << (2 * n - 1).bit_length()
+    fa = numpy.fft.rfft(a, size)
+    fb = numpy.fft.rfft(b, size, axis=0)
+    fa = fa.reshape(fa.shape + (1,) * (len(b.shape) - 1))
+    return numpy.fft.irfft(fa * fb, size, axis=0)[:n]
+
+def _fftcorrelate(u, x):
+    """
+    c[k] = sum_i u[i] x[i + k] summed over columns, for u, x 1D or 2D with
+    the same shape.
+    """
+    n = len(u)
+    size = 1 << (2 * n - 1).bit_length()
+    fu = numpy.fft.rfft(u, size, axis=0)
+    fx = numpy.fft.rfft(x, size, axis=0)
+    c = numpy.fft.irfft(numpy.conj(fu) * fx, size, axis=0)[:n]
+    return numpy.reshape(c, (n, -1)).sum(axis=1)
+
+def toeplitz_matvec(t, b):
+    """
+    Compute T @ b where T is the symmetric Toeplitz matrix with first row t,
+    embedding T in a circulant matrix and using the FFT. O(n log n).
+    """
+    n = len(t)
+    c = numpy.concatenate([t, t[-1:0:-1]]) # first column of the circulant
+    size = len(c)
+    fc = numpy.fft.rfft(c)
+    fb = numpy.fft.rfft(b, size, axis=0)
+    fc = fc.reshape(fc.shape + (1,) * (len(b.shape) - 1))
+    return numpy.fft.irfft(fc * fb, size, axis=0)[:n]
+
+@extend.primitive
+def _toeplitz_solve(decomp, b, t):
+    return decomp._solve(b)
+
+def _toeplitz_solve_vjp(ans, decomp, b, t):
+    def vjp(g):
+        u = _toeplitz_solve(decomp, g, t)
+        c = _fftcorrelate(u, ans) + _fftcorrelate(ans, u)
+        c[0] /= 2
+        return -c
+    return vjp
+
+extend.defvjp(
+    _toeplitz_solve,
+    lambda ans, decomp, b, t: lambda g: _toeplitz_solve(decomp, g, t),
+    _toeplitz_solve_vjp,
+    argnums=[1, 2]
+)
+
+@extend.primitive
+def _toeplitz_logdet(decomp, t):
+    return decomp._logdet
+
+extend.defvjp(
+    _toeplitz_logdet,
+    lambda ans, decomp, t: lambda g: g * decomp._invdiagsums(),
+    argnums=[1]
+)
+
+class ToeplitzDecomp:
+    """
+    Decomposition of a symmetric positive definite Toeplitz matrix, i.e. the
+    covariance matrix of a stationary process on equispaced points. The
+    Levinson-Durbin recursion computes the determinant and the first column
+    of the inverse in O(n^2); then the inverse is applied with the
+    Gohberg-Semencul formula, which requires only products with triangular
+    Toeplitz matrices done with the FFT in O(n log n), followed by a step of
+    iterative refinement with the product by the matrix done with circulant
+    embedding. Supports autograd w.r.t. the first row of the matrix.
+    """
+    
+    # This is not a subclass of Decomposition because the __init__
+    # signature is different.
+    
+    def __init__(self, t, eps=None):
+        """
+        Parameters
+        ----------
+        t : 1D array
+            The first row of the matrix.
+        eps : positive float
+            A multiple of the identity times t[0] is added to the matrix to
+            correct for roundoff. Default is matrix size * float epsilon.
+        """
+        self._t = t
+        tval = numpy.array(noautograd(t), dtype=float)
+        n = len(tval)
+        if eps is None:
+            eps = n * np.finfo(float).eps
+        assert np.isscalar(eps) and 0 <= eps < 1
+        tval[0] += eps * tval[0]
+        
+        a = numpy.ones(1)
+        E = tval[0]
+        logdet = numpy.log(E)
+        for k in range(1, n):
+            lam = -(a @ tval[k:0:-1]) / E
+            a = numpy.concatenate([a, [0]]) + lam * numpy.concatenate([[0], a[::-1]])
+            E = E * (1 - lam ** 2)
+            if not E > 0:
+                raise numpy.linalg.LinAlgError('Toeplitz matrix is not positive definite')
+            logdet += numpy.log(E)
+        
+        self._tval = tval
+        self._x = a / E # first column of the inverse
+        self._logdet = logdet
+    
+    def _solve(self, b):
+        # The Gohberg-Semencul formula loses accuracy when the matrix is
+        # ill-conditioned, so do one step of iterative refinement.
+        b = numpy.asarray(b, dtype=float)
+        x = self._gssolve(b)
+        return x + self._gssolve(b - toeplitz_matvec(self._tval, x))
+    
+    def _gssolve(self, b):
+        # inv(T) = (A @ A.T - B @ B.T) / x[0], where A and B are lower
+        # triangular Toeplitz with first columns x and [0, x[:0:-1]]
+        n = len(b)
+        x = self._x
+        y = numpy.concatenate([[0], x[:0:-1]])
+        ATb = _fftconvolve(x, b[::-1], n)[::-1]
+        BTb = _fftconvolve(y, b[::-1], n)[::-1]
+        return (_fftconvolve(x, ATb, n) - _fftconvolve(y, BTb, n)) / x[0]
+    
+    def _invdiagsums(self):
+        """
+        Sums of the diagonals of the inverse, doubled for the off-diagonal
+        ones, i.e. the gradient of the logdet w.r.t. the first row.
+        """
+        x = self._x
+        y = numpy.concatenate([[0], x[:0:-1]])
+        n = len(x)
+        p = numpy.arange(n)
+        def diagsums(a):
+            # sum_p a[p] a[p + k] (n - k - p)
+            return (n - p) * _fftcorrelate(a, a) - _fftcorrelate(p * a, a)
+        out = (diagsums(x) - diagsums(y)) / x[0]
+        out[1:] *= 2
+        return out
+    
+    def solve(self, b):
+        return _toeplitz_solve(self, b, self._t)
+    
+    def usolve(self, b):
+        if b.dtype == object:
+            # arrays of gvars can not go through the FFT
+            return self._solve(numpy.eye(len(b))) @ b
+        return self._solve(b)
+    
+    def quad(self, b):
+        return b.T @ self.solve(b)
+    
+    def logdet(self):
+        return _toeplitz_logdet(self, self._t)
+
+class DiagLowRank:
+    """
+    Decomposition of a positive diagonal matrix plus a low rank positive
+    semidefinite matrix, diag(d) + U @ U.T, using the Woodbury matrix
+    identity and the matrix determinant lemma. If U is n x m, all operations
+    are O(n m^2) instead of O(n^3). Supports autograd w.r.t. `d` and `U`.
+    
+    Reference: Gaussian Processes for Machine Learning, A.3, p. 201.
+    """
+    
+    # This is not a subclass of Decomposition because the __init__
+    # signature is different.
+    
+    def __init__(self, d, U):
+        """
+        Parameters
+        ----------
+        d : 1D array
+            The diagonal, must be positive.
+        U : 2D array
+            The factor of the low rank part.
+        """
+        assert len(d.shape) == 1 and U.shape[0] == len(d)
+        self._d = d
+        self._U = U
+        self._DiU = U / d[:, None]
+        B = np.eye(U.shape[1]) + U.T @ self._DiU
+        self._L = np.linalg.cholesky(B)
+    
+    def _Dinv(self, b):
+        d = self._d.reshape(self._d.shape + (1,) * (len(b.shape) - 1))
+        return b / d
+    
+    def _invL(self, UTb):
+        return linalg.solve_triangular(self._L, UTb, lower=True)
+    
+    def solve(self, b):
+        invLUTDib = self._invL(self._DiU.T @ b)
+        return self._Dinv(b) - self._DiU @ linalg.solve_triangular(self._L.T, invLUTDib, lower=False)
+    
+    def usolve(self, b):
+        # b may contain gvars, so invert the small matrix explicitly
+        L = noautograd(self._L)
+        DiU = noautograd(self._DiU)
+        invL = slinalg_dense.solve_triangular(L, numpy.eye(len(L)), lower=True)
+        return self._Dinv(b) - DiU @ (invL.T @ (invL @ (DiU.T @ b)))
+    
+    def quad(self, b):
+        invLUTDib = self._invL(self._DiU.T @ b)
+        return b.T @ self._Dinv(b) - invLUTDib.T @ invLUTDib
+    
+    def logdet(self):
+        return np.sum(np.log(self._d)) + 2 * np.sum(np.log(np.diag(self._L)))
+
+class BatchEigCutFullRank:
+    """
+    Diagonalization of a stack of matrices, with the matrices along the last
+    two axes. Like EigCutFullRank, eigenvalues below `eps` relative to the
+    largest eigenvalue of each matrix are set to `eps`. The methods operate
+    on a stack of vectors with the same leading axes and return the results
+    for each matrix. Supports autograd w.r.t. the matrices.
+    """
+    
+    # This is not a subclass of Decomposition because it works with stacks
+    # of matrices.
+    
+    def __init__(self, K, eps=None):
+        assert len(K.shape) >= 2 and K.shape[-1] == K.shape[-2]
+        w, self._V = np.linalg.eigh(K)
+        if eps is None:
+            eps = K.shape[-1] * np.finfo(asinexact(K.dtype)).eps
+        assert np.isscalar(eps) and 0 <= eps < 1
+        cut = eps * w[..., -1:] # w is sorted ascending
+        self._w = np.where(w < cut, cut, w)
+    
+    def _VT(self, b):
+        return (np.swapaxes(self._V, -1, -2) @ b[..., None])[..., 0]
+    
+    def solve(self, b):
+        return (self._V @ (self._VT(b) / self._w)[..., None])[..., 0]
+    
+    def quad(self, b):
+        return np.sum(self._VT(b) ** 2 / self._w, axis=-1)
+    
+    def logdet(self):
+        return np.sum(np.log(self._w), axis=-1)
+
+class GenEig:
+    """
+    Generalized diagonalization of the pair of matrices (K, D), where K is
+    positive semidefinite and D positive definite: K V = D V diag(w) with
+    V.T @ D @ V = I. The decomposition of K + s D for any scalar s >= 0 is
+    then obtained with `shift` in O(n^2) instead of O(n^3). Like
+    EigCutFullRank, eigenvalues below `eps` relative to the largest are set
+    to `eps`. D can be a scalar, meaning D times the identity.
+    """
+    
+    # This is not a subclass of Decomposition because it does not decompose
+    # a single matrix.
+    
+    def __init__(self, K, D, eps=None):
+        if np.isscalar(D) or not np.shape(D):
+            assert D > 0
+            w, V = slinalg_dense.eigh(K, check_finite=False)
+            w = w / D
+            V = V / np.sqrt(D)
+            self._logdetD = len(K) * np.log(D)
+        else:
+            w, V = slinalg_dense.eigh(K, D, check_finite=False)
+            self._logdetD = numpy.linalg.slogdet(D)[1]
+        if eps is None:
+            eps = len(w) * np.finfo(asinexact(w.dtype)).eps
+        assert np.isscalar(eps) and 0 <= eps < 1
+        cut = eps * w[-1] # w is sorted ascending
+        w[w < cut] = cut
+        self._w = w
+        self._V = V
+    
+    def shift(self, s):
+        """
+        Return a decomposition of K + s D. The decomposition supports
+        autograd w.r.t. `s`.
+        """
+        return ShiftedGenEig(self, s)
+
+class ShiftedGenEig:
+    """
+    Decomposition of K + s D, see GenEig.shift. Since K + s D =
+    inv(V.T) @ diag(w + s) @ inv(V), the inverse is V @ diag(1 / (w + s)) @
+    V.T.
+    """
+    
+    # This is not a subclass of Decomposition because the __init__ signature
+    # is different.
+    
+    def __init__(self, geneig, s):
+        self._V = geneig._V
+        self._d = geneig._w + s
+        self._logdetD = geneig._logdetD
+    
+    def _scale(self, VTb):
+        if len(VTb.shape) == 1:
+            return VTb / self._d
+        else:
+            return VTb / self._d[:, None]
+    
+    def solve(self, b):
+        return self._V @ self._scale(self._V.T @ b)
+    
+    usolve = solve
+    
+    def quad(self, b):
+        VTb = self._V.T @ b
+        return VTb.T @ self._scale(VTb)
+    
+    def logdet(self):
+        return self._logdetD + np.sum(np.log(self._d))
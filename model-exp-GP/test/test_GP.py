@@ -0,0 +1,567 @@
+from __future__ import division
+
+import sys
+import io
+
+import numpy as np
+import autograd
+from scipy import linalg
+import gvar
+import pytest
+
+sys.path = ['.'] + sys.path
+import lsqfitgp2 as lgp
+from lsqfitgp2 import _linalg
+
+def randpos(n):
+    A = np.random.randn(n, n)
+    return A.T @ A + np.eye(n)
+
+def test_blockdecomp():
+    K = randpos(12)
+    b = np.random.randn(12, 2)
+    P = _linalg.Diag(K[:5, :5])
+    decomp = _linalg.BlockDecomp(P, K[5:8, 5:8], K[:5, 5:8], _linalg.Diag)
+    decomp = _linalg.BlockDecomp(decomp, K[8:, 8:], K[:8, 8:], _linalg.Chol)
+    assert np.allclose(decomp.solve(b), linalg.solve(K, b))
+    assert np.allclose(decomp.quad(b), b.T @ linalg.solve(K, b))
+    assert np.allclose(decomp.logdet(), np.linalg.slogdet(K)[1])
+
+def test_addx_after_prior():
+    gp = lgp.GP(lgp.ExpQuad(scale=3))
+    x1 = np.linspace(0, 10, 10)
+    x2 = np.linspace(5, 15, 7)
+    gp.addx(x1, 'a')
+    pa = gp.prior('a')
+    gp.addx(x2, 'b')
+    prior = gp.prior()
+    assert prior['a'] is not pa
+    assert np.all(prior['a'] == pa)
+    cov1 = gvar.evalcov(prior.buf)
+    
+    gp2 = lgp.GP(lgp.ExpQuad(scale=3))
+    gp2.addx({'a': x1, 'b': x2})
+    cov2 = gvar.evalcov(gp2.prior().buf)
+    assert np.allclose(cov1, cov2)
+
+def test_pred_incremental():
+    x1 = np.linspace(0, 10, 20)
+    x2 = np.linspace(10.5, 12, 3)
+    xpred = np.linspace(0, 15, 8)
+    y1 = gvar.gvar(np.sin(x1), np.full(len(x1), 0.1))
+    y2 = gvar.gvar(np.sin(x2), np.full(len(x2), 0.1))
+    
+    gp = lgp.GP(lgp.ExpQuad(scale=2), incremental=True)
+    gp.addx(x1, 'day1')
+    gp.addx(xpred, 'pred')
+    gp.predfromdata({'day1': y1}, 'pred', raw=True)
+    gp.addx(x2, 'day2')
+    given = {'day1': y1, 'day2': y2}
+    m1, c1 = gp.predfromdata(given, 'pred', raw=True)
+    assert gp.cache_info()['updates'] == 1
+    ml1 = gp.marginal_likelihood(given)
+    
+    gp2 = lgp.GP(lgp.ExpQuad(scale=2))
+    gp2.addx({'day1': x1, 'day2': x2, 'pred': xpred})
+    m2, c2 = gp2.predfromdata(given, 'pred', raw=True)
+    ml2 = gp2.marginal_likelihood(given)
+    assert np.allclose(m1, m2)
+    assert np.allclose(c1, c2)
+    assert np.allclose(ml1, ml2)
+
+def test_solver_cache_order():
+    # without incremental=True, the result does not depend on the cache
+    x1 = np.linspace(0, 10, 20)
+    x2 = np.linspace(10.5, 12, 3)
+    y = np.sin(np.concatenate([x1, x2]))
+    given = {'day1': y[:len(x1)], 'day2': y[len(x1):]}
+    results = []
+    for warmup in [False, True]:
+        gp = lgp.GP(lgp.ExpQuad(scale=2))
+        gp.addx({'day1': x1, 'day2': x2})
+        if warmup:
+            gp.marginal_likelihood({'day1': given['day1']})
+        results.append(gp.marginal_likelihood(given))
+        assert gp.cache_info()['updates'] == 0
+    assert results[0] == results[1]
+
+def test_solver_cache_autograd():
+    # a data covariance matrix which depends on the parameters is not cached
+    x = np.linspace(0, 10, 10)
+    y = np.sin(x)
+    ycov = np.diag(np.linspace(0.1, 0.2, len(x)))
+    gp = lgp.GP(lgp.ExpQuad(scale=2))
+    gp.addx(x, 'data')
+    gp.marginal_likelihood({'data': y}, {('data', 'data'): ycov})
+    fun = lambda s: gp.marginal_likelihood({'data': y}, {('data', 'data'): s * ycov})
+    eps = 1e-6
+    grad = (fun(1 + eps) - fun(1 - eps)) / (2 * eps)
+    assert np.allclose(autograd.grad(fun)(1.), grad, rtol=1e-4)
+
+def test_solver_cache():
+    x = np.linspace(0, 10, 10)
+    y = gvar.gvar(np.sin(x), np.full(len(x), 0.1))
+    gp = lgp.GP(lgp.ExpQuad(scale=2), cachesize=2)
+    gp.addx(x, 'data')
+    gp.addx(x + 0.5, 'pred')
+    out1 = gp.predfromfit({'data': y}, 'pred')
+    out2 = gp.predfromfit({'data': y}, 'pred')
+    assert np.all(gvar.mean(out1) == gvar.mean(out2))
+    info = gp.cache_info()
+    assert info['hits'] == 1 and info['misses'] == 1
+    
+    for i in range(3):
+        gp.marginal_likelihood({'data': gvar.mean(y)}, {('data', 'data'): (i + 1) * np.eye(len(x))})
+    info = gp.cache_info()
+    assert info['size'] == 2 and info['misses'] == 4
+    
+    gp.cache_clear()
+    assert gp.cache_info() == dict(size=0, maxsize=2, hits=0, misses=0, updates=0)
+
+def test_pred_diagonal():
+    x = np.linspace(0, 10, 15)
+    xpred = np.linspace(-2, 12, 30)
+    y = gvar.gvar(np.sin(x), np.full(len(x), 0.1))
+    gp = lgp.GP(lgp.ExpQuad(scale=2))
+    gp._predchunk = 7
+    gp.addx(x, 'data')
+    gp.addx(xpred, 'pred')
+    gp.addtransf({'pred': 2 * np.eye(len(xpred))}, 'double')
+    for fromdata in [False, True]:
+        m1, c1 = gp.pred({'data': y}, ['pred', 'double'], fromdata=fromdata, raw=True)
+        m2, v2 = gp.pred({'data': y}, ['pred', 'double'], fromdata=fromdata, raw=True, diagonal=True)
+        for key in ['pred', 'double']:
+            assert np.allclose(m1[key], m2[key])
+            assert np.allclose(np.diag(c1[key, key]), v2[key])
+        out = gp.pred({'data': y}, 'pred', fromdata=fromdata, diagonal=True)
+        assert np.allclose(gvar.sdev(out), np.sqrt(v2['pred']))
+
+def test_pred_keepcorr():
+    x = np.linspace(0, 10, 15)
+    xpred = np.linspace(-2, 12, 20)
+    y = gvar.gvar(np.sin(x), np.full(len(x), 0.1))
+    for fromdata in [False, True]:
+        gp = lgp.GP(lgp.Matern32(scale=2), solver='gersh')
+        gp.addx(x, 'data')
+        gp.addx(xpred, 'pred')
+        out = gp.pred({'data': y}, 'pred', fromdata=fromdata)
+        
+        # the old implementation with arrays of gvars
+        yp = gp.prior('data')
+        ysp = gp.prior('pred')
+        Kxsx = gp.prior(['pred', 'data'], raw=True)['pred', 'data']
+        ycov = gvar.evalcov(y) if fromdata else 0
+        expected = Kxsx @ gp._solver(['data'], ycov).usolve(y - yp) + ysp
+        
+        cov1 = gvar.evalcov(np.concatenate([out, y, yp]))
+        cov2 = gvar.evalcov(np.concatenate([expected, y, yp]))
+        assert np.allclose(gvar.mean(out), gvar.mean(expected))
+        assert np.allclose(cov1, cov2)
+
+def test_lazy_prior():
+    gp = lgp.GP(lgp.ExpQuad(scale=3))
+    gp.addx({'a': np.linspace(0, 5, 6), 'b': np.linspace(3, 9, 8), 'c': np.linspace(-3, 1, 4)})
+    pb = gp.prior('b')
+    assert 'a' not in gp._priordict
+    pa = gp.prior('a')
+    assert 'c' not in gp._priordict
+    prior = gp.prior()
+    assert np.all(prior['b'] == pb)
+    cov1 = gvar.evalcov(prior.buf)
+    cov2 = np.block([[gp.prior([r, c], raw=True)[r, c] for c in 'abc'] for r in 'abc'])
+    assert np.allclose(cov1, cov2)
+
+def batchgp():
+    gp = lgp.GP(lgp.ExpQuad(scale=3))
+    gp.addx(np.linspace(0, 10, 15), 'a')
+    gp.addx(np.linspace(0, 10, 4), 'b')
+    return gp
+
+def test_marginal_likelihood_batch():
+    gp = batchgp()
+    y = np.random.randn(3, 2, 15)
+    ml = gp.marginal_likelihood({'a': y}, {('a', 'a'): 0.1 * np.eye(15)})
+    assert ml.shape == (3, 2)
+    for i in np.ndindex(*ml.shape):
+        ml1 = gp.marginal_likelihood({'a': y[i]}, {('a', 'a'): 0.1 * np.eye(15)})
+        assert np.allclose(ml[i], ml1)
+    
+    # different covariance matrix for each dataset
+    noise = np.random.uniform(0.1, 1, size=(3, 2, 1, 1)) * np.eye(15)
+    ml = gp.marginal_likelihood({'a': y}, {('a', 'a'): noise})
+    assert ml.shape == (3, 2)
+    for i in np.ndindex(*ml.shape):
+        ml1 = gp.marginal_likelihood({'a': y[i]}, {('a', 'a'): noise[i]})
+        assert np.allclose(ml[i], ml1)
+    
+    # the same with gvars
+    ygvar = gvar.gvar(y, np.sqrt(np.diagonal(noise, axis1=-2, axis2=-1)))
+    ml2 = gp.marginal_likelihood({'a': ygvar})
+    assert np.allclose(ml, ml2)
+
+def test_pred_batch():
+    gp = batchgp()
+    y = gvar.gvar(np.random.randn(4, 15), np.full((4, 15), 0.3))
+    mean, cov = gp.predfromdata({'a': y}, 'b', raw=True)
+    assert mean.shape == (4, 4)
+    for i in range(len(y)):
+        mean1, cov1 = gp.predfromdata({'a': y[i]}, 'b', raw=True)
+        assert np.allclose(mean[i], mean1)
+        assert np.allclose(cov, cov1)
+    mean2, var2 = gp.predfromdata({'a': y}, 'b', raw=True, diagonal=True)
+    assert np.allclose(mean2, mean)
+    assert np.allclose(var2, np.diag(cov))
+    post = gp.predfromdata({'a': y}, ['b'], keepcorr=False)
+    assert post['b'].shape == (4, 4)
+    assert np.allclose(gvar.mean(post['b']), mean)
+
+def test_distcache():
+    x = np.linspace(0, 10, 20)
+    cache = lgp.DistanceCache()
+    def makegp(scale, distcache):
+        kernel = lgp.ExpQuad(scale=scale) + lgp.Matern32(scale=2 * scale)
+        gp = lgp.GP(kernel, distcache=distcache)
+        gp.addx(x, 'a')
+        gp.addx(x, 'b', deriv=1)
+        return gp
+    for scale in [1, 2, 3]:
+        cov1 = makegp(scale, cache).prior(raw=True)
+        cov2 = makegp(scale, None).prior(raw=True)
+        for k in cov1:
+            assert np.allclose(cov1[k], cov2[k])
+    # only the block ('a', 'a') is cached and the distance is shared by the
+    # two kernels
+    assert cache.misses == 1
+    assert cache.hits == 5
+    
+    # changing the points invalidates the cache
+    x[0] = -1
+    cov1 = makegp(1, cache).prior('a', raw=True)
+    cov2 = makegp(1, None).prior('a', raw=True)
+    assert np.allclose(cov1, cov2)
+    assert cache.misses == 2
+
+def test_distcache_forcekron():
+    x = np.empty(15, dtype=[('a', float), ('b', float)])
+    x['a'] = np.linspace(0, 10, len(x))
+    x['b'] = np.cos(x['a'])
+    cache = lgp.DistanceCache()
+    def makegp(distcache):
+        kernel = lgp.ExpQuad() + lgp.ExpQuad(scale=2, forcekron=True)
+        gp = lgp.GP(kernel, distcache=distcache)
+        gp.addx(x, 'x')
+        return gp
+    for _ in range(2):
+        cov1 = makegp(cache).prior('x', raw=True)
+        cov2 = makegp(None).prior('x', raw=True)
+        assert np.allclose(cov1, cov2)
+
+def test_distcache_transf():
+    # a kernel which calls an isotropic kernel on transformed points must not
+    # read the distances of the original points
+    x = np.linspace(0, 2, 10)
+    inner = lgp.ExpQuad()
+    kernel = lgp.ExpQuad() + lgp.Kernel(lambda x, y: inner(x ** 2, y ** 2))
+    cache = lgp.DistanceCache()
+    for _ in range(2):
+        gp = lgp.GP(kernel, distcache=cache)
+        gp.addx(x, 'x')
+        cov1 = gp.prior('x', raw=True)
+        gp = lgp.GP(kernel)
+        gp.addx(x, 'x')
+        cov2 = gp.prior('x', raw=True)
+        assert np.allclose(cov1, cov2)
+    assert cache.misses == 2
+    assert cache.hits == 2
+
+def test_noisescale():
+    x = np.linspace(0, 10, 30)
+    y = np.sin(x)
+    ycov = np.diag(np.random.uniform(0.01, 0.05, len(x)))
+    gp = lgp.GP(lgp.ExpQuad(scale=2))
+    gp.addx(x, 'data')
+    gp.addx(np.linspace(-1, 11, 7), 'pred')
+    for s in [0.5, 1, 3]:
+        m1 = gp.marginal_likelihood({'data': y}, {('data', 'data'): ycov}, noisescale=s)
+        m2 = gp.marginal_likelihood({'data': y}, {('data', 'data'): s * ycov})
+        assert np.allclose(m1, m2)
+        p1 = gp.predfromdata({'data': y}, 'pred', {('data', 'data'): ycov}, raw=True, noisescale=s)
+        p2 = gp.predfromdata({'data': y}, 'pred', {('data', 'data'): s * ycov}, raw=True)
+        for a1, a2 in zip(p1, p2):
+            assert np.allclose(a1, a2, atol=1e-8)
+    # the generalized diagonalization is computed only once
+    gp.cache_clear()
+    for s in [0.5, 1, 3]:
+        gp.marginal_likelihood({'data': y}, {('data', 'data'): ycov}, noisescale=s)
+    assert gp.cache_info()['misses'] == 1
+    
+    fun = lambda s: gp.marginal_likelihood({'data': y}, {('data', 'data'): ycov}, noisescale=s)
+    funref = lambda s: gp.marginal_likelihood({'data': y}, {('data', 'data'): s * ycov})
+    for op in autograd.grad, autograd.hessian:
+        assert np.allclose(op(fun)(1.5), op(funref)(1.5))
+
+def test_amplitude_batch():
+    # a different prior amplitude for each dataset, sharing the
+    # diagonalization
+    x = np.linspace(0, 10, 30)
+    y = np.random.randn(4, len(x))
+    ycov = np.diag(np.random.uniform(0.01, 0.05, len(x)))
+    amplitude = np.array([0.5, 1, 2, 3])
+    gp = lgp.GP(lgp.ExpQuad(scale=2))
+    gp.addx(x, 'data')
+    ml = gp.marginal_likelihood({'data': y}, {('data', 'data'): ycov}, noisescale=2, amplitude=amplitude)
+    assert ml.shape == (4,)
+    assert gp.cache_info()['misses'] == 1
+    for i, a in enumerate(amplitude):
+        gp1 = lgp.GP(a * lgp.ExpQuad(scale=2))
+        gp1.addx(x, 'data')
+        ml1 = gp1.marginal_likelihood({'data': y[i]}, {('data', 'data'): 2 * ycov})
+        assert np.allclose(ml[i], ml1)
+    
+    # the same with a covariance matrix for each dataset
+    ml2 = gp.marginal_likelihood({'data': y}, {('data', 'data'): np.stack([ycov] * 4)}, noisescale=2, amplitude=amplitude)
+    assert np.allclose(ml, ml2)
+    
+    fun = lambda a: np.sum(gp.marginal_likelihood({'data': y}, {('data', 'data'): ycov}, amplitude=a))
+    funref = lambda a: np.sum(gp.marginal_likelihood({'data': y}, {('data', 'data'): np.stack([ycov] * 4)}, amplitude=a))
+    assert np.allclose(autograd.grad(fun)(amplitude), autograd.grad(funref)(amplitude))
+
+def test_solver_info():
+    x = np.linspace(0, 10, 50)
+    gp = lgp.GP(lgp.ExpQuad(), solver='auto')
+    gp.addx(x, 'data')
+    gp.marginal_likelihood({'data': np.zeros(len(x))})
+    gp.marginal_likelihood({'data': gvar.gvar(np.zeros(len(x)), np.ones(len(x)))})
+    assert gp.solver_info() == dict(chol=1, eigcut=1)
+
+def test_checklevel():
+    x = np.linspace(0, 10, 30)
+    y = np.linspace(0.5, 9.5, 7)
+    preds = []
+    for level in ['full', 'probabilistic', 'off']:
+        gp = lgp.GP(lgp.ExpQuad(scale=3), checklevel=level)
+        gp.addx(x, 'x')
+        gp.addx(y, 'y')
+        gp.addx(y, 'dy', deriv=1)
+        preds.append(gp.predfromdata({'x': np.sin(x)}, ['y', 'dy'], raw=True))
+        gp.prior()
+    for mean, cov in preds[1:]:
+        for key in ['y', 'dy']:
+            assert np.allclose(mean[key], preds[0][0][key])
+        assert np.allclose(cov['y', 'dy'], preds[0][1]['y', 'dy'])
+    
+    asym = lgp.Kernel(lambda x, y: np.exp(-(x - y) ** 2) * (1 + np.sin(x) / 2))
+    for level in ['full', 'probabilistic']:
+        gp = lgp.GP(asym, checklevel=level)
+        gp.addx(x, 'x')
+        with pytest.raises(RuntimeError):
+            gp.prior()
+        gp = lgp.GP(lgp.ExpQuad() + asym, checklevel=level)
+        gp.addx(x, 'x')
+        gp.addx(y, 'y')
+        with pytest.raises(RuntimeError):
+            gp.prior('y', raw=True)['y', 'x']
+    gp = lgp.GP(asym, checklevel='off')
+    gp.addx(x, 'x')
+    gp.prior(raw=True)
+    
+    notpos = lgp.Kernel(lambda x, y: -(x - y) ** 2)
+    for level in ['full', 'probabilistic']:
+        gp = lgp.GP(notpos, checklevel=level)
+        gp.addx(x, 'x')
+        with pytest.raises(ValueError):
+            gp.prior()
+    
+    with pytest.raises(ValueError):
+        lgp.GP(lgp.ExpQuad(), checklevel='sometimes')
+
+def test_posterior():
+    x = np.linspace(0, 10, 20)
+    xs = np.linspace(-1, 11, 15)
+    y = gvar.gvar(np.sin(x), 0.1 * np.ones(len(x)))
+    gp = lgp.GP(lgp.ExpQuad(scale=3))
+    gp.addx(x, 'x')
+    gp.addx(xs, 'xs')
+    gp.addx(xs, 'dxs', deriv=1)
+    fit = gp.predfromdata({'x': y}, 'x')
+    for given, fromdata in [(y, True), (fit, False)]:
+        mean, cov = gp.pred({'x': given}, ['xs', 'dxs'], fromdata=fromdata, raw=True)
+        post = gp.posterior({'x': given}, fromdata=fromdata, hyperparams={'scale': 3})
+        file = io.BytesIO()
+        post.save(file)
+        file.seek(0)
+        post2 = lgp.Posterior.load(file, lambda hp: lgp.ExpQuad(scale=hp['scale']))
+        assert post2.hyperparams == {'scale': 3}
+        for p in [post, post2]:
+            for key, deriv in [('xs', 0), ('dxs', 1)]:
+                m, c = p.pred(xs, deriv=deriv, raw=True)
+                assert np.allclose(m, mean[key])
+                assert np.allclose(c, cov[key, key], atol=1e-6)
+
+def test_posterior_structured():
+    x = np.empty((5, 4), dtype=[('a', float), ('b', float)])
+    x['a'] = np.arange(5)[:, None]
+    x['b'] = np.arange(4)[None, :]
+    xs = np.empty(7, dtype=x.dtype)
+    xs['a'] = np.linspace(0, 4, 7)
+    xs['b'] = 1.5
+    kernel = lgp.ExpQuad(dim='a') * lgp.ExpQuad(dim='b')
+    gp = lgp.GP(kernel)
+    gp.addx(x, 'x', deriv='b')
+    gp.addx(xs, 'xs')
+    y = np.cos(x['a']) * np.sin(x['b'])
+    mean, cov = gp.predfromdata({'x': y}, 'xs', raw=True)
+    file = io.BytesIO()
+    gp.posterior({'x': y}, fromdata=True).save(file)
+    file.seek(0)
+    m, c = lgp.Posterior.load(file, kernel).pred(xs, raw=True)
+    assert np.allclose(m, mean)
+    assert np.allclose(c, cov, atol=1e-6)
+
+def test_predictor():
+    x = np.linspace(0, 10, 20)
+    xs = np.linspace(-1, 11, 600)
+    y = gvar.gvar(np.sin(x), 0.1 * np.ones(len(x)))
+    gp = lgp.GP(lgp.ExpQuad(scale=3))
+    gp.addx(x, 'x')
+    post = gp.predfromdata({'x': y}, predictor=True)
+    gp.addx(xs, 'xs')
+    mean, cov = gp.predfromdata({'x': y}, 'xs', raw=True)
+    m, c = post.pred(xs, raw=True)
+    assert np.allclose(m, mean)
+    assert np.allclose(c, cov, atol=1e-6)
+    m, v = post.pred(xs, raw=True, diagonal=True)
+    assert np.allclose(m, mean)
+    assert np.allclose(v, np.diag(cov), atol=1e-6)
+    out = post.pred(xs.reshape(20, 30), diagonal=True)
+    assert out.shape == (20, 30)
+    assert np.allclose(gvar.sdev(out).reshape(-1), np.sqrt(v))
+    
+    post = gp.predfromdata({'x': y}, predictor=True, noisescale=4)
+    mean, cov = gp.predfromdata({'x': y}, 'xs', raw=True, noisescale=4)
+    m, c = post.pred(xs, raw=True)
+    assert np.allclose(m, mean)
+    assert np.allclose(c, cov, atol=1e-6)
+    
+    with pytest.raises(ValueError):
+        gp.predfromdata({'x': y}, 'xs', predictor=True)
+
+def test_predictor_keepcorr():
+    x = np.linspace(0, 10, 15)
+    xs = np.linspace(-2, 12, 20)
+    y = gvar.gvar(np.sin(x), np.full(len(x), 0.1))
+    y = y + gvar.gvar(0, 0.1) # correlate the data
+    for fromdata in [False, True]:
+        gp = lgp.GP(lgp.Matern32(scale=2), solver='gersh')
+        gp.addx(x, 'x')
+        gp.addx(xs, 'xs')
+        expected = gp.pred({'x': y}, 'xs', fromdata=fromdata)
+        post = gp.pred({'x': y}, fromdata=fromdata, predictor=True)
+        out = post.pred(xs)
+        cov1 = gvar.evalcov(np.concatenate([out, y]))
+        cov2 = gvar.evalcov(np.concatenate([expected, y]))
+        assert np.allclose(gvar.mean(out), gvar.mean(expected))
+        assert np.allclose(cov1, cov2)
+        
+        out = post.pred(xs, keepcorr=False)
+        assert np.allclose(gvar.evalcov(out), gvar.evalcov(expected))
+        assert np.allclose(gvar.evalcov(np.concatenate([out, y]))[:len(xs), len(xs):], 0)
+        with pytest.raises(ValueError):
+            post.pred(xs, raw=True, keepcorr=True)
+        
+        file = io.BytesIO()
+        post.save(file)
+        file.seek(0)
+        post = lgp.Posterior.load(file, gp._covfun)
+        with pytest.raises(ValueError):
+            post.pred(xs, keepcorr=True)
+
+def test_crossval():
+    x = np.linspace(0, 10, 12)
+    y = np.sin(x) + 0.1 * np.cos(3 * x)
+    err = 0.1 + 0.05 * np.arange(len(x)) / len(x)
+    kernel = lgp.ExpQuad(scale=2)
+    gp = lgp.GP(kernel)
+    gp.addx(x, 'x')
+    given = gvar.gvar(y, err)
+    
+    def brute(fold):
+        rest = np.setdiff1d(np.arange(len(x)), fold)
+        gp = lgp.GP(kernel)
+        gp.addx(x[rest], 'rest')
+        gp.addx(x[fold], 'fold')
+        m, c = gp.predfromdata({'rest': given[rest]}, 'fold', raw=True)
+        c = c + np.diag(err[fold] ** 2)
+        r = y[fold] - m
+        logp = -1/2 * (r @ linalg.solve(c, r) + np.linalg.slogdet(c)[1] + len(fold) * np.log(2 * np.pi))
+        return m, np.diag(c), logp
+    
+    mean, var, logp = gp.crossval(given)
+    assert mean.shape == var.shape == logp.shape == x.shape
+    for i in range(len(x)):
+        m, v, l = brute([i])
+        assert np.allclose(mean[i], m)
+        assert np.allclose(var[i], v)
+        assert np.allclose(logp[i], l)
+    
+    fold = np.arange(9, 12)
+    mean, var, logp = gp.crossval({'x': given}, folds=[fold])
+    m, v, l = brute(fold)
+    assert np.allclose(mean['x'][fold], m)
+    assert np.allclose(var['x'][fold], v)
+    assert np.allclose(logp, l)
+    assert np.all(np.isnan(mean['x'][:9]))
+    
+    _, _, logp = gp.crossval(given, folds=1)
+    assert np.allclose(logp, gp.marginal_likelihood(given))
+    _, _, logp = gp.crossval(given, folds=3)
+    assert logp.shape == (3,)
+    
+    with pytest.raises(ValueError):
+        gp.crossval(given, folds=[[0, 1], [1, 2]])
+
+def test_laplace():
+    # with one point, compare with numerical integration
+    from scipy import integrate, stats
+    gp = lgp.GP(lgp.ExpQuad() * 4)
+    gp.addx(np.zeros(1), 'x')
+    for y in [0, 3, 50, 10000]:
+        logpost = lambda f: stats.poisson.logpmf(y, np.exp(f)) + stats.norm.logpdf(f, 0, 2)
+        mode = np.log(y + 1/2)
+        width = 10 / np.sqrt(y + 1)
+        z, _ = integrate.quad(lambda f: np.exp(logpost(f)), mode - width, mode + width, points=[mode])
+        logml = gp.marginal_likelihood({'x': np.array([y])}, likelihood='poisson')
+        assert np.allclose(logml, np.log(z), atol=0.03)
+    
+    # the pseudodata give the mode as posterior mean on the same points
+    x = np.linspace(0, 10, 30)
+    y = np.random.default_rng(0).poisson(np.exp(2 + np.sin(x)))
+    for likelihood, dispersion in [('poisson', None), ('negbin', 5)]:
+        gp = lgp.GP(lgp.ExpQuad(scale=2) * 4)
+        gp.addx(x, 'x')
+        pseudodata = gp.laplace(y, likelihood=likelihood, dispersion=dispersion)
+        f, _ = gp.predfromdata(pseudodata, 'x', raw=True)
+        mu = np.exp(f)
+        if likelihood == 'poisson':
+            grad = y - mu
+        else:
+            grad = (y - mu) * dispersion / (dispersion + mu)
+        K = gp.prior('x', raw=True)
+        assert np.allclose(f, K @ grad)
+        
+    # derivatives w.r.t. the hyperparameters and the dispersion
+    def fun(p):
+        gp = lgp.GP(lgp.ExpQuad(scale=p[0]) * 4)
+        gp.addx(x, 'x')
+        return gp.marginal_likelihood(y, likelihood='negbin', dispersion=p[1])
+    p = np.array([2., 5.])
+    grad = autograd.grad(fun)(p)
+    eps = 1e-5
+    for i in range(2):
+        dp = eps * np.eye(2)[i]
+        assert np.allclose(grad[i], (fun(p + dp) - fun(p - dp)) / (2 * eps), rtol=1e-5)
+    
+    with pytest.raises(ValueError):
+        gp.laplace(y, likelihood='negbin')
+    with pytest.raises(ValueError):
+        gp.laplace(-y)
@@ -0,0 +1,173 @@
+from __future__ import division
+
+import sys
+
+import autograd
+from autograd import numpy as np
+import gvar
+from scipy import integrate
+import pytest
+
+sys.path = ['.'] + sys.path
+import lsqfitgp2 as lgp
+
+def makegp(hp):
+    gp = lgp.GP(lgp.ExpQuad(scale=hp['scale']) * hp['sigma'] ** 2)
+    gp.addx(np.linspace(0, 10, 30), 'data')
+    return gp
+
+def test_empbayes_methods():
+    x = np.linspace(0, 10, 30)
+    data = {'data': gvar.gvar(np.sin(x), np.full(len(x), 0.1))}
+    hyperprior = {'log(scale)': gvar.log(gvar.gvar(2, 1)), 'log(sigma)': gvar.log(gvar.gvar(1, 1))}
+    results = [
+        lgp.empbayes_fit(hyperprior, makegp, data, method=method)
+        for method in ['newton', 'bfgs']
+    ]
+    r1, r2 = [gvar.BufferDict(r).buf for r in results]
+    assert np.allclose(gvar.mean(r1), gvar.mean(r2), rtol=1e-4)
+    # BFGS gives only an approximation of the inverse of the hessian
+    assert np.allclose(gvar.evalcov(r1), gvar.evalcov(r2), rtol=0.1)
+
+def test_empbayes_solver():
+    # the toeplitz solver supports only first derivatives
+    x = np.linspace(0, 10, 30)
+    data = {'data': gvar.gvar(np.sin(x), np.full(len(x), 0.1))}
+    hyperprior = {'log(scale)': gvar.log(gvar.gvar(2, 1))}
+    def makegp(hp, solver):
+        gp = lgp.GP(lgp.ExpQuad(scale=hp['scale']), solver=solver)
+        gp.addx(x, 'data')
+        return gp
+    with pytest.raises(ValueError):
+        lgp.empbayes_fit(hyperprior, lambda hp: makegp(hp, 'toeplitz'), data, method='newton')
+    r1 = lgp.empbayes_fit(hyperprior, lambda hp: makegp(hp, 'toeplitz'), data)
+    r2 = lgp.empbayes_fit(hyperprior, lambda hp: makegp(hp, 'eigcut+'), data, method='newton')
+    assert np.allclose(gvar.mean(r1['log(scale)']), gvar.mean(r2['log(scale)']), rtol=1e-4)
+
+def test_empbayes_cov():
+    # the covariance is the inverse of the hessian of the minus log posterior
+    x = np.linspace(0, 10, 30)
+    data = {'data': gvar.gvar(np.sin(x), np.full(len(x), 0.1))}
+    hyperprior = gvar.BufferDict({'log(scale)': gvar.log(gvar.gvar(2, 1))})
+    result = lgp.empbayes_fit(hyperprior, lambda hp: makegp(dict(hp, sigma=1)), data, method='newton')
+    def fun(p):
+        gp = makegp(dict(scale=np.exp(p), sigma=1))
+        prior = (p - gvar.mean(hyperprior['log(scale)'])) ** 2 / 2 / gvar.var(hyperprior['log(scale)'])
+        return -gp.marginal_likelihood(data) + prior
+    p = gvar.mean(result['log(scale)'])
+    assert np.allclose(autograd.grad(fun)(p), 0, atol=1e-5)
+    assert np.allclose(gvar.var(result['log(scale)']), 1 / autograd.hessian(fun)(p))
+
+def test_empbayes_batch():
+    # two copies of the data are equivalent to one with the prior widened by
+    # sqrt(2), with half the posterior covariance
+    x = np.linspace(0, 10, 30)
+    y = gvar.gvar(np.sin(x), np.full(len(x), 0.1))
+    makegp1 = lambda hp: makegp(dict(hp, sigma=1))
+    hp1 = lgp.empbayes_fit({'log(scale)': gvar.gvar(1, 1)}, makegp1, {'data': np.stack([y, y])}, method='newton')
+    hp2 = lgp.empbayes_fit({'log(scale)': gvar.gvar(1, np.sqrt(2))}, makegp1, {'data': y}, method='newton')
+    assert np.allclose(gvar.mean(hp1['log(scale)']), gvar.mean(hp2['log(scale)']), rtol=1e-5)
+    assert np.allclose(gvar.var(hp1['log(scale)']), gvar.var(hp2['log(scale)']) / 2, rtol=1e-4)
+
+def test_empbayes_noisescale():
+    # the noise scale is fitted reusing the decomposition of the same GP
+    x = np.linspace(0, 10, 30)
+    y = gvar.gvar(np.sin(x), np.full(len(x), 0.1))
+    hyperprior = {'log(noise)': gvar.gvar(0, 1)}
+    gp = makegp(dict(scale=2, sigma=1))
+    result = lgp.empbayes_fit(hyperprior, lambda hp: gp, {'data': y}, method='newton', noisescale=lambda hp: hp['noise'])
+    assert gp.cache_info()['misses'] == 1
+    ycov = gvar.evalcov(y)
+    def fun(p):
+        gp = makegp(dict(scale=2, sigma=1))
+        ml = gp.marginal_likelihood({'data': gvar.mean(y)}, {('data', 'data'): np.exp(p) * ycov})
+        return -ml + p ** 2 / 2
+    p = gvar.mean(result['log(noise)'])
+    assert np.allclose(autograd.grad(fun)(p), 0, atol=1e-5)
+    assert np.allclose(gvar.var(result['log(noise)']), 1 / autograd.hessian(fun)(p))
+
+def test_empbayes_amplitude():
+    # one amplitude per dataset, fitted with a shared decomposition
+    x = np.linspace(0, 10, 30)
+    y = np.stack([np.sin(x), 3 * np.sin(x)])
+    data = {'data': gvar.gvar(y, np.full(y.shape, 0.1))}
+    gp = makegp(dict(scale=2, sigma=1))
+    hyperprior = {'log(amp)': gvar.gvar([0, 0], [2, 2])}
+    result = lgp.empbayes_fit(hyperprior, lambda hp: gp, data, method='newton', amplitude=lambda hp: hp['amp'])
+    assert gp.cache_info()['misses'] == 1
+    for i in range(2):
+        hp = lgp.empbayes_fit({'log(amp)': hyperprior['log(amp)'][i]}, lambda hp: makegp(dict(scale=2, sigma=np.sqrt(hp['amp']))), {'data': data['data'][i]}, method='newton')
+        assert np.allclose(gvar.mean(result['log(amp)'][i]), gvar.mean(hp['log(amp)']), rtol=1e-4)
+        assert np.allclose(gvar.sdev(result['log(amp)'][i]), gvar.sdev(hp['log(amp)']), rtol=1e-4)
+
+def test_empbayes_grid():
+    x = np.linspace(0, 10, 30)
+    data = {'data': gvar.gvar(np.sin(x), np.full(len(x), 0.1))}
+    hyperprior = {'log(scale)': gvar.log(gvar.gvar(2, 1)), 'log(sigma)': gvar.log(gvar.gvar(1, 1))}
+    points, marglike = lgp.empbayes_grid(hyperprior, makegp, data, 10, chunksize=4)
+    assert points.shape == (10, 2)
+    for p, ml in zip(points, marglike):
+        gp = makegp(dict(scale=np.exp(p[0]), sigma=np.exp(p[1])))
+        assert np.allclose(ml, gp.marginal_likelihood(data))
+    
+    # each stratum of the Latin hypercube is sampled once
+    flat = gvar.BufferDict(hyperprior).buf
+    u = gvar.mean((points - gvar.mean(flat)) / gvar.sdev(flat))
+    from scipy import stats
+    strata = np.floor(stats.norm.cdf(u) * 10)
+    assert all(sorted(s) == list(range(10)) for s in strata.T)
+    
+    points, marglike = lgp.empbayes_grid(hyperprior, makegp, data, 3, method='grid')
+    assert points.shape == (9, 2)
+    _, marglike2 = lgp.empbayes_grid(hyperprior, makegp, {'data': np.stack([data['data']] * 2)}, points, processes=2, chunksize=4)
+    assert np.allclose(marglike2, 2 * marglike)
+
+def makegp_bimodal(hp):
+    # the marginal likelihood has maxima at log(scale) = -0.93 and 0.66
+    gp = lgp.GP(lgp.ExpQuad(scale=hp['scale']))
+    gp.addx(np.linspace(0, 10, 40), 'data')
+    return gp
+
+def test_empbayes_multistart():
+    x = np.linspace(0, 10, 40)
+    data = {'data': gvar.gvar(np.sin(x) + np.sin(6 * x) / 2, np.full(len(x), 0.1))}
+    hyperprior = {'log(scale)': gvar.gvar(0, 1.5)}
+    modes = lgp.empbayes_fit(hyperprior, makegp_bimodal, data, method='newton', multistart=8)
+    assert len(modes) == 2
+    assert sum(count for _, _, count in modes) == 8
+    assert modes[0][1] > modes[1][1]
+    
+    # the evidence matches the integral of the posterior around the mode
+    for hp, logz, _ in modes:
+        mean = gvar.mean(hp['log(scale)'])
+        sdev = gvar.sdev(hp['log(scale)'])
+        def post(l):
+            ml = makegp_bimodal({'scale': np.exp(l)}).marginal_likelihood(data)
+            return np.exp(ml - l ** 2 / (2 * 1.5 ** 2)) / np.sqrt(2 * np.pi * 1.5 ** 2)
+        z, _ = integrate.quad(post, mean - 5 * sdev, mean + 5 * sdev)
+        assert np.allclose(logz, np.log(z), atol=0.05)
+    
+    modes2 = lgp.empbayes_fit(hyperprior, makegp_bimodal, data, method='newton', multistart=8, processes=2)
+    for (hp1, logz1, count1), (hp2, logz2, count2) in zip(modes, modes2):
+        assert np.allclose(gvar.mean(hp1['log(scale)']), gvar.mean(hp2['log(scale)']))
+        assert np.allclose(logz1, logz2)
+        assert count1 == count2
+
+def test_empbayes_poisson():
+    x = np.linspace(0, 10, 30)
+    y = np.random.default_rng(1).poisson(np.exp(2 + np.sin(x)))
+    def makegp(hp):
+        gp = lgp.GP(lgp.ExpQuad(scale=hp['scale']) * hp['sigma'] ** 2)
+        gp.addx(x, 'x')
+        return gp
+    hyperprior = {'log(scale)': gvar.log(gvar.gvar(2, 1)), 'log(sigma)': gvar.log(gvar.gvar(2, 1))}
+    results = [
+        lgp.empbayes_fit(hyperprior, makegp, {'x': y}, method=method, likelihood='poisson')
+        for method in ['newton', 'bfgs']
+    ]
+    r1, r2 = [gvar.BufferDict(r).buf for r in results]
+    assert np.allclose(gvar.mean(r1), gvar.mean(r2), rtol=1e-4)
+    
+    hyperprior['log(r)'] = gvar.log(gvar.gvar(10, 10))
+    result = lgp.empbayes_fit(hyperprior, makegp, {'x': y}, likelihood='negbin', dispersion=lambda hp: hp['r'])
+    assert np.isfinite(gvar.sdev(result['log(r)']))
@@ -8,7 +8,7 @@ import autograd
 from scipy import linalg
 
 sys.path = ['.'] + sys.path
-from lsqfitgp2 import _kernels, _Kernel
+from lsqfitgp2 import _kernels, _Kernel, _Deriv
 
 # Make list of Kernel concrete subclasses.
 kernels = []
@@ -149,6 +149,17 @@ def test_matern_half_integer():
         r2 = _kernels.Matern(nu=nualt)(x, y)
         assert np.allclose(r1, r2)
 
+def test_matern_integer():
+    """
+    Check that integer nu is not computed with the half integer formula.
+    """
+    for nu in range(1, 5):
+        nualt = nu * (1 + 4 * np.finfo(float).eps)
+        x, y = 3 * np.random.randn(2, 100)
+        r1 = _kernels.Matern(nu=nu)(x, y)
+        r2 = _kernels.Matern(nu=nualt)(x, y)
+        assert np.allclose(r1, r2)
+
 def test_matern_spec():
     """
     Test implementations of specific cases of nu.
@@ -172,3 +183,106 @@ def test_matern_deriv_spec():
         r1 = autograd.elementwise_grad(_kernels.Matern(nu=nu))(x, y)
         r2 = autograd.elementwise_grad(spec())(x, y)
         assert np.allclose(r1, r2)
+
+def test_algebra():
+    """
+    Check that sums, products and powers of kernels give the same result of
+    the kernels evaluated separately, also for the derivatives.
+    """
+    x = np.empty(30, dtype=[('time', float), ('label', int)])
+    x['time'] = np.random.randn(len(x))
+    x['label'] = np.random.randint(3, size=len(x))
+    cov = np.eye(3) + 0.5
+    k1 = _kernels.ExpQuad(dim='time', scale=2)
+    k2 = _kernels.Matern32(dim='time')
+    k3 = _kernels.Categorical(dim='label', cov=cov)
+    k4 = _kernels.RatQuad(scale=3, dim='time')
+    kernel = 3 * k1 * k3 + k2 ** 2 * k1 + (k3 * 2 + k4) * k2 + 1
+    c1 = k1(x[:, None], x[None, :])
+    c2 = k2(x[:, None], x[None, :])
+    c3 = k3(x[:, None], x[None, :])
+    c4 = k4(x[:, None], x[None, :])
+    expected = 3 * c1 * c3 + c2 ** 2 * c1 + (c3 * 2 + c4) * c2 + 1
+    assert np.allclose(kernel(x[:, None], x[None, :]), expected)
+    
+    t = x['time']
+    kernel = (_kernels.ExpQuad() + _kernels.Cos()) * _kernels.ExpQuad(scale=2)
+    opaque = lambda k: _Kernel.Kernel(k, derivable=True)
+    opaque = (opaque(_kernels.ExpQuad()) + opaque(_kernels.Cos())) * opaque(_kernels.ExpQuad(scale=2))
+    c1 = kernel.diff(1, 1)(t[:, None], t[None, :])
+    c2 = opaque.diff(1, 1)(t[:, None], t[None, :])
+    assert np.allclose(c1, c2)
+    g1 = autograd.elementwise_grad(kernel)(t, t[::-1])
+    g2 = autograd.elementwise_grad(opaque)(t, t[::-1])
+    assert np.allclose(g1, g2)
+
+def test_closed_derivs():
+    """
+    Check the closed form derivatives against autograd.
+    """
+    x = np.random.uniform(-5, 5, size=30)
+    kernels = [
+        _kernels.ExpQuad(scale=2),
+        _kernels.Matern32(scale=0.7),
+        _kernels.Matern52(scale=1.3),
+        _kernels.RatQuad(alpha=1.5, scale=2),
+        _kernels.Periodic(outerscale=1.3, scale=2),
+        _kernels.Cos(scale=3),
+        _kernels.Linear(),
+        3 * _kernels.ExpQuad(scale=2) + _kernels.Cos(),
+        2 * _kernels.ExpQuad() * _kernels.Periodic(scale=2),
+    ]
+    for kernel in kernels:
+        opaque = _Kernel.Kernel(kernel, derivable=kernel.derivable)
+        for orders in [(1, 0), (0, 1), (1, 1), (2, 0), (0, 2)]:
+            if max(orders) > kernel.derivable:
+                continue
+            f, _, _ = kernel._closedderiv(x, _Deriv.Deriv(orders[0]), _Deriv.Deriv(orders[1]))
+            assert f is not kernel._kernel
+            r1 = kernel.diff(*orders)(x[:, None], x[None, :])
+            r2 = opaque.diff(*orders)(x[:, None], x[None, :])
+            assert np.allclose(r1, r2)
+    
+    kernel = _kernels.ExpQuad(dim='time')
+    assert kernel.diff('time', 'time') is kernel.diff('time', 'time')
+
+def test_closed_derivs_22():
+    """
+    Check the (2, 2) derivatives against finite differences, also at x == y
+    where autograd on the kernels with input='soft' is wrong.
+    """
+    x = np.random.uniform(-3, 3, size=10)
+    y = np.concatenate([x[:5], x[5:] + 0.3])
+    kernels = [
+        _kernels.ExpQuad(scale=2),
+        _kernels.RatQuad(alpha=1.5, scale=2),
+        _kernels.Periodic(outerscale=1.3, scale=2),
+        _kernels.Cos(scale=2),
+        _kernels.Matern52(scale=1.3),
+        2 * _kernels.ExpQuad() * _kernels.Periodic(scale=2) + _kernels.Matern52(scale=2),
+    ]
+    h = 2e-3
+    w = [1, -2, 1]
+    for kernel in kernels:
+        fd = sum(
+            w[i] * w[j] * kernel(x + (i - 1) * h, y + (j - 1) * h)
+            for i in range(3) for j in range(3)
+        ) / h ** 4
+        assert np.allclose(kernel.diff(2, 2)(x, y), fd, rtol=1e-2, atol=1e-3)
+
+def test_closed_derivs_fields():
+    # each factor of a product on separate fields has closed form derivatives
+    # w.r.t. its field, the other factor does not depend on it
+    x = np.empty(20, dtype=[('a', float), ('b', float)])
+    x['a'] = np.random.uniform(-5, 5, size=len(x))
+    x['b'] = np.random.uniform(-5, 5, size=len(x))
+    kernel = _kernels.ExpQuad(dim='a') * _kernels.Matern52(dim='b', scale=2)
+    opaque = _Kernel.Kernel(kernel, derivable=kernel.derivable)
+    for dim in 'ab':
+        for orders in [(1, 0), (0, 1), (1, 1), (2, 0), (0, 2)]:
+            xderiv, yderiv = [_Deriv.Deriv([o, dim]) if o else _Deriv.Deriv() for o in orders]
+            f, _, _ = kernel._closedderiv(x, xderiv, yderiv)
+            assert f is not kernel._kernel
+            r1 = kernel.diff(xderiv, yderiv)(x[:, None], x[None, :])
+            r2 = opaque.diff(xderiv, yderiv)(x[:, None], x[None, :])
+            assert np.allclose(r1, r2)
@@ -4,9 +4,10 @@ import autograd
 from autograd import numpy as np
 from scipy import linalg, stats
 import gvar
+import pytest
 
 sys.path = ['.'] + sys.path
-from lsqfitgp2 import _linalg
+from lsqfitgp2 import _linalg, _kernels
 
 class DecompTestBase:
     
@@ -219,6 +220,29 @@ class TestCholGersh(DecompTestBase):
     def decompclass(self):
         return _linalg.CholGersh
 
+class TestAutoDecomp(DecompTestBase):
+    
+    @property
+    def decompclass(self):
+        return _linalg.AutoDecomp
+
+def test_autodecomp_path():
+    x = np.linspace(0, 10, 50)
+    K = np.exp(-1/2 * (x[:, None] - x[None, :]) ** 2)
+    assert _linalg.AutoDecomp(K).path == 'eigcut'
+    assert _linalg.AutoDecomp(K + 0.01 * np.eye(len(x))).path == 'chol'
+
+def test_autodecomp_eigcut():
+    # the fallback is the same of EigCutFullRank (eigcut+)
+    x = np.linspace(0, 10, 50)
+    K = np.exp(-1/2 * (x[:, None] - x[None, :]) ** 2)
+    b = np.random.randn(len(x))
+    d1 = _linalg.AutoDecomp(K)
+    d2 = _linalg.EigCutFullRank(K)
+    assert d1.path == 'eigcut'
+    assert np.allclose(d1.solve(b), d2.solve(b), rtol=1e-12)
+    assert np.allclose(d1.logdet(), d2.logdet(), rtol=1e-12)
+
 def _noautograd(x):
     if isinstance(x, np.numpy_boxes.ArrayBox):
         return x._value
@@ -286,3 +310,156 @@ def check_solve_triangular(A, B, lower):
     assert np.allclose(np.tensordot(A, x1, 1), B)
     x2 = _linalg.solve_triangular(A, B, lower=lower)
     assert np.allclose(x1, x2)
+
+def randkron(ns):
+    test = DecompTestBase()
+    return [test.randsymmat(n) for n in ns]
+
+def kron(mats):
+    K = np.ones((1, 1))
+    for M in mats:
+        K = np.kron(K, M)
+    return K
+
+def test_kron_solve():
+    for ns in [(1,), (3, 4), (2, 3, 4)]:
+        Ks = randkron(ns)
+        noise = np.random.uniform(0, 1)
+        K = kron(Ks) + noise * np.eye(len(kron(Ks)))
+        b = np.random.randn(len(K), 3)
+        sol = linalg.solve(K, b)
+        result = _linalg.KronDecomp(Ks, noise).solve(b)
+        assert np.allclose(sol, result, rtol=1e-4)
+
+def test_kron_logdet():
+    for ns in [(1,), (3, 4), (2, 3, 4)]:
+        Ks = randkron(ns)
+        K = kron(Ks)
+        sol = np.sum(np.log(linalg.eigvalsh(K)))
+        result = _linalg.KronDecomp(Ks).logdet()
+        assert np.allclose(sol, result)
+
+def test_kron_grad():
+    x = np.arange(5)
+    C = np.array([[2, 1], [1, 2]])
+    def fun(s, kron_solver):
+        K1 = np.exp(-1/2 * (x[:, None] - x[None, :]) ** 2 / s ** 2)
+        K2 = C * s
+        b = np.arange(10.)
+        if kron_solver:
+            decomp = _linalg.KronDecomp([K1, K2], s / 10)
+        else:
+            K = np.reshape(K1[:, None, :, None] * K2[None, :, None, :], (10, 10))
+            decomp = _linalg.Diag(K + s / 10 * np.eye(10))
+        return decomp.logdet() + decomp.quad(b)
+    for s in [0.5, 1., 2.]:
+        g1 = autograd.grad(fun)(s, True)
+        g2 = autograd.grad(fun)(s, False)
+        assert np.allclose(g1, g2)
+
+def test_kalman_solve():
+    x = np.random.uniform(0, 5, size=20)
+    x[3] = x[7] # repeated point
+    terms = [(2, 0, 1), (1, 1, 0.5), (0.5, 3, 2)]
+    K = sum(var * _kernels.Matern(nu=p + 1/2, scale=scale)(x[:, None], x[None, :]) for var, p, scale in terms)
+    noise = np.random.uniform(0.1, 1, size=len(x))
+    K = K + np.diag(noise)
+    b = np.random.randn(len(x), 3)
+    decomp = _linalg.KalmanDecomp(x, terms, noise)
+    assert np.allclose(decomp.solve(b), linalg.solve(K, b))
+    assert np.allclose(decomp.quad(b), b.T @ linalg.solve(K, b))
+    assert np.allclose(decomp.logdet(), np.linalg.slogdet(K)[1])
+
+def test_toeplitz_solve():
+    x = np.arange(30)
+    t = _kernels.Matern32(scale=4)(x[:1], x)
+    t[0] += 0.1
+    K = linalg.toeplitz(t)
+    b = np.random.randn(len(x), 3)
+    decomp = _linalg.ToeplitzDecomp(t)
+    assert np.allclose(decomp.solve(b), linalg.solve(K, b))
+    assert np.allclose(decomp.quad(b), b.T @ linalg.solve(K, b))
+    assert np.allclose(decomp.logdet(), np.linalg.slogdet(K)[1])
+    assert np.allclose(_linalg.toeplitz_matvec(t, b), K @ b)
+
+def test_diaglowrank_solve():
+    d = np.random.uniform(1, 2, size=20)
+    U = np.random.randn(20, 4)
+    K = np.diag(d) + U @ U.T
+    b = np.random.randn(20, 3)
+    decomp = _linalg.DiagLowRank(d, U)
+    assert np.allclose(decomp.solve(b), linalg.solve(K, b))
+    assert np.allclose(decomp.usolve(b), linalg.solve(K, b))
+    assert np.allclose(decomp.quad(b), b.T @ linalg.solve(K, b))
+    assert np.allclose(decomp.logdet(), np.linalg.slogdet(K)[1])
+
+def test_batch_eigcut_solve():
+    A = np.random.randn(4, 15, 15)
+    K = A @ np.swapaxes(A, -1, -2) + np.eye(15)
+    b = np.random.randn(3, 1, 15) # broadcast against the matrices
+    decomp = _linalg.BatchEigCutFullRank(K)
+    for i in range(3):
+        for j in range(4):
+            assert np.allclose(decomp.solve(b)[i, j], linalg.solve(K[j], b[i, 0]))
+            assert np.allclose(decomp.quad(b)[i, j], b[i, 0] @ linalg.solve(K[j], b[i, 0]))
+    assert np.allclose(decomp.logdet(), np.linalg.slogdet(K)[1])
+    
+    def fun(s):
+        return np.sum(_linalg.BatchEigCutFullRank(K * s).quad(b))
+    grad = autograd.grad(fun)(1.5)
+    assert np.allclose(grad, -fun(1.5) / 1.5)
+
+def test_cg_solve():
+    x = np.linspace(0, 10, 100)
+    K = _kernels.ExpQuad()(x[:, None], x[None, :]) + 0.1 * np.eye(len(x))
+    b = np.random.randn(len(x), 3)
+    decomp = _linalg.CGDecomp(K)
+    assert np.allclose(decomp.solve(b), linalg.solve(K, b))
+    assert np.allclose(decomp.quad(b), b.T @ linalg.solve(K, b))
+    assert np.allclose(decomp.logdet(), np.linalg.slogdet(K)[1], rtol=0.05)
+    
+    # the same with the matrix given as a function
+    decomp2 = _linalg.CGDecomp(lambda V: K @ V, diag=np.diag(K), maxeigv=_linalg._gershgorin_eigval_bound(K))
+    assert np.allclose(decomp2.solve(b), decomp.solve(b))
+    assert np.allclose(decomp2.logdet(), decomp.logdet())
+
+def test_cg_maxiter():
+    # with k distinct eigenvalues the conjugate gradient converges in k
+    # iterations
+    A = np.diag([1., 2., 3., 1., 2.])
+    B = np.random.randn(5, 2)
+    X, converged = _linalg._cg(A, B, 1e-10, 3)
+    assert converged
+    assert np.allclose(A @ X, B)
+    X, converged = _linalg._cg(A, B, 1e-10, 2)
+    assert not converged
+
+def test_cg_function_autograd():
+    x = np.linspace(0, 10, 30)
+    K = _kernels.ExpQuad()(x[:, None], x[None, :]) + 0.1 * np.eye(len(x))
+    b = np.random.randn(len(x))
+    decomp = _linalg.CGDecomp(lambda V: K @ V, diag=np.diag(K))
+    
+    # the argument of solve and quad can be differentiated
+    grad = autograd.grad(decomp.quad)(b)
+    assert np.allclose(grad, 2 * linalg.solve(K, b))
+    grad = autograd.grad(lambda b: np.sum(decomp.solve(b)))(b)
+    assert np.allclose(grad, linalg.solve(K, np.ones(len(b))))
+    
+    # the matrix can not
+    def fun(s):
+        return _linalg.CGDecomp(lambda V: s * K @ V, diag=np.diag(K)).quad(b)
+    with pytest.raises(TypeError):
+        autograd.grad(fun)(1.)
+    def fun(s):
+        return _linalg.CGDecomp(lambda V: K @ V, diag=s * np.diag(K)).logdet()
+    with pytest.raises(TypeError):
+        autograd.grad(fun)(1.)
+
+def test_slq_logdet():
+    # with many probes the estimate converges to the exact value
+    A = np.random.randn(20, 20)
+    A = A @ A.T + np.eye(20)
+    Z = np.random.choice([-1., 1.], size=(20, 20000))
+    logdet = _linalg._slq_logdet(A, Z, 20)
+    assert np.allclose(logdet, np.linalg.slogdet(A)[1], rtol=0.01)
@@ -0,0 +1,354 @@
+from __future__ import division
+
+import sys
+
+import autograd
+from autograd import numpy as np
+import gvar
+
+sys.path = ['.'] + sys.path
+import lsqfitgp2 as lgp
+
+def lattice(nlabels, ntimes):
+    x = np.empty((nlabels, ntimes), dtype=[('label', int), ('time', float)])
+    x['label'] = np.arange(nlabels)[:, None]
+    x['time'] = np.linspace(0, 10, ntimes)
+    return x
+
+def labelcov(n):
+    A = np.random.randn(n, n)
+    return A.T @ A + np.eye(n)
+
+def kron_marglike(scale, solver, x, cov, y, noise):
+    kernel = lgp.ExpQuad(scale=scale, dim='time')
+    kernel = 3 * kernel * lgp.Categorical(cov=cov, dim='label')
+    gp = lgp.GP(kernel, solver=solver)
+    gp.addx(x, 'data')
+    ycov = noise * np.eye(x.size).reshape(2 * x.shape)
+    return gp.marginal_likelihood({'data': y}, {('data', 'data'): ycov})
+
+def test_kron_marginal_likelihood():
+    x = lattice(3, 20)
+    cov = labelcov(3)
+    y = np.random.randn(*x.shape)
+    for noise in [0.01, 0.1]:
+        args = (x, cov, y, noise)
+        ml1 = kron_marglike(2, 'kron', *args)
+        ml2 = kron_marglike(2, 'eigcut+', *args)
+        assert np.allclose(ml1, ml2)
+
+def test_kron_marginal_likelihood_grad():
+    x = lattice(2, 10)
+    cov = labelcov(2)
+    y = np.random.randn(*x.shape)
+    grad = autograd.grad(kron_marglike)
+    g1 = grad(3., 'kron', x, cov, y, 0.1)
+    g2 = grad(3., 'eigcut+', x, cov, y, 0.1)
+    assert np.allclose(g1, g2)
+
+def test_kron_pred():
+    x = lattice(3, 20)
+    xpred = lattice(3, 7)
+    xpred['time'] += 0.3
+    kernel = lgp.ExpQuad(scale=2, dim='time') * lgp.Categorical(cov=labelcov(3), dim='label')
+    y = gvar.gvar(np.random.randn(*x.shape), np.full(x.shape, 0.1))
+    results = []
+    for solver in ['kron', 'eigcut+']:
+        gp = lgp.GP(kernel, solver=solver)
+        gp.addx(x, 'data')
+        gp.addx(xpred, 'pred')
+        results.append(gp.predfromdata({'data': y}, 'pred', raw=True))
+    (m1, c1), (m2, c2) = results
+    assert np.allclose(m1, m2)
+    assert np.allclose(c1, c2)
+
+def test_kron_not_lattice():
+    x = lattice(2, 10)
+    x['time'][1] += 1
+    gp = lgp.GP(lgp.ExpQuad(dim='time') * lgp.ExpQuad(dim='label'), solver='kron')
+    gp.addx(x, 'data')
+    try:
+        gp.marginal_likelihood({'data': np.zeros(x.shape)})
+    except ValueError:
+        pass
+    else:
+        assert False
+
+def sskernel(scale, amplitude=1):
+    return amplitude * lgp.Matern32(scale=scale) + lgp.Matern12(scale=3) + 0.5 * lgp.Matern52(scale=scale / 2)
+
+def ss_marglike(scale, noise, solver, x, y):
+    gp = lgp.GP(sskernel(scale), solver=solver)
+    gp.addx(x, 'data')
+    ycov = np.diag(noise * (1 + np.arange(len(x)) / len(x)))
+    return gp.marginal_likelihood({'data': y}, {('data', 'data'): ycov})
+
+def test_statespace_marginal_likelihood():
+    x = np.random.uniform(0, 10, size=40)
+    y = np.random.randn(len(x))
+    for noise in [0.01, 0.1]:
+        ml1 = ss_marglike(2, noise, 'statespace', x, y)
+        ml2 = ss_marglike(2, noise, 'eigcut+', x, y)
+        assert np.allclose(ml1, ml2)
+
+def test_statespace_marginal_likelihood_grad():
+    x = np.random.uniform(0, 10, size=20)
+    y = np.random.randn(len(x))
+    grad = autograd.grad(ss_marglike, [0, 1])
+    g1 = grad(2., 0.1, 'statespace', x, y)
+    g2 = grad(2., 0.1, 'eigcut+', x, y)
+    assert np.allclose(g1, g2)
+
+def test_statespace_pred():
+    x = np.random.uniform(0, 10, size=30)
+    xpred = np.linspace(-1, 11, 13)
+    y = gvar.gvar(np.random.randn(len(x)), np.full(len(x), 0.1))
+    for keepcorr in [False, True]:
+        results = []
+        for solver in ['statespace', 'eigcut+']:
+            gp = lgp.GP(sskernel(1.5, 2), solver=solver)
+            gp.addx(x, 'data')
+            gp.addx(xpred, 'pred')
+            out = gp.predfromdata({'data': y}, 'pred', keepcorr=keepcorr)
+            results.append(out)
+        out1, out2 = results
+        assert np.allclose(gvar.mean(out1), gvar.mean(out2))
+        assert np.allclose(gvar.evalcov(out1), gvar.evalcov(out2))
+
+def test_statespace_not_matern():
+    gp = lgp.GP(lgp.ExpQuad(), solver='statespace')
+    gp.addx(np.arange(5.), 'data')
+    try:
+        gp.marginal_likelihood({'data': np.zeros(5)})
+    except ValueError:
+        pass
+    else:
+        assert False
+
+def test_statespace_integer_nu():
+    gp = lgp.GP(lgp.Matern(nu=1), solver='statespace')
+    gp.addx(np.arange(5.), 'data')
+    try:
+        gp.marginal_likelihood({'data': np.zeros(5)})
+    except ValueError:
+        pass
+    else:
+        assert False
+
+def sparse_marglike(scale, noise, solver, x, y):
+    kernel = lgp.PPKernel(q=1, scale=scale) + 0.3 * lgp.PPKernel(scale=scale / 2)
+    gp = lgp.GP(kernel, solver=solver)
+    gp.addx(x[:10], 'a')
+    gp.addx(x[10:], 'b')
+    ycov = np.diag(noise * (1 + np.arange(len(x)) / len(x)))
+    given = {'a': y[:10], 'b': y[10:]}
+    givencov = {
+        (k1, k2): ycov[s1, s2]
+        for k1, s1 in [('a', slice(0, 10)), ('b', slice(10, None))]
+        for k2, s2 in [('a', slice(0, 10)), ('b', slice(10, None))]
+    }
+    return gp.marginal_likelihood(given, givencov)
+
+def test_sparse_marginal_likelihood():
+    x = np.random.uniform(0, 20, size=40)
+    y = np.random.randn(len(x))
+    ml1 = sparse_marglike(1.5, 0.1, 'sparse', x, y)
+    ml2 = sparse_marglike(1.5, 0.1, 'eigcut+', x, y)
+    assert np.allclose(ml1, ml2)
+
+def test_sparse_marginal_likelihood_grad():
+    x = np.random.uniform(0, 20, size=30)
+    y = np.random.randn(len(x))
+    grad = autograd.grad(sparse_marglike, [0, 1])
+    g1 = grad(1.5, 0.1, 'sparse', x, y)
+    g2 = grad(1.5, 0.1, 'eigcut+', x, y)
+    assert np.allclose(g1, g2)
+
+def test_sparse_pred():
+    x = np.random.uniform(0, 20, size=30)
+    xpred = np.linspace(-1, 21, 13)
+    y = gvar.gvar(np.random.randn(len(x)), np.full(len(x), 0.1))
+    results = []
+    for solver in ['sparse', 'eigcut+']:
+        gp = lgp.GP(lgp.PPKernel(q=2, scale=2), solver=solver)
+        gp.addx(x, 'data')
+        gp.addx(xpred, 'pred')
+        results.append(gp.predfromdata({'data': y}, 'pred', raw=True))
+    (m1, c1), (m2, c2) = results
+    assert np.allclose(m1, m2)
+    assert np.allclose(c1, c2)
+
+def toeplitz_marglike(scale, noise, solver, x, y):
+    gp = lgp.GP(2 * lgp.ExpQuad(scale=scale) + lgp.Matern32(scale=3 * scale), solver=solver)
+    gp.addx(x[:20], 'a')
+    gp.addx(x[20:], 'b')
+    given = {'a': y[:20], 'b': y[20:]}
+    givencov = {
+        (k1, k2): noise * np.eye(20 if k1 == 'a' else len(x) - 20) if k1 == k2 else np.zeros((20 if k1 == 'a' else len(x) - 20, 20 if k2 == 'a' else len(x) - 20))
+        for k1 in 'ab' for k2 in 'ab'
+    }
+    return gp.marginal_likelihood(given, givencov)
+
+def test_toeplitz_marginal_likelihood():
+    x = np.arange(50.)
+    y = np.random.randn(len(x))
+    for noise in [0.01, 0.1]:
+        ml1 = toeplitz_marglike(3, noise, 'toeplitz', x, y)
+        ml2 = toeplitz_marglike(3, noise, 'eigcut+', x, y)
+        assert np.allclose(ml1, ml2)
+
+def test_toeplitz_marginal_likelihood_grad():
+    x = np.arange(30.)
+    y = np.random.randn(len(x))
+    grad = autograd.grad(toeplitz_marglike, [0, 1])
+    g1 = grad(3., 0.1, 'toeplitz', x, y)
+    g2 = grad(3., 0.1, 'eigcut+', x, y)
+    assert np.allclose(g1, g2)
+
+def test_toeplitz_pred():
+    x = np.arange(30.)
+    xpred = np.linspace(-1, 31, 13)
+    y = gvar.gvar(np.random.randn(len(x)), np.full(len(x), 0.1))
+    results = []
+    for solver in ['toeplitz', 'eigcut+']:
+        gp = lgp.GP(lgp.Matern52(scale=3), solver=solver)
+        gp.addx(x, 'data')
+        gp.addx(xpred, 'pred')
+        results.append(gp.predfromdata({'data': y}, 'pred', raw=True))
+    (m1, c1), (m2, c2) = results
+    assert np.allclose(m1, m2)
+    assert np.allclose(c1, c2)
+
+def test_toeplitz_fallback():
+    x = np.random.uniform(0, 10, size=20)
+    gp = lgp.GP(lgp.ExpQuad(), solver='toeplitz')
+    gp.addx(x, 'data')
+    decomp = gp._solver(['data'], 0.1 * np.eye(len(x)))
+    assert isinstance(decomp, lgp._linalg.EigCutFullRank)
+
+def test_toeplitz_stationary():
+    x = np.arange(20.)
+    stationary = [
+        lgp.ExpQuad() * 2 + lgp.Cos(scale=5) * lgp.Matern32(),
+        lgp.ExpQuad() ** 2,
+        lgp.Kernel(lambda x, y: np.exp(-np.abs(x - y)), stationary=True),
+    ]
+    nonstationary = [
+        lgp.where(lambda x: x < 10, lgp.ExpQuad(), lgp.ExpQuad(scale=2)),
+        lgp.ExpQuad() + lgp.Linear(),
+        lgp.Kernel(lambda x, y: np.exp(-np.abs(x - y))),
+    ]
+    for kernels, cls in [(stationary, lgp._linalg.ToeplitzDecomp), (nonstationary, lgp._linalg.EigCutFullRank)]:
+        for kernel in kernels:
+            gp = lgp.GP(kernel, solver='toeplitz', checkpos=False)
+            gp.addx(x, 'data')
+            decomp = gp._solver(['data'], 0.1 * np.eye(len(x)))
+            assert isinstance(decomp, cls)
+
+def inducing_marglike(scale, solver, x, y, **kw):
+    gp = lgp.GP(lgp.ExpQuad(scale=scale), solver=solver, **kw)
+    gp.addx(x[:20], 'a')
+    gp.addx(x[20:], 'b')
+    given = {'a': y[:20], 'b': y[20:]}
+    sizes = {'a': 20, 'b': len(x) - 20}
+    givencov = {
+        (k1, k2): 0.1 * np.eye(sizes[k1]) if k1 == k2 else np.zeros((sizes[k1], sizes[k2]))
+        for k1 in given for k2 in given
+    }
+    return gp.marginal_likelihood(given, givencov)
+
+def test_fitc_exact():
+    # with the inducing points on the data points FITC is exact
+    x = np.random.uniform(0, 10, size=40)
+    y = np.random.randn(len(x))
+    ml1 = inducing_marglike(3, 'fitc', x, y, inducing=x)
+    ml2 = inducing_marglike(3, 'eigcut+', x, y)
+    assert np.allclose(ml1, ml2)
+    grad = autograd.grad(inducing_marglike)
+    g1 = grad(3., 'fitc', x, y, inducing=x)
+    g2 = grad(3., 'eigcut+', x, y)
+    assert np.allclose(g1, g2)
+
+def test_fitc_approx():
+    x = np.linspace(0, 10, 200)
+    y = np.sin(x)
+    ml = inducing_marglike(3, 'eigcut+', x, y)
+    for solver in ['fitc', 'nystrom']:
+        mlapprox = inducing_marglike(3, solver, x, y, inducing=20)
+        assert np.allclose(ml, mlapprox, rtol=1e-6)
+
+def test_fitc_inducing_grad():
+    x = np.linspace(0, 10, 50)
+    y = np.sin(x)
+    u = np.linspace(1, 9, 5)
+    fun = lambda u: inducing_marglike(2, 'fitc', x, y, inducing=u)
+    grad = autograd.grad(fun)(u)
+    delta = 1e-6 * np.random.randn(len(u))
+    assert np.allclose(fun(u + delta) - fun(u), grad @ delta, rtol=1e-3)
+
+def test_fitc_pred():
+    x = np.linspace(0, 10, 100)
+    xpred = np.linspace(-1, 11, 30)
+    y = gvar.gvar(np.sin(x), np.full(len(x), 0.1))
+    results = []
+    for solver, kw in [('fitc', dict(inducing=30)), ('eigcut+', {})]:
+        gp = lgp.GP(lgp.ExpQuad(scale=2), solver=solver, **kw)
+        gp.addx(x, 'data')
+        gp.addx(xpred, 'pred')
+        results.append(gp.predfromdata({'data': y}, 'pred', raw=True, diagonal=True))
+    (m1, v1), (m2, v2) = results
+    assert np.allclose(m1, m2, atol=1e-6)
+    assert np.allclose(v1, v2, atol=1e-6)
+
+def cg_marglike(scale, solver, x, y, **kw):
+    gp = lgp.GP(lgp.ExpQuad(scale=scale), solver=solver, **kw)
+    gp.addx(x, 'data')
+    return gp.marginal_likelihood({'data': y}, {('data', 'data'): 0.1 * np.eye(len(x))})
+
+def test_cg_marginal_likelihood():
+    x = np.linspace(0, 10, 100)
+    y = np.sin(x)
+    ml1 = cg_marglike(2, 'cg', x, y)
+    ml2 = cg_marglike(2, 'eigcut+', x, y)
+    # the error of the stochastic logdet is proportional to the size
+    assert np.allclose(ml1, ml2, atol=0.05 * len(x))
+    grad = autograd.grad(cg_marglike)
+    g1 = grad(2., 'cg', x, y)
+    g2 = grad(2., 'eigcut+', x, y)
+    assert np.allclose(g1, g2, rtol=0.2)
+
+def test_cg_matfree():
+    x = np.linspace(0, 10, 100)
+    y = np.sin(x)
+    gp = lgp.GP(lgp.ExpQuad(scale=2), solver='cg', matfree=True)
+    gp._matfreechunk = 30
+    gp.addx(x[:60], 'a')
+    gp.addx(x[60:], 'b', deriv=1)
+    given = {'a': y[:60], 'b': np.cos(x[60:])}
+    ml1 = gp.marginal_likelihood(given, {('a', 'a'): 0.1 * np.eye(60), ('b', 'b'): 0.1 * np.eye(40), ('a', 'b'): np.zeros((60, 40)), ('b', 'a'): np.zeros((40, 60))})
+    assert not hasattr(gp, '_covblocks') # the matrix was not computed
+    gp2 = lgp.GP(lgp.ExpQuad(scale=2), solver='cg')
+    gp2.addx(x[:60], 'a')
+    gp2.addx(x[60:], 'b', deriv=1)
+    ml2 = gp2.marginal_likelihood(given, {('a', 'a'): 0.1 * np.eye(60), ('b', 'b'): 0.1 * np.eye(40), ('a', 'b'): np.zeros((60, 40)), ('b', 'a'): np.zeros((40, 60))})
+    # the estimate of the logdet is the same but for the bound on the
+    # maximum eigenvalue used for the jitter
+    assert np.allclose(ml1, ml2, rtol=1e-4)
+    
+    # with hyperparameters traced by autograd the matrix is stored
+    grad = autograd.grad(lambda s: cg_marglike(s, 'cg', x, y, matfree=True))
+    assert np.allclose(grad(2.), autograd.grad(cg_marglike)(2., 'cg', x, y))
+
+def test_cg_pred():
+    x = np.linspace(0, 10, 50)
+    xpred = np.linspace(-1, 11, 20)
+    y = gvar.gvar(np.sin(x), np.full(len(x), 0.1))
+    results = []
+    for solver in ['cg', 'eigcut+']:
+        gp = lgp.GP(lgp.ExpQuad(scale=2), solver=solver)
+        gp.addx(x, 'data')
+        gp.addx(xpred, 'pred')
+        results.append(gp.predfromdata({'data': y}, 'pred', raw=True))
+    (m1, c1), (m2, c2) = results
+    assert np.allclose(m1, m2)
+    assert np.allclose(c1, c2)